@@ -1 +1,17 @@
-from .mie_coated import Mie
+__version__ = "0.2.0"
+
+from .mie_coated import Mie, MieSolver, MieResult
+from .mie_batch import mie_batch, mie_spectral, mie_stream, mie_jacobian
+from .mie_coeffs import enable_shared_cache, disable_shared_cache, \
+    enable_term_cache, disable_term_cache
+from .mie_lut import LookupTable, build_table, load_table
+from .mie_parallel import mie_sweep
+from .mie_psd import ExponentialPSD, GammaPSD, LognormalPSD, bulk_props
+from .mie_profile import profiling
+from .mie_refractive import water_permittivity, ice_permittivity, \
+    water_refractive_index, ice_refractive_index
+from .mie_backend import set_backend, get_backend, available_backends, \
+    backend
+
+from . import mie_backend
+mie_backend._init_backend()
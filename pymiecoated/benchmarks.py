@@ -0,0 +1,223 @@
+"""Benchmarks for the Mie code.
+
+Run with:
+python -m pymiecoated.benchmarks [--json FILE] [--min-time SECONDS]
+
+The results are printed as a table and, with --json, written as JSON so
+that they can be compared between versions.
+
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy
+from .mie_coated import Mie, MieSolver
+from .mie_batch import mie_batch, mie_jacobian
+from .mie_coeffs import MieCoeffs, single_mie_coeff, coated_mie_coeff, \
+    multilayer_mie_coeff, TermCache
+from . import mie_coeffs
+from . import mie_backend
+from . import __version__
+from .mie_props import mie_props, mie_S12, mie_pt, pt_cache
+
+
+SIZES = (0.01, 1.0, 100.0, 1e4)
+M = complex(1.5, 0.1)
+M2 = complex(1.33, 0.01)
+N_LAYERS = 5
+N_ANGLES = 181
+N_BATCH = 64
+
+
+def bench(func, min_time=0.2):
+    """Time a function.
+
+    The function is called repeatedly until min_time has elapsed, and once
+    more with tracemalloc enabled to measure its peak memory use.
+
+    Returns:
+        A dict with the number of calls per second, the time per call in
+        seconds and the peak memory allocated during one call in bytes.
+    """
+    func()
+    calls = 0
+    t0 = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter()-t0
+        if elapsed >= min_time:
+            break
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"calls_per_sec":calls/elapsed, "time_per_call":elapsed/calls,
+        "peak_memory":peak}
+
+
+def _clear_term_cache():
+    """Clear the term cache if it is enabled.
+    """
+    if mie_coeffs.term_cache is not None:
+        mie_coeffs.term_cache.clear()
+
+
+def _cases(x):
+    """The benchmark cases for the size parameter x.
+    """
+    eps = M**2
+    eps2 = M2**2
+    par = {"eps":eps, "mu":1.0, "x":x, "y":None, "eps2":None}
+    coeffs = MieCoeffs(par)
+    u = numpy.linspace(-1, 1, N_ANGLES)
+    mie_cached = Mie(x=x, m=M)
+    solver = MieSolver()
+    x_batch = x*numpy.linspace(0.5, 1.5, N_BATCH)
+
+    def S12_uncached():
+        pt_cache.clear()
+        mie_S12(coeffs, u)
+
+    def mie_uncached():
+        _clear_term_cache()
+        Mie(x=x, m=M).qext()
+
+    def solver_uncached():
+        _clear_term_cache()
+        MieSolver().solve(x, M).qext
+
+    def single_uncached():
+        _clear_term_cache()
+        single_mie_coeff(eps, 1.0, x)
+
+    def coated_uncached():
+        _clear_term_cache()
+        coated_mie_coeff(eps, eps2, 0.5*x, x)
+
+    # a new shell around the same core for each call, with the terms of
+    # the core taken from a term cache
+    shell = itertools.count()
+    term_cache = TermCache()
+    def coated_shell():
+        previous = mie_coeffs.term_cache
+        mie_coeffs.term_cache = term_cache
+        try:
+            coated_mie_coeff(eps, eps2, 0.5*x, x*(1+1e-9*next(shell)))
+        finally:
+            mie_coeffs.term_cache = previous
+
+    return [
+        ("single_mie_coeff", single_uncached),
+        ("coated_mie_coeff", coated_uncached),
+        ("coated_mie_coeff_shell", coated_shell),
+        ("multilayer_mie_coeff", lambda: multilayer_mie_coeff(
+            numpy.linspace(eps, eps2, N_LAYERS),
+            numpy.linspace(x/N_LAYERS, x, N_LAYERS))),
+        ("mie_props", lambda: mie_props(coeffs, x)),
+        ("mie_props_qext", lambda: mie_props(coeffs, x, ("qext",))),
+        ("mie_pt", lambda: mie_pt(u, coeffs.nmax)),
+        ("mie_S12_cached", lambda: mie_S12(coeffs, u)),
+        ("mie_S12_uncached", S12_uncached),
+        ("Mie_cached", mie_cached.qext),
+        ("Mie_uncached", mie_uncached),
+        ("MieSolver_cached", lambda: solver.solve(x, M).qext),
+        ("MieSolver_uncached", solver_uncached),
+        ("mie_batch", lambda: mie_batch(x=x_batch, m=M)),
+        ("mie_batch_single", lambda: mie_batch(x=x_batch, m=M,
+            precision="single")),
+        ("mie_jacobian", lambda: mie_jacobian(x=x_batch, m=M)),
+    ]
+
+
+def run_benchmarks(sizes=SIZES, min_time=0.2, names=None):
+    """Run the benchmarks.
+
+    Args:
+        sizes: The size parameters to benchmark.
+        min_time: The minimum time spent on each benchmark in seconds.
+        names: If given, run only the benchmarks with these names.
+
+    Returns:
+        A dict with information about the environment (including the
+        pymiecoated version and the active backend) and a list of the
+        results under "results".
+    """
+    results = []
+    for x in sizes:
+        for (name, func) in _cases(x):
+            if (names is not None) and (name not in names):
+                continue
+            res = {"name":name, "x":x}
+            res.update(bench(func, min_time=min_time))
+            results.append(res)
+
+    return {
+        "pymiecoated":__version__,
+        "backend":mie_backend.get_backend(),
+        "python":platform.python_version(),
+        "numpy":numpy.__version__,
+        "platform":platform.platform(),
+        "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results":results
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pymiecoated.")
+    parser.add_argument("--json", metavar="FILE",
+        help="write the results as JSON to FILE ('-' for stdout)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+        help="minimum time per benchmark in seconds")
+    parser.add_argument("--sizes", type=float, nargs="+", default=SIZES,
+        help="size parameters to benchmark")
+    parser.add_argument("--names", nargs="+",
+        help="run only the benchmarks with these names")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(sizes=args.sizes, min_time=args.min_time,
+        names=args.names)
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    print("{:<24} {:>10} {:>14} {:>14} {:>12}".format(
+        "benchmark", "x", "calls/s", "s/call", "peak bytes"))
+    for res in report["results"]:
+        print("{name:<24} {x:>10g} {calls_per_sec:>14.1f} " \
+            "{time_per_call:>14.3e} {peak_memory:>12d}".format(**res))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
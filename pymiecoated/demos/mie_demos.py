@@ -28,7 +28,8 @@ try:
     from matplotlib import pyplot
 except ImportError:
     pass
-from ..mie_coated import Mie
+from ..mie_coated import MieSolver
+from ..mie_refractive import ice_refractive_index, water_refractive_index
 
 
 def melting_hail(plot=False):
@@ -43,9 +44,10 @@ def melting_hail(plot=False):
         is installed.
     """
     c = 299792458.0
-    wl = c/5.6e9*1e3
-    m_i = complex(1.7844, 1.4773e-4)
-    m_w = complex(8.3355, 2.2173)
+    freq = 5.6e9
+    wl = c/freq*1e3
+    m_i = ice_refractive_index(freq, 273.15)
+    m_w = water_refractive_index(freq, 273.15)
 
     D_shell = numpy.linspace(1, 30, 1000)
     frac = numpy.arange(0.0,1.01,0.2)
@@ -55,11 +57,9 @@ def melting_hail(plot=False):
 
     xsect = {}
 
-    mie = Mie(m=m_i,m2=m_w)
+    solver = MieSolver()
     def xsect_b(xc,xs):
-        mie.x = xc
-        mie.y = xs
-        return mie.qb()*pi*xs**2
+        return solver.solve(xc,m_i,xs,m_w).qb*pi*xs**2
 
     for f in frac:
         x_core = x_shell * f**(1.0/3.0)
@@ -19,15 +19,136 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-class Cache(dict):
-    def __init__(self, size=10):
-        super(Cache, self).__init__()
-        self.size = size
-        self.log = []
+from collections import OrderedDict
+import sys
+import threading
+
+
+# Marks a cache limit that was not given, as opposed to None for no limit.
+DEFAULT = object()
+
+
+class Cache(object):
+    """A least-recently-used cache.
+
+    The cache can be bounded by the number of entries, by the total size of
+    the entries in bytes, or both. The size of an entry is taken from its
+    nbytes attribute if it has one, otherwise from sys.getsizeof.
+
+    Hits and misses are counted by get(); evictions by the insertions that
+    cause them. Use stats() to see the counters.
+
+    Attributes:
+        size: The maximum number of entries (None for no limit).
+        max_bytes: The maximum total size of the entries in bytes (None for
+            no limit).
+        default_size, default_max_bytes: The limits used for new caches if
+            they are not given (or given as DEFAULT). Set these on the class
+            to change the limits globally, e.g. Cache.default_size = 100.
+    """
+    default_size = 10
+    default_max_bytes = None
+
+    def __init__(self, size=DEFAULT, max_bytes=DEFAULT):
+        self.size = self.default_size if size is DEFAULT else size
+        self.max_bytes = self.default_max_bytes if max_bytes is DEFAULT \
+            else max_bytes
+        self._data = OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def get(self, key, default=None):
+        """Get the entry for key, marking it as recently used.
+
+        Returns default if the key is not found.
+        """
+        try:
+            (value, nbytes) = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        (value, nbytes) = self._data[key]
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._data.pop(key)[1]
+        nbytes = self._sizeof(value)
+        self._data[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self._data and (
+            ((self.size is not None) and (len(self._data) > self.size)) or
+            ((self.max_bytes is not None) and (self.nbytes > self.max_bytes))):
+            self.nbytes -= self._data.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def _sizeof(self, value):
+        nbytes = getattr(value, "nbytes", None)
+        return sys.getsizeof(value) if nbytes is None else nbytes
+
+    def __delitem__(self, key):
+        self.nbytes -= self._data.pop(key)[1]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """The cache counters.
+
+        Returns:
+            A dict with the numbers of hits, misses and evictions, the
+            current number of entries and their total size in bytes.
+        """
+        return {"hits":self.hits, "misses":self.misses,
+            "evictions":self.evictions, "entries":len(self._data),
+            "nbytes":self.nbytes}
+
+
+class SharedCache(Cache):
+    """A thread-safe version of Cache.
+    """
+    def __init__(self, size=DEFAULT, max_bytes=DEFAULT):
+        super(SharedCache, self).__init__(size=size, max_bytes=max_bytes)
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super(SharedCache, self).get(key, default)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super(SharedCache, self).__getitem__(key)
 
     def __setitem__(self, key, value):
-        super(Cache, self).__setitem__(key, value)
-        self.log.append(key)
-        if len(self.log) > self.size:
-            del self[self.log[0]]
-            self.log.pop(0)
+        with self._lock:
+            super(SharedCache, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super(SharedCache, self).__delitem__(key)
+
+    def clear(self):
+        with self._lock:
+            super(SharedCache, self).clear()
+
+    def stats(self):
+        with self._lock:
+            return super(SharedCache, self).stats()
@@ -0,0 +1,202 @@
+"""Compute backends for the sequential kernels of the Mie code.
+
+The recurrences over the orders n (the logarithmic derivative, the
+Riccati-Bessel functions, the psi*zeta products, the angular functions and
+the sums over the coefficients) are provided by a backend. The "numpy"
+backend is always available; the "numba" backend compiles the kernels with
+numba if it is installed.
+
+The backend is chosen when pymiecoated is imported, from the environment
+variable PYMIECOATED_BACKEND ("numpy", "numba" or "auto", the default,
+which uses numba if it is installed). Selecting an optional backend only
+checks that its dependency is installed; its module (e.g. mie_numba, which
+imports numba) is imported when one of its kernels is first used. The
+backend can be changed with set_backend, or within a block with:
+with backend("numpy"):
+    mie.qb()
+
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from contextlib import contextmanager
+import importlib
+import importlib.util
+import os
+import warnings
+
+
+class Backend(object):
+    """A named set of kernels, available as attributes.
+
+    The kernels of an optional backend are loaded by importing its module
+    when one of them is first accessed.
+
+    Attributes:
+        name: The name of the backend.
+        log_derivative: See mie_coeffs.log_derivative.
+        riccati_bessel: See mie_coeffs.riccati_bessel.
+        psi_zeta: See mie_coeffs._psi_zeta.
+        mie_pt: See mie_props.mie_pt.
+        all_props: A function (coeffs, y) returning all the properties of
+            one particle in the order of mie_props.PROP_NAMES.
+    """
+    def __init__(self, name, module=None):
+        self.name = name
+        self._module = module
+
+    def __getattr__(self, kernel):
+        # only called for kernels that are not loaded yet
+        module = self.__dict__.get("_module")
+        if (kernel not in KERNELS) or (module is None):
+            raise AttributeError(kernel)
+        self._module = None
+        try:
+            importlib.import_module(module, __package__)
+        except ImportError as e:
+            warnings.warn("The backend {} could not be loaded ({}). " \
+                "Using the numpy kernels.".format(self.name, e))
+        _fill_kernels(self)
+        return getattr(self, kernel)
+
+
+# The names of the kernels that a backend provides
+KERNELS = ("log_derivative", "riccati_bessel", "psi_zeta", "mie_pt",
+    "all_props")
+
+# The registered backends, and the modules that register the optional ones
+# together with the packages they require
+_backends = {}
+_modules = {"numba": (".mie_numba", "numba")}
+
+active = None
+
+
+def register_kernels(name, **kernels):
+    """Register kernels for the backend name, creating it if necessary.
+
+    Kernels that a backend does not provide are taken from the "numpy"
+    backend.
+    """
+    for k in kernels:
+        if k not in KERNELS:
+            raise ValueError("Unknown kernel: " + k)
+    b = _backends.get(name)
+    if b is None:
+        b = _backends[name] = Backend(name)
+    for (k, kernel) in kernels.items():
+        setattr(b, k, kernel)
+
+
+def _load(name):
+    """The backend name, without importing the module of an optional
+    backend yet (see Backend).
+
+    Returns:
+        The Backend, or None if it is not available.
+    """
+    if (name not in _backends) and (name in _modules):
+        (module, requires) = _modules[name]
+        if importlib.util.find_spec(requires) is None:
+            return None
+        _backends[name] = Backend(name, module=module)
+    b = _backends.get(name)
+    if (b is not None) and (b.__dict__.get("_module") is None):
+        _fill_kernels(b)
+    return b
+
+
+def _fill_kernels(b):
+    """Take the kernels that the backend b does not provide from the
+    "numpy" backend.
+    """
+    numpy_backend = _backends["numpy"]
+    for k in KERNELS:
+        if k not in b.__dict__:
+            setattr(b, k, getattr(numpy_backend, k))
+
+
+def available_backends():
+    """The names of the backends that can be used.
+    """
+    names = sorted(set(_backends) | set(_modules))
+    return [name for name in names if _load(name) is not None]
+
+
+def _activate(b):
+    """Make b the active backend. If it changes, the caches of the terms
+    and angular functions computed with the previous backend are cleared.
+    """
+    global active
+    if b is not active:
+        # imported here since these modules import this one
+        from . import mie_coeffs, mie_props
+        if mie_coeffs.term_cache is not None:
+            mie_coeffs.term_cache.clear()
+        mie_props.pt_cache.clear()
+    active = b
+
+
+def set_backend(name="auto"):
+    """Select the backend by name, or with "auto" the fastest available.
+    The cached terms computed with the previous backend are discarded.
+
+    Returns:
+        The name of the selected backend.
+    """
+    if name == "auto":
+        b = _load("numba") or _load("numpy")
+    elif (name not in _backends) and (name not in _modules):
+        raise ValueError("Unknown backend: " + str(name))
+    else:
+        b = _load(name)
+        if b is None:
+            raise ValueError("The backend " + name + " is not available.")
+    _activate(b)
+    return b.name
+
+
+def get_backend():
+    """The name of the active backend.
+    """
+    return active.name
+
+
+@contextmanager
+def backend(name):
+    """Context manager that uses the backend name within its block.
+    """
+    previous = active
+    set_backend(name)
+    try:
+        yield active
+    finally:
+        _activate(previous)
+
+
+def _init_backend():
+    """Select the backend given by the environment variable
+    PYMIECOATED_BACKEND, falling back to numpy with a warning if it is not
+    available.
+    """
+    try:
+        set_backend(os.environ.get("PYMIECOATED_BACKEND", "auto"))
+    except ValueError as e:
+        warnings.warn(str(e) + " Using the numpy backend.")
+        set_backend("numpy")
@@ -0,0 +1,360 @@
+"""
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from numpy import asarray, broadcast_arrays, argsort, empty, errstate, where
+from numpy import pi, float32
+from .mie_coeffs import MieCoeffsBatch, MieCoeffsJac, _nmax
+from .mie_props import mie_props, mie_props_jac, PROP_NAMES
+
+
+def mie_batch(x=None, m=None, y=None, m2=None, eps=None, mu=None,
+    eps2=None, x_layers=None, m_layers=None, eps_layers=None,
+    chunk_size=256, props=PROP_NAMES, precision="double"):
+    """Scattering properties of many homogeneous or coated spheres at once.
+
+    The arguments have the same meaning as the attributes of Mie, but can
+    be given as arrays (scalars are broadcast against the arrays). The
+    particles are sorted by size and processed in chunks, so that the
+    coefficients of each chunk can be computed as a padded 2-D array with
+    little wasted work.
+
+    For example, the melting hail demo can be computed with:
+    mie_batch(x=x_core, y=x_shell, m=m_i, m2=m_w)["qb"]
+
+    Multilayered spheres are given with x_layers and m_layers (or
+    eps_layers) instead, as arrays whose last axis runs over the layers
+    from the core outward; the other axes are broadcast as above.
+
+    Args:
+        x, m, y, m2, eps, mu, eps2: See Mie.
+        x_layers, m_layers, eps_layers: See Mie.
+        chunk_size: The number of particles computed simultaneously.
+        props: The names of the properties to compute, see mie_props.
+            Computing only the needed ones saves time, e.g. props=("qext",)
+            skips the sums for the backscattering and the asymmetry.
+        precision: "double" or "single". In single precision the results
+            are float32 arrays, and the errors of qext, qsca and qb are
+            below 1e-4*qext and those of asy below 1e-4; see
+            mie_coeffs_batch for details.
+
+    Returns:
+        A dict with the properties given by props (by default "qext",
+        "qsca", "qabs", "qb", "asy" and "qratio"), each containing an array
+        with the broadcast shape of the arguments.
+    """
+    (par, shape) = _batch_params(x=x, m=m, y=y, m2=m2, eps=eps, mu=mu,
+        eps2=eps2, x_layers=x_layers, m_layers=m_layers,
+        eps_layers=eps_layers)
+    N = len(_outer_size(par))
+    dtype = float32 if precision == "single" else float
+    results = dict((p,empty(N, dtype=dtype)) for p in props)
+
+    for ind in _size_chunks(par, chunk_size):
+        props_chunk = _batch_props(par, ind, props, precision)
+        for p in props:
+            results[p][ind] = props_chunk[p]
+
+    return dict((p,results[p].reshape(shape)) for p in props)
+
+
+def mie_jacobian(x=None, m=None, y=None, m2=None, eps=None, eps2=None,
+    chunk_size=256, props=PROP_NAMES):
+    """Scattering properties of many spheres and their derivatives.
+
+    The derivatives with respect to the size parameters and the real and
+    imaginary parts of the refractive indices are computed analytically in
+    the same pass as the properties (see mie_coeffs_jac). This costs about
+    as much as three evaluations with mie_batch for homogeneous spheres and
+    five for coated ones, compared to four and seven for one-sided finite
+    differences, and has no truncation error.
+
+    For example, the derivatives of qb for a retrieval:
+    (values, jac) = mie_jacobian(x=x, m=m, props=("qext","qb"))
+    (jac["qb"]["x"], jac["qb"]["m_real"], jac["qb"]["m_imag"])
+
+    Args:
+        x, m, y, m2, eps, eps2: As in mie_batch. Multilayered and magnetic
+            spheres are not supported.
+        chunk_size, props: As in mie_batch.
+
+    Returns:
+        A tuple (values, jac) where values is a dict as returned by
+        mie_batch, and jac contains for each property a dict of the
+        derivatives with respect to "x", "m_real" and "m_imag" and, for
+        coated spheres, "y", "m2_real" and "m2_imag", each an array with
+        the broadcast shape of the arguments. The derivatives with respect
+        to m are also given if the particles were specified with eps.
+    """
+    (par, shape) = _batch_params(x=x, m=m, y=y, m2=m2, eps=eps, eps2=eps2)
+    N = len(_outer_size(par))
+    names = ("x", "m_real", "m_imag") if par["y"] is None else \
+        ("x", "y", "m_real", "m_imag", "m2_real", "m2_imag")
+    values = dict((p,empty(N)) for p in props)
+    jac = dict((p,empty((len(names),N))) for p in props)
+
+    for ind in _size_chunks(par, chunk_size):
+        par_chunk = dict((k,v if v is None else v[ind])
+            for (k,v) in par.items())
+        coeffs = MieCoeffsJac(par_chunk)
+        (values_chunk, jac_chunk) = mie_props_jac(coeffs,
+            _outer_size(par_chunk), props)
+        for p in props:
+            values[p][ind] = values_chunk[p]
+            jac[p][:,ind] = jac_chunk[p]
+
+    return (dict((p,values[p].reshape(shape)) for p in props),
+        dict((p,dict((k,d.reshape(shape)) for (k,d) in zip(names,jac[p])))
+        for p in props))
+
+
+def mie_spectral(wl, r, m, r2=None, m2=None, chunk_size=256,
+    props=PROP_NAMES, precision="double"):
+    """Scattering properties of one particle at many wavelengths.
+
+    All the wavelengths are computed in a single vectorized pass with
+    mie_batch.
+
+    Args:
+        wl: Array of wavelengths.
+        r: The radius of the particle, or of the core for coated particles,
+            in the same units as wl.
+        m: The complex refractive index, either an array matching wl or a
+            function that returns the refractive index for an array of
+            wavelengths.
+        r2: The outer radius of a coated particle.
+        m2: The refractive index of the shell, given as m.
+        chunk_size, props, precision: Passed to mie_batch.
+
+    Returns:
+        A dict of arrays as returned by mie_batch, with the shape of wl.
+    """
+    wl = asarray(wl, dtype=float)
+    k = 2*pi/wl
+    if callable(m):
+        m = m(wl)
+    if r2 is None:
+        if m2 is not None:
+            raise ValueError("Must specify both r2 and m2 for coated " + \
+                "particles.")
+        return mie_batch(x=k*r, m=m, chunk_size=chunk_size, props=props,
+            precision=precision)
+    if callable(m2):
+        m2 = m2(wl)
+    return mie_batch(x=k*r, y=k*r2, m=m, m2=m2, chunk_size=chunk_size,
+        props=props, precision=precision)
+
+
+def mie_stream(records, chunk_size=256, props=PROP_NAMES,
+    precision="double"):
+    """Scattering properties of a stream of particles.
+
+    The records are read from any iterable (e.g. a generator reading a
+    file) and computed with mie_batch in chunks of at most chunk_size
+    consecutive records, so only one chunk is held in memory at a time and
+    the input can be arbitrarily long.
+
+    Each record is either a tuple (x, m) or (x, m, y, m2), or a dict of
+    keyword arguments of mie_batch for a single particle, e.g.
+    {"x":1.0, "y":2.0, "eps":eps, "eps2":eps2} or
+    {"x_layers":[1.0,2.0,3.0], "m_layers":[m1,m2,m3]}. A chunk is also
+    ended when the kind of record changes, so streams that mix kinds are
+    computed in smaller chunks.
+
+    For example:
+    for props in mie_stream((x, m) for (x, m) in records):
+        print(props["qext"])
+
+    Args:
+        records: An iterable of particle records.
+        chunk_size: The maximum number of records computed together.
+        props, precision: See mie_batch.
+
+    Returns:
+        A generator that yields, in the order of the records, a dict of
+        the properties given by props for each record. An invalid record
+        raises ValueError when its chunk is computed.
+    """
+    chunk = []
+    kind = None
+    for rec in records:
+        rec = _stream_record(rec)
+        rec_kind = _record_kind(rec)
+        if chunk and ((rec_kind != kind) or (len(chunk) >= chunk_size)):
+            for res in _stream_chunk(chunk, props, precision):
+                yield res
+            chunk = []
+        kind = rec_kind
+        chunk.append(rec)
+    if chunk:
+        for res in _stream_chunk(chunk, props, precision):
+            yield res
+
+
+def _stream_record(rec):
+    """A record of mie_stream as a dict of the given arguments.
+    """
+    if not isinstance(rec, dict):
+        rec = tuple(rec)
+        if len(rec) not in (2, 4):
+            raise ValueError("A record must be (x, m), (x, m, y, m2) " + \
+                "or a dict.")
+        rec = dict(zip(("x","m","y","m2"), rec))
+    return dict((k,v) for (k,v) in rec.items() if v is not None)
+
+
+def _record_kind(rec):
+    """The kind of a record of mie_stream; only records of the same kind
+    can be computed together.
+    """
+    return tuple(sorted(rec)) + \
+        ((len(rec["x_layers"]),) if "x_layers" in rec else ())
+
+
+def _stream_chunk(chunk, props, precision):
+    """Compute a chunk of records of the same kind for mie_stream.
+    """
+    kwargs = dict((k,[rec[k] for rec in chunk]) for k in chunk[0])
+    results = mie_batch(chunk_size=len(chunk), props=props,
+        precision=precision, **kwargs)
+    for i in range(len(chunk)):
+        yield dict((p,results[p][i].item()) for p in props)
+
+
+def _batch_params(x=None, m=None, y=None, m2=None, eps=None, mu=None,
+    eps2=None, x_layers=None, m_layers=None, eps_layers=None):
+    """Convert the arguments of mie_batch to flat arrays.
+
+    Returns:
+        A tuple (par, shape) where par is a dict of the flattened parameters
+        in the form used by mie_coeffs_batch and shape is the broadcast
+        shape of the arguments. For multilayered spheres, x_layers and
+        eps_layers have the shape (N, L).
+    """
+    if x_layers is not None:
+        return _layer_params(x, m, y, m2, eps, mu, eps2, x_layers,
+            m_layers, eps_layers)
+    if (m_layers is not None) or (eps_layers is not None):
+        raise ValueError("Must specify x_layers with m_layers or " + \
+            "eps_layers.")
+    if (m is not None) and (eps is not None):
+        raise ValueError("Cannot specify both eps and m.")
+    if (m2 is not None) and (eps2 is not None):
+        raise ValueError("Cannot specify both eps2 and m2.")
+    if m is not None:
+        eps = asarray(m)**2
+        mu = None
+    if m2 is not None:
+        eps2 = asarray(m2)**2
+
+    names = ("eps","mu","x","y","eps2")
+    given = [(k,v) for (k,v) in zip(names,(eps,mu,x,y,eps2)) if v is not None]
+    arrays = broadcast_arrays(*[asarray(v) for (k,v) in given])
+    shape = arrays[0].shape if arrays else ()
+    par = dict((k,None) for k in names)
+    par.update((k,a.ravel()) for ((k,v),a) in zip(given,arrays))
+    if par["x"] is None:
+        raise ValueError("Must specify x and either eps or m.")
+    if (par["x"] < 0).any() or \
+        ((par["y"] is not None) and (par["y"] < par["x"]).any()):
+        raise ValueError("The sizes must satisfy 0 <= x <= y.")
+    return (par, shape)
+
+
+def _layer_params(x, m, y, m2, eps, mu, eps2, x_layers, m_layers,
+    eps_layers):
+    """_batch_params for multilayered spheres.
+    """
+    if any(v is not None for v in (x, m, y, m2, eps, eps2)):
+        raise ValueError("Cannot specify x_layers together with x, y, " + \
+            "m, m2, eps or eps2.")
+    if (m_layers is not None) and (eps_layers is not None):
+        raise ValueError("Cannot specify both eps_layers and m_layers.")
+    if (mu is not None) and (asarray(mu) != 1.0).any():
+        raise ValueError("Multilayer calculations for magnetic " + \
+            "particles are not currently supported.")
+    if m_layers is not None:
+        eps_layers = asarray(m_layers)**2
+    if eps_layers is None:
+        raise ValueError("Must specify eps_layers or m_layers for each " + \
+            "layer.")
+    (x_layers, eps_layers) = broadcast_arrays(
+        asarray(x_layers, dtype=float), asarray(eps_layers))
+    if x_layers.ndim == 0:
+        raise ValueError("x_layers must have an axis for the layers.")
+    shape = x_layers.shape[:-1]
+    L = x_layers.shape[-1]
+    par = dict((k,None) for k in ("eps","mu","x","y","eps2"))
+    par["x_layers"] = x_layers.reshape(-1,L)
+    par["eps_layers"] = eps_layers.reshape(-1,L)
+    return (par, shape)
+
+
+def _outer_size(par):
+    """The size parameters of the particles described by par.
+    """
+    if par.get("x_layers") is not None:
+        return par["x_layers"][:,-1]
+    return par["x"] if par["y"] is None else par["y"]
+
+
+# The largest number of coefficients (particles times orders) computed in
+# one chunk; this bounds the memory used for large size parameters
+MAX_CHUNK_COEFFS = 2**20
+
+
+def _size_chunks(par, chunk_size):
+    """Split the particles into chunks of similar size.
+
+    The chunks have at most chunk_size particles, and fewer for large
+    particles so that a chunk has at most MAX_CHUNK_COEFFS coefficients
+    (per layer for multilayered spheres).
+
+    Returns:
+        A list of index arrays, one for each chunk.
+    """
+    size = _outer_size(par)
+    order = argsort(size, kind="stable")
+    nmax = _nmax(size[order])
+    if par.get("x_layers") is not None:
+        # the temporary arrays of the layered version grow with the layers
+        nmax = nmax*par["x_layers"].shape[1]
+    chunks = []
+    i0 = 0
+    while i0 < len(size):
+        n = min(chunk_size, len(size)-i0)
+        # the particles are sorted, so the last one has the largest nmax
+        while (n > 1) and (n*nmax[i0+n-1] > MAX_CHUNK_COEFFS):
+            n = max(min(n-1, MAX_CHUNK_COEFFS//nmax[i0+n-1]), 1)
+        chunks.append(order[i0:i0+n])
+        i0 += n
+    return chunks
+
+
+def _batch_props(par, ind, props=PROP_NAMES, precision="double"):
+    """The scattering properties of the particles with the indices ind.
+    """
+    par_chunk = dict((k,v if v is None else v[ind]) for (k,v) in par.items())
+    coeffs = MieCoeffsBatch(par_chunk, precision)
+    size = _outer_size(par_chunk)
+    with errstate(invalid="ignore", divide="ignore"):
+        values = mie_props(coeffs, size, props)
+    # give valid output for zero-sized particles
+    return dict((p,where(size==0, 0.0, values[p])) for p in props)
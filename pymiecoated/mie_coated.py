@@ -19,36 +19,159 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from numpy import sqrt
+from numpy import sqrt, asarray, zeros, array
 from .mie_coeffs import MieCoeffs
-from .mie_aux import Cache
-from .mie_props import mie_props, mie_S12
+from .mie_aux import Cache, DEFAULT
+from .mie_props import mie_S12, mie_mueller, mie_legendre, PROP_NAMES, \
+    _mie_props
+from . import mie_backend
+from . import mie_profile
 
 
 class MieScatterProps(object):
     """Stores the mie coefficients and the corresponding parameters.
+
+    The scattering properties are computed when first requested, each
+    together with the ones it depends on, and memoized.
     """
     def __init__(self, params):
-        par = dict(zip(("eps","mu","x","y","eps2"),params[:5]))
-        if par["x"]==0 and par["y"] is None:
+        par = dict(zip(("eps","mu","x","y","eps2","x_layers","eps_layers"),
+            params[:7]))
+        if par["x_layers"] is not None:
+            self.size = par["x_layers"][-1]
+        else:
+            self.size = par["x"] if par["y"]==None else par["y"]
+        if self.size==0:
             #give valid output for x==0
-            self._coeffs = {"qext":0.0, "qsca":0.0, "qabs":0.0, "qb":0.0,
-                            "0.0":asy, "0.0":qratio}
+            self._coeffs = None
+            self._props = dict((p,0.0) for p in PROP_NAMES)
         else:
             self._coeffs = MieCoeffs(par)
-        self._props = None
+            self._props = {}
         self._S12 = None
-        self.size = par["x"] if par["y"]==None else par["y"]
+
+    def _get_nbytes(self):
+        if self._coeffs is None:
+            return 0
+        return self._coeffs.an.nbytes + self._coeffs.bn.nbytes
+
+    nbytes = property(_get_nbytes)
 
     def prop(self, prop_name):
-        if self._props is None:
-            self._props = mie_props(self._coeffs, self.size)
+        if prop_name not in self._props:
+            self._props = _mie_props(self._coeffs, self.size, (prop_name,),
+                self._props)
         return self._props[prop_name]
 
     def S12(self, u):
+        if self._coeffs is None:
+            z = zeros(asarray(u).shape, dtype=complex)
+            return (z, z.copy())
         self._S12 = mie_S12(self._coeffs, u)
         return self._S12
 
+    def mueller(self, u):
+        if self._coeffs is None:
+            return tuple(zeros(asarray(u).shape) for i in range(4))
+        return mie_mueller(self._coeffs, u)
+
+    def legendre(self, n_moments):
+        if self._coeffs is None:
+            #the Rayleigh limit
+            chi = zeros(3 if n_moments is None else n_moments)
+            chi[:3] = (1.0, 0.0, 0.1)[:len(chi)]
+            return chi
+        return mie_legendre(self._coeffs, n_moments)
+
+
+class MieResult(object):
+    """All the scattering properties of a particle, as returned by
+    MieSolver.solve.
+
+    The properties are stored in a single float array, values, in the
+    order of PROP_NAMES, and can be read as attributes, e.g. result.qb.
+    """
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+    def _get_nbytes(self):
+        return self.values.nbytes
+
+    nbytes = property(_get_nbytes)
+
+    def as_dict(self):
+        return dict(zip(PROP_NAMES, self.values.tolist()))
+
+
+def _result_property(i):
+    return property(lambda self: float(self.values[i]))
+
+for (i, p) in enumerate(PROP_NAMES):
+    setattr(MieResult, p, _result_property(i))
+
+
+class MieSolver(object):
+    """A low-overhead solver for homogeneous and coated spheres.
+
+    This is meant for tight loops over particles. Unlike Mie, it has no
+    attributes to set: solve() takes the parameters as arguments and
+    returns all the scattering properties at once, and the results are
+    cached as a small array per particle. Use Mie for magnetic and
+    multilayered spheres and for the scattering matrix.
+
+    For example, with a core of x and m and a shell of y and m2:
+    solver = MieSolver()
+    qb = solver.solve(x, m, y, m2).qb
+
+    The keyword arguments cache_size and cache_max_bytes are as for Mie.
+    """
+    __slots__ = ("_cache",)
+
+    def __init__(self, cache_size=DEFAULT, cache_max_bytes=DEFAULT):
+        self._cache = Cache(size=cache_size, max_bytes=cache_max_bytes)
+
+    def solve(self, x, m, y=None, m2=None):
+        """The scattering properties of a sphere.
+
+        Args:
+            x: The size parameter (of the core for coated spheres).
+            m: The complex refractive index (of the core).
+            y, m2: The size parameter and the refractive index of the
+                shell of a coated sphere (must be y >= x).
+
+        Returns:
+            A MieResult.
+        """
+        key = (x, m, y, m2)
+        result = self._cache.get(key)
+        if result is None:
+            result = MieResult(_solve(x, m, y, m2))
+            self._cache[key] = result
+        return result
+
+    def cache_stats(self):
+        """The statistics of the result cache, see Mie.cache_stats.
+        """
+        return self._cache.stats()
+
+
+def _solve(x, m, y, m2):
+    """The array of the properties for MieSolver.solve.
+    """
+    if (x < 0) or ((y is not None) and (y < x)):
+        raise ValueError("The sizes must satisfy 0 <= x <= y.")
+    if (y is None) != (m2 is None):
+        raise ValueError("Must specify both y and m2 for coated particles.")
+    size = x if y is None else y
+    if size == 0:
+        return zeros(len(PROP_NAMES))
+    par = {"eps":m*m, "mu":None, "x":x, "y":y,
+        "eps2":None if m2 is None else m2*m2}
+    return array(mie_backend.active.all_props(MieCoeffs(par), size),
+        dtype=float)
+
 
 class Mie(object):
     """Class for computing Mie scattering from homogeneous and coated spheres.
@@ -69,34 +192,46 @@ class Mie(object):
     m: The complex refractive index. Setting this sets eps to m**2 and mu
         to 1.0.
     m2: The complex refractive index of the outer layer. See "m" above.
+    x_layers: For spheres with any number of layers, the size parameters
+        of the outer boundaries of the layers from the core outward, e.g.
+        [x_core, x_layer1, x_layer2]. Use this instead of x and y.
+    eps_layers: The complex relative permittivities of the layers given
+        by x_layers.
+    m_layers: The complex refractive indices of the layers given by
+        x_layers. Setting this sets eps_layers and sets mu to 1.0.
 
-    Setting mu together with eps2 and y raises an error.
+    Setting mu together with eps2 and y, or with x_layers, raises an error.
 
     Any of the above attributes can be given as keyword arguments when
     creating a new Mie instance. For example:
     mie = Mie(x=1.5,m=complex(1.2,0.1))
+
+    The results for recently used parameters are kept in a LRU cache. Its
+    limits can be given with the keyword arguments cache_size (number of
+    entries) and cache_max_bytes, where None means no limit; the defaults
+    are set globally by mie_aux.Cache.default_size and
+    mie_aux.Cache.default_max_bytes.
     """
     def __init__(self, **kwargs):
-        self._cache = Cache()
+        self._cache = Cache(size=kwargs.get("cache_size", DEFAULT),
+            max_bytes=kwargs.get("cache_max_bytes", DEFAULT))
         self.eps = None
         self.mu = 1.0
         self._x = None
         self._y = None
         self.eps2 = None
+        self._x_layers = None
+        self._eps_layers = None
         for k in ["eps","mu","eps2"]:
             if k in kwargs:
                 self.__dict__[k] = kwargs[k]
-        if "m" in kwargs:
-            self.m = kwargs["m"]
-        if "m2" in kwargs:
-            self.m2 = kwargs["m2"]
-        if "x" in kwargs:
-            self.x = kwargs["x"]
-        if "y" in kwargs:
-            self.y = kwargs["y"]
+        for k in ["m","m2","x","y","x_layers","eps_layers","m_layers"]:
+            if k in kwargs:
+                setattr(self, k, kwargs[k])
 
     def _params_signature(self):
-        return (self.eps, self.mu, self.x, self.y, self.eps2)
+        return (self.eps, self.mu, self.x, self.y, self.eps2, self.x_layers,
+            self.eps_layers)
 
     def qext(self):
         """The extinction efficiency.
@@ -153,28 +288,78 @@ class Mie(object):
         """The amplitude scattering matrix elements.
 
         Arguments:
-            u: The cosine of the scattering angle, -1 <= u <= 1
+            u: The cosine of the scattering angle, -1 <= u <= 1. This can
+                also be an array of cosines, which is much faster than
+                calling S12 separately for each angle.
 
         Returns:
             The amplitude scattering matrix elements S1 and S2.
             Follows the conventions of Bohren and Huffman (1983).
+            If u is an array, S1 and S2 are arrays of the same shape.
         """
         return self._get_S12(u)
 
+    def mueller(self, u):
+        """The scattering (Mueller) matrix elements.
 
-    def _get_scatt_prop(self, prop):
+        Arguments:
+            u: The cosine of the scattering angle, as for S12.
+
+        Returns:
+            The independent elements (S11, S12, S33, S34) of the scattering
+            matrix, following Bohren and Huffman (1983). S11 integrates
+            over the sphere to pi*x**2*qsca, where x is the outer size.
+        """
+        self._check_u(u)
+        return self._get_scatt_props().mueller(u)
+
+    def legendre_moments(self, n_moments=None):
+        """The Legendre moments of the phase function.
+
+        Arguments:
+            n_moments: The number of moments (default: all the nonzero
+                moments).
+
+        Returns:
+            An array of the moments chi_l, l = 0...n_moments-1, of the
+            expansion p(u) = sum_l (2*l+1)*chi_l*P_l(u) of the phase
+            function, normalized so that chi_0 = 1 and chi_1 = asy().
+            These are the phase function moments used by DISORT.
+        """
+        return self._get_scatt_props().legendre(n_moments)
+
+
+    def cache_stats(self):
+        """The statistics of the result cache.
+
+        Returns:
+            A dict with the numbers of cache hits, misses and evictions,
+            the number of cached entries and their size in bytes.
+        """
+        return self._cache.stats()
+
+
+    def _get_scatt_props(self):
         sig = self._params_signature()
-        if sig not in self._cache:
-            self._cache[sig] = MieScatterProps(sig)
-        return self._cache[sig].prop(prop)
+        props = self._cache.get(sig)
+        prof = mie_profile.active
+        if prof is not None:
+            prof.count("Mie.cache_miss" if props is None else "Mie.cache_hit")
+        if props is None:
+            props = MieScatterProps(sig)
+            self._cache[sig] = props
+        return props
+
+    def _get_scatt_prop(self, prop):
+        return self._get_scatt_props().prop(prop)
 
     def _get_S12(self, u):
-        if abs(u) > 1:
+        self._check_u(u)
+        return self._get_scatt_props().S12(u)
+
+    def _check_u(self, u):
+        if (abs(asarray(u)) > 1).any():
             raise ValueError("The cosine u must be between -1 and 1.")
-        sig = self._params_signature()
-        if sig not in self._cache:
-            self._cache[sig] = MieScatterProps(sig)
-        return self._cache[sig].S12(u)
 
 
     def _get_m(self):
@@ -188,7 +373,7 @@ class Mie(object):
 
 
     def _get_m2(self):
-        return sqrt(self.m2)
+        return sqrt(self.eps2)
 
     def _set_m2(self, m2):
         self.eps2 = m2**2
@@ -218,3 +403,42 @@ class Mie(object):
             raise ValueError("The size y cannot be smaller than x.")
 
     y = property(_get_y, _set_y)
+
+
+    def _get_x_layers(self):
+        return self._x_layers
+
+    def _set_x_layers(self, x_layers):
+        if x_layers is None:
+            self._x_layers = None
+            return
+        x_layers = tuple(float(x) for x in x_layers)
+        if (len(x_layers) == 0) or (x_layers[0] < 0) or \
+            any(x1 < x0 for (x0,x1) in zip(x_layers[:-1],x_layers[1:])):
+            raise ValueError("The layer sizes must satisfy " + \
+                "0 <= x_layers[0] <= x_layers[1] <= ...")
+        self._x_layers = x_layers
+
+    x_layers = property(_get_x_layers, _set_x_layers)
+
+
+    def _get_eps_layers(self):
+        return self._eps_layers
+
+    def _set_eps_layers(self, eps_layers):
+        self._eps_layers = None if eps_layers is None else \
+            tuple(complex(eps) for eps in eps_layers)
+
+    eps_layers = property(_get_eps_layers, _set_eps_layers)
+
+
+    def _get_m_layers(self):
+        if self.eps_layers is None:
+            return None
+        return tuple(complex(sqrt(eps)) for eps in self.eps_layers)
+
+    def _set_m_layers(self, m_layers):
+        self.mu = 1.0
+        self.eps_layers = [complex(m)**2 for m in m_layers]
+
+    m_layers = property(_get_m_layers, _set_m_layers)
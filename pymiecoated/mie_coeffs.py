@@ -19,8 +19,14 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from numpy import pi, arange, zeros, hstack, sqrt, sin, cos
-from scipy.special import jv, yv
+from numpy import pi, arange, zeros, sqrt, sin, cos, rint
+from numpy import array, asarray, broadcast_arrays, errstate, where, newaxis
+from numpy import floor, log10, iscomplexobj, empty, ones, exp
+from numpy import concatenate, cumprod, float32, complex64
+from time import perf_counter
+from .mie_aux import SharedCache
+from . import mie_backend
+from . import mie_profile
 
 
 class MieCoeffs(object):
@@ -30,9 +36,103 @@ class MieCoeffs(object):
         (self.an, self.bn, self.nmax) = mie_coeffs(par)
 
 
+class MieCoeffsBatch(object):
+    """Wrapper for the Mie coefficients of many particles.
+
+    The coefficients are stored in arrays of shape (N, nmax.max()), with
+    the orders beyond the nmax of each particle padded with zeros. See
+    mie_coeffs_batch for precision.
+    """
+    def __init__(self, par, precision="double"):
+        (self.an, self.bn, self.nmax) = mie_coeffs_batch(par, precision)
+
+
+class CoeffCache(SharedCache):
+    """Process-wide cache of Mie coefficients.
+
+    When enabled with enable_shared_cache, the cache is consulted by
+    mie_coeffs and mie_coeffs_batch, and thus by all Mie instances and the
+    batch functions. It is thread-safe.
+
+    Optionally, the size parameters and permittivities can be quantized to
+    a given number of significant digits so that nearly identical inputs
+    share an entry. The coefficients are then computed at the quantized
+    values, so the results do not depend on the order of the calls.
+
+    Attributes:
+        x_digits: Significant digits kept in x and y (None to disable).
+        eps_digits: Significant digits kept in eps and eps2 (None to
+            disable).
+    """
+    def __init__(self, size=1000, max_bytes=None, x_digits=None,
+        eps_digits=None):
+        super(CoeffCache, self).__init__(size=size, max_bytes=max_bytes)
+        self.x_digits = x_digits
+        self.eps_digits = eps_digits
+
+    def quantize(self, eps, mu, x, y, eps2):
+        return (_quantize(eps,self.eps_digits), mu,
+            _quantize(x,self.x_digits), _quantize(y,self.x_digits),
+            _quantize(eps2,self.eps_digits))
+
+    def quantize_layers(self, eps, x):
+        return (_quantize(asarray(eps), self.eps_digits),
+            _quantize(asarray(x), self.x_digits))
+
+    def _sizeof(self, coeffs):
+        return coeffs[0].nbytes + coeffs[1].nbytes
+
+
+def _quantize(v, digits):
+    """Round v to the given number of significant digits.
+
+    For complex v, both parts are rounded with the same step, determined
+    by abs(v).
+    """
+    if digits is None:
+        return v
+    a = abs(asarray(v))
+    scale = 10.0**(digits - 1 - floor(log10(where(a>0, a, 1.0))))
+    if iscomplexobj(v):
+        q = rint(v.real*scale)/scale + complex(0,1)*rint(v.imag*scale)/scale
+    else:
+        q = rint(v*scale)/scale
+    return q if q.ndim else q.item()
+
+
+shared_cache = None
+
+
+def enable_shared_cache(size=1000, max_bytes=None, x_digits=None,
+    eps_digits=None):
+    """Enable the process-wide coefficient cache.
+
+    Args:
+        size: The maximum number of cached particles.
+        max_bytes: The maximum total size of the cached coefficients.
+        x_digits, eps_digits: Quantization of the inputs, see CoeffCache.
+
+    Returns:
+        The new CoeffCache instance.
+    """
+    global shared_cache
+    shared_cache = CoeffCache(size=size, max_bytes=max_bytes,
+        x_digits=x_digits, eps_digits=eps_digits)
+    return shared_cache
+
+
+def disable_shared_cache():
+    """Disable the process-wide coefficient cache.
+    """
+    global shared_cache
+    shared_cache = None
+
+
 def mie_coeffs(params):
     """Input validation and function selection for the Mie coefficients.
     """
+    if params.get("x_layers") is not None:
+        return _layered_mie_coeffs(params)
 
     eps = complex(params["eps"]) if params["eps"] is not None else None
     x = float(params["x"]) if params["x"] is not None else None
@@ -57,6 +157,18 @@ def mie_coeffs(params):
         y = x
         eps2 = eps
 
+    cache = shared_cache
+    if cache is not None:
+        key = cache.quantize(eps,mu,x,y,eps2)
+        coeffs = cache.get(key)
+        prof = mie_profile.active
+        if prof is not None:
+            prof.count("shared_cache.miss" if coeffs is None else
+                "shared_cache.hit")
+        if coeffs is not None:
+            return coeffs
+        (eps,mu,x,y,eps2) = key
+
     # Do not use the coated version if it is not necessary
     if x==y or eps==eps2:
         coeffs = single_mie_coeff(eps,mu,y)
@@ -65,6 +177,66 @@ def mie_coeffs(params):
     else:
         coeffs = coated_mie_coeff(eps,eps2,x,y)
 
+    if cache is not None:
+        cache[key] = coeffs
+
+    return coeffs
+
+
+def _layered_mie_coeffs(params):
+    """Input validation and function selection for multilayered spheres.
+    """
+    for k in ("eps","x","y","eps2"):
+        if params.get(k) is not None:
+            raise ValueError("Cannot specify both x_layers and " + k + ".")
+    mu = params.get("mu")
+    if (mu is not None) and complex(mu)!=complex(1.0):
+        raise ValueError("Multilayer calculations for magnetic particles " + \
+            "are not currently supported.")
+    x = [float(xl) for xl in params["x_layers"]]
+    eps = params.get("eps_layers")
+    if (eps is None) or (len(eps) != len(x)) or (len(x) == 0):
+        raise ValueError("Must specify eps_layers or m_layers for each " + \
+            "layer.")
+    eps = [complex(e) for e in eps]
+    if (x[0] < 0) or any(x1 < x0 for (x0,x1) in zip(x[:-1],x[1:])):
+        raise ValueError("The layer sizes must satisfy " + \
+            "0 <= x_layers[0] <= x_layers[1] <= ...")
+
+    cache = shared_cache
+    if cache is not None:
+        (eps, x) = cache.quantize_layers(eps, x)
+        key = (tuple(eps.tolist()), tuple(x.tolist()))
+        coeffs = cache.get(key)
+        prof = mie_profile.active
+        if prof is not None:
+            prof.count("shared_cache.miss" if coeffs is None else
+                "shared_cache.hit")
+        if coeffs is not None:
+            return coeffs
+        (eps, x) = key
+
+    # Drop layers of zero thickness and merge layers of the same material
+    (eps_m, x_m) = ([], [])
+    for (e, xl) in zip(eps, x):
+        if xl == (x_m[-1] if x_m else 0.0):
+            continue
+        if eps_m and (e == eps_m[-1]):
+            x_m[-1] = xl
+        else:
+            eps_m.append(e)
+            x_m.append(xl)
+
+    if not eps_m:
+        coeffs = single_mie_coeff(eps[-1],complex(1.0),x[-1])
+    elif len(eps_m) == 1:
+        coeffs = single_mie_coeff(eps_m[0],complex(1.0),x_m[-1])
+    else:
+        coeffs = multilayer_mie_coeff(eps_m,x_m)
+
+    if cache is not None:
+        cache[key] = coeffs
+
     return coeffs
 
 
@@ -84,34 +256,421 @@ def single_mie_coeff(eps,mu,x):
     m = sqrt(eps/mu)
 
     nmax = int(round(2+x+4*x**(1.0/3.0)))
-    nmax1 = nmax-1
-    nmx = int(round(max(nmax,abs(z))+16))
     n = arange(nmax)
-    nu = n+1.5
 
-    sx = sqrt(0.5*pi*x)
-    px = sx*jv(nu,x)
-    p1x = hstack((sin(x), px[:nmax1]))
-    chx = -sx*yv(nu,x)
-    ch1x = hstack((cos(x), chx[:nmax1]))
-    gsx = px-complex(0,1)*chx
-    gs1x = p1x-complex(0,1)*ch1x
+    prof = mie_profile.active
+    if prof is not None:
+        prof.observe("nmax", nmax)
+        prof.observe("nmx", _start_order(nmax,abs(z)))
+        t = perf_counter()
 
-    dnx = zeros(nmx,dtype=complex)
-    for j in range(nmx-1,0,-1):
-        r = (j+1.0)/z
-        dnx[j-1] = r - 1.0/(dnx[j]+r)
-    dn = dnx[:nmax]
+    # with the term cache, the functions of x are reused when only eps
+    # changes
+    (psi,gs) = _get_terms("riccati_bessel",x,nmax)
+    (px,p1x) = (psi[1:],psi[:-1])
+    (gsx,gs1x) = (gs[1:],gs[:-1])
+    if prof is not None:
+        t = prof.lap("single_mie_coeff.bessel", t)
+
+    (dn,) = _get_terms("log_derivative",z,nmax)
+    if prof is not None:
+        t = prof.lap("single_mie_coeff.log_derivative", t)
     n1 = n+1
     da = dn/m + n1/x
     db = dn*m + n1/x
 
     an = (da*px-p1x)/(da*gsx-gs1x)
     bn = (db*px-p1x)/(db*gsx-gs1x)
+    if prof is not None:
+        prof.lap("single_mie_coeff.coefficients", t)
 
     return (an, bn, nmax)
 
 
+def log_derivative(z,nmax,nmx):
+    """The logarithmic derivative of the Riccati-Bessel function psi_n.
+
+    D_n(z) = psi_n'(z)/psi_n(z) is computed with the downward recurrence
+    D_(n-1) = n/z - 1/(D_n + n/z) starting from D_nmx = 0. If z is an array,
+    the recurrence is run simultaneously for all its elements; small arrays
+    are handled element-wise in a single pass over n, which avoids the
+    per-step overhead of NumPy for a few arguments.
+
+    Args:
+        z: The complex argument, a scalar or an array.
+        nmax: The number of orders to return.
+        nmx: The order where the recurrence is started (nmx > nmax).
+
+    Returns:
+        An array of shape z.shape+(nmax,) containing D_n(z) for
+        n = 1...nmax. It is in single precision if z is.
+    """
+    return mie_backend.active.log_derivative(z,nmax,nmx)
+
+
+def _log_derivative_numpy(z,nmax,nmx):
+    """The NumPy kernel of log_derivative.
+    """
+    z = _as_complex(z)
+    if z.size <= _LOOP_SIZE:
+        zl = [complex(zz) for zz in z.ravel()]
+        dnx = [[0j]*nmx for zz in zl]
+        for j in range(nmx-1,0,-1):
+            j1 = j+1.0
+            for (zz,dx) in zip(zl,dnx):
+                r = j1/zz
+                dx[j-1] = r - 1.0/(dx[j]+r)
+        return array([dx[:nmax] for dx in dnx],
+            dtype=z.dtype).reshape(z.shape+(nmax,))
+
+    dn = zeros(z.shape+(nmax,),dtype=z.dtype)
+    dnj = zeros(z.shape,dtype=z.dtype)
+    for j in range(nmx-1,0,-1):
+        r = (j+1.0)/z
+        dnj = r - 1.0/(dnj+r)
+        if j <= nmax:
+            dn[...,j-1] = dnj
+    return dn
+
+
+# Arguments of log_derivative and riccati_bessel up to this size are
+# computed without NumPy
+_LOOP_SIZE = 16
+
+
+def _as_complex(z):
+    """z as a complex array, keeping single precision (complex64) if z is
+    in single precision.
+    """
+    z = asarray(z)
+    single = z.dtype in (float32, complex64)
+    return z.astype(complex64 if single else complex, copy=False)
+
+
+def _start_order(nmax,za):
+    """The starting order of the downward recurrences.
+
+    The error of the starting value only decays once the order exceeds
+    |z|, over a transition region whose width grows as |z|**(1/3); starting
+    at max(nmax,|z|)+16 alone is inaccurate for large size parameters.
+    """
+    return int(max(nmax,za)+16+8*za**(1.0/3.0))
+
+
+def riccati_bessel(z,nmax):
+    """The Riccati-Bessel functions psi_n(z) = z*j_n(z) and chi_n(z) = -z*y_n(z).
+
+    psi_n is computed with Miller's downward recurrence, normalized with
+    psi_0 = sin(z) or psi_1 = sin(z)/z-cos(z), whichever is larger. For
+    real z, chi_n is computed with the upward recurrence from
+    chi_0 = cos(z) and chi_1 = cos(z)/z+sin(z). For complex z the upward
+    recurrence of chi_n is unstable, so it is instead run for
+    zeta_n = psi_n -+ i*chi_n (the Riccati-Hankel function that decays
+    away from the real axis, chosen by the sign of Im(z)) and chi_n is
+    recovered from zeta_n and psi_n. If z is an array, the recurrences are
+    run simultaneously for all its elements.
+
+    Args:
+        z: The argument, a real or complex scalar or array.
+        nmax: The maximum order.
+
+    Returns:
+        A tuple (psi, chi) of arrays of shape z.shape+(nmax+1,) containing
+        the functions for n = 0...nmax. The arrays are real if z is real,
+        and in single precision if z is.
+    """
+    return mie_backend.active.riccati_bessel(z,nmax)
+
+
+def _riccati_bessel_numpy(z,nmax):
+    """The NumPy kernel of riccati_bessel.
+    """
+    z = asarray(z)
+    if iscomplexobj(z):
+        z = _as_complex(z)
+    else:
+        z = z.astype(float32 if z.dtype==float32 else float, copy=False)
+    dtype = z.dtype
+    if z.size <= _LOOP_SIZE:
+        # the loop is run with Python floats, so normalize in double
+        # precision before converting to the precision of z
+        z = z.astype(complex if iscomplexobj(z) else float)
+    rescale = _RESCALE if z.real.dtype==float else _RESCALE_SINGLE
+    nm = max(nmax,1)
+    za = abs(z).max() if z.size else 0.0
+    nmx = _start_order(nm,za)
+
+    if z.size <= _LOOP_SIZE:
+        zl = z.ravel().tolist()
+        psi = []
+        chi = []
+        for zz in zl:
+            p = [0.0]*(nm+1)
+            (pn, pn1) = (1.0, 0.0)
+            for n in range(nmx,0,-1):
+                (pn, pn1) = ((2*n+1)/zz*pn - pn1, pn)
+                if n <= nm+1:
+                    p[n-1] = pn
+                if abs(pn) > _RESCALE:
+                    pn /= _RESCALE
+                    pn1 /= _RESCALE
+                    p = [pp/_RESCALE for pp in p]
+            psi.append(p)
+            c = [0.0]*(nm+1)
+            (c[0], c[1]) = _riccati_start(zz)
+            for n in range(1,nm):
+                c[n+1] = (2*n+1)/zz*c[n] - c[n-1]
+            chi.append(c)
+        psi = array(psi, dtype=z.dtype).reshape(z.shape+(nm+1,))
+        chi = array(chi, dtype=z.dtype).reshape(z.shape+(nm+1,))
+    else:
+        psi = empty(z.shape+(nm+1,), dtype=z.dtype)
+        (pn, pn1) = (ones(z.shape, dtype=z.dtype), zeros(z.shape, dtype=z.dtype))
+        for n in range(nmx,0,-1):
+            (pn, pn1) = ((2*n+1)/z*pn - pn1, pn)
+            if n <= nm+1:
+                psi[...,n-1] = pn
+            big = abs(pn) > rescale
+            if big.any():
+                scale = where(big, 1.0/rescale, 1.0).astype(z.real.dtype)
+                pn *= scale
+                pn1 *= scale
+                if n <= nm+1:
+                    psi[...,n-1:] *= scale[...,newaxis]
+        chi = empty(z.shape+(nm+1,), dtype=z.dtype)
+        (chi[...,0], chi[...,1]) = _riccati_start(z)
+        for n in range(1,nm):
+            chi[...,n+1] = (2*n+1)/z*chi[...,n] - chi[...,n-1]
+
+    s0 = sin(z)
+    s1 = s0/z - cos(z)
+    with errstate(divide="ignore", invalid="ignore"):
+        norm = where(abs(s0) >= abs(s1), s0/psi[...,0], s1/psi[...,1])
+    psi *= norm[...,newaxis]
+    if iscomplexobj(z):
+        # chi holds zeta_n here
+        sign = where(z.imag >= 0, 1.0, -1.0).astype(z.real.dtype)
+        chi = complex(0,1)*sign[...,newaxis]*(chi-psi)
+
+    return (psi[...,:nmax+1].astype(dtype, copy=False),
+        chi[...,:nmax+1].astype(dtype, copy=False))
+
+
+def _riccati_start(z):
+    """The starting values for the upward recurrence in riccati_bessel.
+
+    Returns chi_0 and chi_1 for real z, and zeta_0 and zeta_1 for complex z.
+    """
+    if not iscomplexobj(z):
+        c = cos(z)
+        return (c, c/z + sin(z))
+    sign = where(asarray(z).imag >= 0, 1.0, -1.0)
+    # zeta_0 = sin(z) -+ i*cos(z), computed without cancellation
+    e = exp(complex(0,1)*sign*z)
+    zeta0 = complex(0,-1)*sign*e
+    return (zeta0, zeta0/z - e)
+
+
+# Rescaling threshold for the downward recurrence in riccati_bessel, in
+# double and single precision
+_RESCALE = 1e150
+_RESCALE_SINGLE = 1e18
+
+
+def riccati_bessel_scipy(z,nmax):
+    """Reference implementation of riccati_bessel using scipy.special.
+
+    This is slower than riccati_bessel and requires SciPy; it is intended
+    for cross-checking the recurrences.
+    """
+    from scipy.special import jv, yv
+    z = asarray(z)[...,newaxis]
+    nu = arange(nmax+1)+0.5
+    sz = sqrt(0.5*pi*z)
+    return (sz*jv(nu,z), -sz*yv(nu,z))
+
+
+def _psi_ratio(z,dn):
+    """The ratios psi_n(z)/psi_(n-1)(z) = n/z - D_(n-1)(z) for n = 1...nmax.
+
+    Args:
+        z: The argument, a scalar or array.
+        dn: D_n(z) for n = 1...nmax as returned by log_derivative.
+
+    Returns:
+        An array with the shape of dn.
+    """
+    z = _as_complex(z)[...,newaxis]
+    n = arange(1,dn.shape[-1]+1,dtype=z.real.dtype)
+    d0 = 1.0/z - 1.0/(dn[...,:1]+1.0/z)
+    return n/z - concatenate((d0,dn[...,:-1]), axis=-1)
+
+
+def _psi_zeta(z,a):
+    """The products psi_n(z)*zeta_n(z) for n = 1...nmax.
+
+    zeta_n is the Riccati-Hankel function that decays away from the real
+    axis (see riccati_bessel). Unlike the functions themselves, the product
+    stays bounded for large |Im(z)|. It is computed with the upward
+    recurrence psi_n*zeta_n = a_n*(a_n*psi_(n-1)*zeta_(n-1) -+ i) from
+    psi_0*zeta_0 = (1-exp(+-2iz))/2 (Yang, Appl. Opt. 42, 1710, 2003).
+
+    Args:
+        z: The argument, a scalar or array.
+        a: The ratios psi_n/psi_(n-1) from _psi_ratio.
+
+    Returns:
+        An array with the shape of a.
+    """
+    return mie_backend.active.psi_zeta(z,a)
+
+
+def _psi_zeta_numpy(z,a):
+    """The NumPy kernel of _psi_zeta.
+    """
+    z = _as_complex(z)
+    isg = where(z.imag >= 0, complex(0,1), complex(0,-1)).astype(z.dtype)
+    p = 0.5*(1-exp(2*isg*z))
+    nmax = a.shape[-1]
+    if z.size <= _LOOP_SIZE:
+        pz = []
+        for (pp, ii, aa) in zip(p.ravel().tolist(), isg.ravel().tolist(),
+            a.reshape(-1,nmax).tolist()):
+            row = []
+            for an in aa:
+                pp = an*(an*pp-ii)
+                row.append(pp)
+            pz.append(row)
+        return array(pz, dtype=a.dtype).reshape(a.shape)
+
+    pz = empty(a.shape, dtype=a.dtype)
+    for n in range(nmax):
+        p = a[...,n]*(a[...,n]*p-isg)
+        pz[...,n] = p
+    return pz
+
+
+def _core_ratio(v,w,av,aw):
+    """The squared ratios (psi_n(v)/psi_n(w))**2 for n = 1...nmax.
+
+    The ratio is accumulated from the ratios av and aw of _psi_ratio,
+    starting from sin(v)/sin(w) evaluated without overflow; it underflows
+    harmlessly to zero when the layer between v and w is opaque.
+    """
+    v = _as_complex(v)
+    w = _as_complex(w)
+    isg = where(v.imag >= 0, complex(0,1), complex(0,-1)).astype(v.dtype)
+    rho0 = exp(isg*(w-v))*(1-exp(2*isg*v))/(1-exp(2*isg*w))
+    return (rho0[...,newaxis]*cumprod(av/aw, axis=-1))**2
+
+
+mie_backend.register_kernels("numpy", log_derivative=_log_derivative_numpy,
+    riccati_bessel=_riccati_bessel_numpy, psi_zeta=_psi_zeta_numpy)
+
+class TermCache(SharedCache):
+    """LRU cache of the order-dependent terms of single arguments.
+
+    When enabled with enable_term_cache, single_mie_coeff and
+    coated_mie_coeff get the terms of each of their arguments from the
+    cache, so that only the terms of the arguments that changed are
+    recomputed: in a sweep over the shell of a coated sphere
+    (y, eps2) the terms of the core argument are reused, and in a sweep
+    over eps the Riccati-Bessel functions of x. The kinds of terms are:
+
+    "log_derivative": (D_n(z),) for n = 1...nmax, see log_derivative.
+    "psi_zeta": (psi_n/psi_(n-1), psi_n*zeta_n) for n = 1...nmax, see
+        _psi_ratio and _psi_zeta.
+    "riccati_bessel": (psi_n, psi_n-i*chi_n) for n = 0...nmax, see
+        riccati_bessel.
+
+    Terms computed up to some nmax are sliced when a smaller nmax is
+    requested, and recomputed (with some headroom) for a larger one. The
+    downward recurrences then start from a higher order, which changes the
+    results only at the level of rounding errors.
+
+    The cache is cleared when the backend is changed with
+    mie_backend.set_backend.
+    """
+    def __init__(self, size=64, max_bytes=2**26):
+        super(TermCache, self).__init__(size=size, max_bytes=max_bytes)
+
+    def get_terms(self, kind, z, nmax):
+        """The terms of the given kind for the scalar argument z.
+
+        Returns:
+            A tuple of arrays. They are views of the cached arrays and must
+            not be modified.
+        """
+        key = (kind, z)
+        entry = self.get(key)
+        prof = mie_profile.active
+        if prof is not None:
+            prof.count("term_cache.hit" if (entry is not None) and
+                (entry[0] >= nmax) else "term_cache.miss")
+        if (entry is None) or (entry[0] < nmax):
+            nmax_terms = nmax if entry is None else \
+                max(nmax, int(1.5*entry[0]))
+            entry = (nmax_terms, _TERM_FUNCS[kind](z, nmax_terms))
+            self[key] = entry
+        (nmax_terms, terms) = entry
+        return tuple(t[:len(t)-nmax_terms+nmax] for t in terms)
+
+    def _sizeof(self, entry):
+        return sum(t.nbytes for t in entry[1])
+
+
+def _log_derivative_terms(z, nmax):
+    return (log_derivative(z,nmax,_start_order(nmax,abs(z))),)
+
+
+def _psi_zeta_terms(z, nmax):
+    (dn,) = _get_terms("log_derivative",z,nmax)
+    a = _psi_ratio(z,dn)
+    return (a, _psi_zeta(z,a))
+
+
+def _riccati_bessel_terms(x, nmax):
+    (psi,chi) = riccati_bessel(x,nmax)
+    return (psi, psi-complex(0,1)*chi)
+
+
+_TERM_FUNCS = {"log_derivative":_log_derivative_terms,
+    "psi_zeta":_psi_zeta_terms, "riccati_bessel":_riccati_bessel_terms}
+
+term_cache = None
+
+
+def enable_term_cache(size=64, max_bytes=2**26):
+    """Enable the process-wide cache of the terms of single arguments.
+
+    Args:
+        size: The maximum number of cached arguments.
+        max_bytes: The maximum total size of the cached terms.
+
+    Returns:
+        The new TermCache instance.
+    """
+    global term_cache
+    term_cache = TermCache(size=size, max_bytes=max_bytes)
+    return term_cache
+
+
+def disable_term_cache():
+    """Disable the process-wide cache of the terms of single arguments.
+    """
+    global term_cache
+    term_cache = None
+
+
+def _get_terms(kind, z, nmax):
+    """The terms of the given kind for z, from term_cache if it is enabled.
+    """
+    cache = term_cache
+    if cache is None:
+        return _TERM_FUNCS[kind](z, nmax)
+    return cache.get_terms(kind, z, nmax)
+
+
 def coated_mie_coeff(eps1,eps2,x,y):
     """Mie coefficients for the dual-layered (coated) sphere.
 
@@ -133,44 +692,53 @@ def coated_mie_coeff(eps1,eps2,x,y):
     w = m2*y
 
     nmax = int(round(2+y+4*y**(1.0/3.0)))
-    mx = max(abs(m1*y),abs(w))
-    nmx = int(round(max(nmax,mx)+16))
-    nmax1 = nmax-1
     n = arange(nmax)
 
-    dnu = zeros(nmax,dtype=complex)
-    dnv = zeros(nmax,dtype=complex)
-    dnw = zeros(nmax,dtype=complex)
-    dnx = zeros(nmx,dtype=complex)
+    nmx = _start_order(nmax,max(abs(u),abs(v),abs(w)))
+    cache = term_cache
 
-    for (z, dn) in zip((u,v,w),(dnu,dnv,dnw)):
-        for j in range(nmx-1,0,-1):
-            r = (j+1.0)/z
-            dnx[j-1] = r - 1.0/(dnx[j]+r)
-        dn[:] = dnx[:nmax]
-
-    nu = n+1.5
-    vwy = [v,w,y]
-    sx = [sqrt(0.5*pi*xx) for xx in vwy]
-    (pv,pw,py) = [s*jv(nu,xx) for (s,xx) in zip(sx,vwy)]
-    (chv,chw,chy) = [-s*yv(nu,xx) for (s,xx) in zip(sx,vwy)]
-    p1y = hstack((sin(y), py[:nmax1]))
-    ch1y = hstack((cos(y), chy[:nmax1]))
-    gsy = py-complex(0,1)*chy
-    gs1y = p1y-complex(0,1)*ch1y
+    prof = mie_profile.active
+    if prof is not None:
+        prof.observe("nmax", nmax)
+        prof.observe("nmx", nmx)
+        t = perf_counter()
+
+    # With the term cache, the terms of each argument are cached separately,
+    # so that e.g. only those of w and y are computed when the shell is
+    # grown around a fixed core; without it, the log derivatives of all
+    # three arguments are computed in a single pass
+    if cache is None:
+        (dnu,dnv,dnw) = log_derivative((u,v,w),nmax,nmx)
+    else:
+        (dnu,) = cache.get_terms("log_derivative",u,nmax)
+        (dnv,) = cache.get_terms("log_derivative",v,nmax)
+        (dnw,) = cache.get_terms("log_derivative",w,nmax)
+    if prof is not None:
+        t = prof.lap("coated_mie_coeff.log_derivative", t)
 
+    # psi_n(v) and psi_n(w) only enter through ratios and products with
+    # zeta_n, which stay finite for thick absorbing shells
+    if cache is None:
+        (psi,chi) = riccati_bessel(y,nmax)
+        gs = psi-complex(0,1)*chi
+        a = _psi_ratio((v,w),asarray((dnv,dnw)))
+        ((av,aw),(pzv,pzw)) = (a, _psi_zeta((v,w),a))
+    else:
+        (psi,gs) = cache.get_terms("riccati_bessel",y,nmax)
+        (av,pzv) = cache.get_terms("psi_zeta",v,nmax)
+        (aw,pzw) = cache.get_terms("psi_zeta",w,nmax)
+    (py,p1y) = (psi[1:],psi[:-1])
+    (gsy,gs1y) = (gs[1:],gs[:-1])
+    rho2 = _core_ratio(v,w,av,aw)
+    if prof is not None:
+        t = prof.lap("coated_mie_coeff.bessel", t)
+
+    isg = complex(0,1) if v.imag >= 0 else complex(0,-1)
+    q = isg*(pzv-rho2*pzw)
     uu = m*dnu-dnv
     vv = dnu/m-dnv
-    fv = pv/chv
-    fw = pw/chw
-    ku1 = uu*fv/pw
-    kv1 = vv*fv/pw
-    pt = pw-chw*fv
-    prat = pw/pv/chv
-    ku2 = uu*pt+prat
-    kv2 = vv*pt+prat
-    dns1 = ku1/ku2
-    gns1 = kv1/kv2
+    dns1 = uu*rho2/(1+uu*q)
+    gns1 = vv*rho2/(1+vv*q)
 
     dns = dns1+dnw
     gns = gns1+dnw
@@ -179,5 +747,850 @@ def coated_mie_coeff(eps1,eps2,x,y):
     b1 = m2*gns+nrat
     an = (py*a1-p1y)/(gsy*a1-gs1y)
     bn = (py*b1-p1y)/(gsy*b1-gs1y)
+    if prof is not None:
+        prof.lap("coated_mie_coeff.coefficients", t)
+
+    return (an, bn, nmax)
+
 
+def multilayer_mie_coeff(eps,x):
+    """Mie coefficients for the multilayered sphere.
+
+    The layers are added one at a time with the recursive algorithm of
+    Yang (Appl. Opt. 42, 1710, 2003), so the cost grows linearly with the
+    number of layers. For two layers the result is the same as that of
+    coated_mie_coeff.
+
+       Args:
+          eps: The complex relative permittivities of the layers, from the
+              core outward.
+          x: The size parameters of the outer boundaries of the layers;
+              x[0] is that of the core and x[-1] that of the particle.
+              Must be positive and increasing.
+
+       Returns:
+          A tuple containing (an, bn, nmax) where an and bn are the Mie
+          coefficients and nmax is the maximum number of coefficients.
+    """
+    m = sqrt(asarray(eps, dtype=complex))
+    x = asarray(x, dtype=float)
+    y = x[-1]
+    nmax = int(round(2+y+4*y**(1.0/3.0)))
+
+    prof = mie_profile.active
+    if prof is not None:
+        prof.observe("nmax", nmax)
+
+    (an, bn) = _layered_coeffs(m,x,nmax,stage="multilayer_mie_coeff")
     return (an, bn, nmax)
+
+
+def _layered_coeffs(m,x,nmax,stage=None):
+    """The Mie coefficients of layered spheres.
+
+    Args:
+        m: The complex refractive indices of the layers, an array of shape
+            (L,)+S for L layers and particles of shape S.
+        x: The size parameters of the layers, with the same shape as m.
+            Layers with x == 0 are ignored; the outermost layer must have
+            x > 0.
+        nmax: The number of coefficients.
+        stage: If given, the steps are recorded in the active profiler with
+            this prefix.
+
+    Returns:
+        A tuple (an, bn) of arrays of shape S+(nmax,).
+    """
+    L = len(m)
+    zero = (x == 0)
+    x = where(zero, 1.0, x)
+    prof = mie_profile.active if stage is not None else None
+    if prof is not None:
+        t = perf_counter()
+
+    # all arguments are computed together: m_l*x_l for l = 1...L and
+    # m_l*x_(l-1) for l = 2...L
+    z = concatenate((m*x, m[1:]*x[:-1]))
+    nmx = _start_order(nmax,abs(z).max())
+    dn = log_derivative(z,nmax,nmx)
+    if prof is not None:
+        prof.observe("nmx", nmx)
+        t = prof.lap(stage+".log_derivative", t)
+
+    (psi,chi) = riccati_bessel(x[-1],nmax)
+    (py,p1y) = (psi[...,1:],psi[...,:-1])
+    gs = psi-complex(0,1)*chi
+    (gsy,gs1y) = (gs[...,1:],gs[...,:-1])
+    a = _psi_ratio(z,dn)
+    pz = _psi_zeta(z,a)
+    rho2 = _core_ratio(z[L:],z[1:L],a[L:],a[1:L])
+    if prof is not None:
+        t = prof.lap(stage+".bessel", t)
+
+    isg = where(z[L:].imag >= 0, complex(0,1),
+        complex(0,-1)).astype(z.dtype)[...,newaxis]
+    q = isg*(pz[L:]-rho2*pz[1:L])
+    ha = hb = dn[0]
+    for l in range(1,L):
+        # Yang's recurrence, written like the core terms of coated_mie_coeff
+        mrel = (m[l]/m[l-1])[...,newaxis]
+        d1 = dn[L+l-1]
+        ga = mrel*ha-d1
+        gb = hb/mrel-d1
+        core = zero[l-1][...,newaxis]
+        ha = where(core, dn[l], dn[l]+rho2[l-1]*ga/(1+ga*q[l-1]))
+        hb = where(core, dn[l], dn[l]+rho2[l-1]*gb/(1+gb*q[l-1]))
+
+    ml = m[-1][...,newaxis]
+    nrat = arange(1,nmax+1,dtype=x.dtype)/x[-1][...,newaxis]
+    a1 = ha/ml+nrat
+    b1 = ml*hb+nrat
+    an = (py*a1-p1y)/(gsy*a1-gs1y)
+    bn = (py*b1-p1y)/(gsy*b1-gs1y)
+    if prof is not None:
+        prof.lap(stage+".coefficients", t)
+
+    return (an, bn)
+
+
+def mie_coeffs_batch(params, precision="double"):
+    """Input validation and function selection for the batch Mie coefficients.
+
+    The parameters are as in mie_coeffs but given as arrays (or scalars
+    that are broadcast against the arrays). Particles for which the coated
+    version is not necessary are computed with the single-layer version.
+
+    With precision="single", the coefficients are returned in single
+    precision (complex64), and those of homogeneous spheres that are
+    neither very small nor large and weakly absorbing are also computed in
+    single precision, which halves the memory traffic; the other particles
+    (see _SINGLE_MIN_SIZE) are computed in double precision and converted.
+    The errors of qext, qsca and qb computed from the coefficients with
+    mie_props are then below 1e-4*qext, and those of asy below 1e-4;
+    qabs of weakly absorbing particles, the difference of the nearly equal
+    qext and qsca, loses relative accuracy accordingly. With the shared
+    cache enabled, all particles are computed in double precision, as the
+    cached coefficients are shared with other callers.
+    """
+    dtype = _precision_dtype(precision)
+    if params.get("x_layers") is not None:
+        return _layered_mie_coeffs_batch(params, dtype)
+    if (params.get("x") is None) or (params.get("eps") is None):
+        raise ValueError("Must specify x and either eps or m.")
+    mu = params.get("mu")
+    y = params.get("y")
+    eps2 = params.get("eps2")
+    coated = (y is not None)
+    if coated == (eps2 is None):
+        raise ValueError("Must specify both y and m2 for coated particles.")
+
+    (eps, mu, x) = broadcast_arrays(
+        asarray(params["eps"], dtype=complex),
+        asarray(1.0 if mu is None else mu, dtype=complex),
+        asarray(params["x"], dtype=float))
+    if coated:
+        (eps, mu, x, y, eps2) = broadcast_arrays(eps, mu, x,
+            asarray(y, dtype=float), asarray(eps2, dtype=complex))
+        if (mu != 1.0).any():
+            raise ValueError("Multilayer calculations for magnetic " + \
+                "particles are not currently supported.")
+    else:
+        (y, eps2) = (x, eps)
+    (eps, mu, x, y, eps2) = [a.ravel() for a in (eps, mu, x, y, eps2)]
+
+    if (x < 0).any() or (y < x).any():
+        raise ValueError("The sizes must satisfy 0 <= x <= y.")
+
+    cache = shared_cache
+    if cache is None:
+        safe = _single_precision_safe(eps, mu, x, y, eps2)
+        return _mixed_precision(dtype, y, safe, lambda ind, dt:
+            _mie_coeffs_batch(eps[ind], mu[ind], x[ind], y[ind], eps2[ind],
+            dt))
+
+    (eps, mu, x, y, eps2) = cache.quantize(eps, mu, x, y, eps2)
+    keys = list(zip(*[a.tolist() for a in (eps, mu, x, y, eps2)]))
+    (an, bn, nmax) = _cached_coeffs_batch(cache, keys,
+        lambda ind: _mie_coeffs_batch(eps[ind], mu[ind], x[ind], y[ind],
+        eps2[ind]))
+    return (an.astype(dtype, copy=False), bn.astype(dtype, copy=False), nmax)
+
+
+def _precision_dtype(precision):
+    """The complex type for the precision "double" or "single".
+    """
+    if precision == "double":
+        return complex
+    elif precision == "single":
+        return complex64
+    raise ValueError("The precision must be \"double\" or \"single\".")
+
+
+# The particles for which mie_coeffs_batch uses single precision when it
+# is requested: homogeneous spheres with outer size parameters of at least
+# _SINGLE_MIN_SIZE and at most _SINGLE_MAX_NMAX coefficients that either
+# are small (|m|*y at most _SINGLE_MAX_MX) or absorb enough (Im(m) at least
+# _SINGLE_MIN_LOSS*Re(m)) that their resonances are broad. The resonances
+# of larger, weakly absorbing spheres are so sharp that the rounding of x
+# and m to single precision alone changes qb by up to 1e-2 of qext, and in
+# the coated formulation the rounding errors are amplified near the zeros
+# of psi_n(m2*y), so coated spheres are always computed in double
+# precision.
+_SINGLE_MIN_SIZE = 1.0
+_SINGLE_MAX_NMAX = 1000
+_SINGLE_MAX_MX = 5.0
+_SINGLE_MIN_LOSS = 0.01
+
+
+def _single_precision_safe(eps, mu, x, y, eps2):
+    """Whether the particles can be computed in single precision, see
+    _SINGLE_MIN_SIZE.
+    """
+    homogeneous = (x==y) | (eps==eps2) | (x==0)
+    m = sqrt(where(x==0, eps2, eps)*mu)
+    return homogeneous & (y >= _SINGLE_MIN_SIZE) & \
+        (_nmax(y) <= _SINGLE_MAX_NMAX) & \
+        ((abs(m)*y <= _SINGLE_MAX_MX) | (m.imag >= _SINGLE_MIN_LOSS*m.real))
+
+
+def _mixed_precision(dtype, y, safe, compute):
+    """Compute the batch coefficients with the complex type dtype.
+
+    For single precision (complex64), only the particles where safe is
+    true are computed in single precision; the others are computed in
+    double precision and converted.
+
+    Args:
+        dtype: complex or complex64.
+        y: The outer size parameters of the particles.
+        safe: A boolean array, see _single_precision_safe.
+        compute: A function that is called with a boolean mask of the
+            particles and the complex type, and returns (an, bn, nmax) for
+            those particles.
+    """
+    if dtype == complex:
+        return compute(slice(None), complex)
+    nmax = _nmax(y)
+    an = zeros((len(y), nmax.max() if len(y) else 0), dtype=dtype)
+    bn = zeros(an.shape, dtype=dtype)
+    for (mask, dt) in ((safe, complex64), (~safe, complex)):
+        if mask.any():
+            (an_b, bn_b, nmax_b) = compute(mask, dt)
+            an[mask,:an_b.shape[1]] = an_b
+            bn[mask,:bn_b.shape[1]] = bn_b
+    return (an, bn, nmax)
+
+
+def _layered_mie_coeffs_batch(params, dtype=complex):
+    """Input validation for the batch coefficients of multilayered spheres.
+
+    x_layers and eps_layers are arrays of shape (..., L) for L layers.
+    """
+    for k in ("eps","x","y","eps2"):
+        if params.get(k) is not None:
+            raise ValueError("Cannot specify both x_layers and " + k + ".")
+    mu = params.get("mu")
+    if (mu is not None) and (asarray(mu) != 1.0).any():
+        raise ValueError("Multilayer calculations for magnetic " + \
+            "particles are not currently supported.")
+    if params.get("eps_layers") is None:
+        raise ValueError("Must specify eps_layers or m_layers for each " + \
+            "layer.")
+    (x, eps) = broadcast_arrays(asarray(params["x_layers"], dtype=float),
+        asarray(params["eps_layers"], dtype=complex))
+    if x.ndim == 0:
+        raise ValueError("Must specify eps_layers or m_layers for each " + \
+            "layer.")
+    x = x.reshape(-1, x.shape[-1])
+    eps = eps.reshape(x.shape)
+    if (x[:,0] < 0).any() or (x[:,1:] < x[:,:-1]).any():
+        raise ValueError("The layer sizes must satisfy " + \
+            "0 <= x_layers[...,0] <= x_layers[...,1] <= ...")
+
+    cache = shared_cache
+    if cache is None:
+        (an, bn, nmax) = multilayer_mie_coeff_batch(eps, x)
+    else:
+        (eps, x) = cache.quantize_layers(eps, x)
+        keys = [(tuple(e), tuple(xl)) for (e, xl) in zip(eps.tolist(),
+            x.tolist())]
+        (an, bn, nmax) = _cached_coeffs_batch(cache, keys,
+            lambda ind: multilayer_mie_coeff_batch(eps[ind], x[ind]))
+    # the multilayer recurrence loses too much accuracy in single
+    # precision, so only the result is converted
+    return (an.astype(dtype, copy=False), bn.astype(dtype, copy=False), nmax)
+
+
+def _cached_coeffs_batch(cache, keys, compute):
+    """Look up the batch coefficients in the shared cache.
+
+    Args:
+        cache: The CoeffCache.
+        keys: The cache keys of the particles.
+        compute: A function that computes (an, bn, nmax) for a list of
+            indices of the particles that are not found in the cache.
+    """
+    coeffs = [cache.get(k) for k in keys]
+    missing = {}
+    for (i,(k,c)) in enumerate(zip(keys,coeffs)):
+        if c is None:
+            missing.setdefault(k, i)
+    if missing:
+        ind = list(missing.values())
+        (an, bn, nmax) = compute(ind)
+        for (j,k) in enumerate(missing):
+            nm = int(nmax[j])
+            cache[k] = (an[j,:nm].copy(), bn[j,:nm].copy(), nm)
+        computed = dict((k, cache_entry) for (k, cache_entry) in
+            zip(missing, zip(an, bn, nmax.tolist())))
+        coeffs = [computed[k] if c is None else c
+            for (k,c) in zip(keys,coeffs)]
+
+    nmax = array([c[2] for c in coeffs], dtype=int)
+    an = zeros((len(keys), nmax.max() if len(keys) else 0), dtype=complex)
+    bn = zeros(an.shape, dtype=complex)
+    for (i,c) in enumerate(coeffs):
+        an[i,:c[2]] = c[0][:c[2]]
+        bn[i,:c[2]] = c[1][:c[2]]
+
+    return (an, bn, nmax)
+
+
+def _mie_coeffs_batch(eps, mu, x, y, eps2, dtype=complex):
+    prof = mie_profile.active
+    if prof is not None:
+        t = perf_counter()
+        for nm in _nmax(y).tolist():
+            prof.observe("nmax", nm)
+    # Do not use the coated version if it is not necessary
+    single = (x==y) | (eps==eps2) | (x==0)
+    eps_s = where(x==0, eps2, eps)[single]
+    nmax = _nmax(y)
+    an = zeros((len(x), nmax.max() if len(x) else 0), dtype=dtype)
+    bn = zeros(an.shape, dtype=dtype)
+    for (mask, (an_b, bn_b, nmax_b)) in (
+        (single, single_mie_coeff_batch(eps_s, mu[single], y[single],
+            dtype)),
+        (~single, coated_mie_coeff_batch(eps[~single], eps2[~single],
+            x[~single], y[~single], dtype))):
+        an[mask,:an_b.shape[1]] = an_b
+        bn[mask,:bn_b.shape[1]] = bn_b
+    if prof is not None:
+        prof.lap("mie_coeffs_batch", t)
+
+    return (an, bn, nmax)
+
+
+def _nmax(x):
+    return rint(2+x+4*x**(1.0/3.0)).astype(int)
+
+
+def _real_dtype(dtype):
+    """The real type corresponding to the complex type dtype.
+    """
+    return zeros(0, dtype=dtype).real.dtype
+
+
+def single_mie_coeff_batch(eps,mu,x,dtype=complex):
+    """Mie coefficients for many single-layered spheres at once.
+
+    Args:
+        eps: Array of complex relative permittivities.
+        mu: Array of complex relative permeabilities.
+        x: Array of size parameters.
+        dtype: The complex type used in the computation, complex or
+            complex64 (see mie_coeffs_batch).
+
+    Returns:
+        A tuple containing (an, bn, nmax) where an and bn are arrays of
+        shape (N, nmax.max()), zero-padded beyond the nmax of each particle,
+        and nmax is the array of the numbers of coefficients.
+    """
+    nmax = _nmax(asarray(x, dtype=float))
+    (eps, mu) = (asarray(eps, dtype=dtype), asarray(mu, dtype=dtype))
+    x = asarray(x, dtype=_real_dtype(dtype))
+    N = len(x)
+    if N == 0:
+        return (zeros((0,0),dtype=dtype), zeros((0,0),dtype=dtype), nmax)
+    zero = (x==0)
+    x = where(zero, 1.0, x)
+
+    z = sqrt(eps*mu)*x
+    m = sqrt(eps/mu)
+
+    nm = nmax.max()
+    nmx = _start_order(nm,abs(z).max())
+    n = arange(nm)
+    xc = x[:,newaxis]
+
+    with errstate(all="ignore"):
+        (psi,chi) = riccati_bessel(x,nm)
+        (px,p1x) = (psi[:,1:],psi[:,:-1])
+        gs = psi-complex(0,1)*chi
+        (gsx,gs1x) = (gs[:,1:],gs[:,:-1])
+
+        dn = log_derivative(z,nm,nmx)
+        n1 = arange(1,nm+1,dtype=x.dtype)
+        mc = m[:,newaxis]
+        da = dn/mc + n1/xc
+        db = dn*mc + n1/xc
+
+        an = (da*px-p1x)/(da*gsx-gs1x)
+        bn = (db*px-p1x)/(db*gsx-gs1x)
+
+    valid = (n < nmax[:,newaxis]) & ~zero[:,newaxis]
+    an = where(valid, an, 0.0)
+    bn = where(valid, bn, 0.0)
+
+    return (an, bn, nmax)
+
+
+def coated_mie_coeff_batch(eps1,eps2,x,y,dtype=complex):
+    """Mie coefficients for many dual-layered (coated) spheres at once.
+
+       Args:
+          eps1: Array of complex relative permittivities of the core.
+          eps2: Array of complex relative permittivities of the shell.
+          x: Array of size parameters of the core.
+          y: Array of size parameters of the shell.
+          dtype: The complex type used in the computation, complex or
+              complex64 (see mie_coeffs_batch).
+
+       Returns:
+          A tuple containing (an, bn, nmax) where an and bn are arrays of
+          shape (N, nmax.max()), zero-padded beyond the nmax of each
+          particle, and nmax is the array of the numbers of coefficients.
+    """
+    nmax = _nmax(asarray(y, dtype=float))
+    (eps1, eps2) = (asarray(eps1, dtype=dtype), asarray(eps2, dtype=dtype))
+    (x, y) = (asarray(x, dtype=_real_dtype(dtype)),
+        asarray(y, dtype=_real_dtype(dtype)))
+    N = len(y)
+    if N == 0:
+        return (zeros((0,0),dtype=dtype), zeros((0,0),dtype=dtype), nmax)
+
+    m1 = sqrt(eps1)
+    m2 = sqrt(eps2)
+    m = (m2/m1)[:,newaxis]
+    u = m1*x
+    v = m2*x
+    w = m2*y
+
+    nm = nmax.max()
+    mx = max(abs(m1*y).max(),abs(w).max())
+    nmx = _start_order(nm,mx)
+    n = arange(nm)
+
+    with errstate(all="ignore"):
+        (dnu,dnv,dnw) = log_derivative((u,v,w),nm,nmx)
+
+        (psi,chi) = riccati_bessel(y,nm)
+        (py,p1y) = (psi[:,1:],psi[:,:-1])
+        gs = psi-complex(0,1)*chi
+        (gsy,gs1y) = (gs[:,1:],gs[:,:-1])
+        a = _psi_ratio(asarray([v,w]),asarray([dnv,dnw]))
+        pz = _psi_zeta(asarray([v,w]),a)
+        rho2 = _core_ratio(v,w,a[0],a[1])
+        yc = y[:,newaxis]
+
+        isg = where(v.imag >= 0, complex(0,1),
+            complex(0,-1)).astype(dtype)[:,newaxis]
+        q = isg*(pz[0]-rho2*pz[1])
+        uu = m*dnu-dnv
+        vv = dnu/m-dnv
+        dns1 = uu*rho2/(1+uu*q)
+        gns1 = vv*rho2/(1+vv*q)
+
+        dns = dns1+dnw
+        gns = gns1+dnw
+        nrat = arange(1,nm+1,dtype=y.dtype)/yc
+        m2c = m2[:,newaxis]
+        a1 = dns/m2c+nrat
+        b1 = m2c*gns+nrat
+        an = (py*a1-p1y)/(gsy*a1-gs1y)
+        bn = (py*b1-p1y)/(gsy*b1-gs1y)
+
+    valid = (n < nmax[:,newaxis])
+    an = where(valid, an, 0.0)
+    bn = where(valid, bn, 0.0)
+
+    return (an, bn, nmax)
+
+
+def multilayer_mie_coeff_batch(eps,x,dtype=complex):
+    """Mie coefficients for many multilayered spheres at once.
+
+       Args:
+          eps: Array of shape (N, L) of the complex relative permittivities
+              of the L layers of each particle, from the core outward.
+          x: Array of shape (N, L) of the size parameters of the outer
+              boundaries of the layers. Layers of zero thickness are
+              allowed.
+          dtype: The complex type used in the computation, complex or
+              complex64 (see mie_coeffs_batch).
+
+       Returns:
+          A tuple containing (an, bn, nmax) where an and bn are arrays of
+          shape (N, nmax.max()), zero-padded beyond the nmax of each
+          particle, and nmax is the array of the numbers of coefficients.
+    """
+    nmax = _nmax(asarray(x, dtype=float)[:,-1])
+    eps = asarray(eps, dtype=dtype)
+    x = asarray(x, dtype=_real_dtype(dtype))
+    y = x[:,-1]
+    N = len(x)
+    if N == 0:
+        return (zeros((0,0),dtype=dtype), zeros((0,0),dtype=dtype), nmax)
+
+    nm = nmax.max()
+    n = arange(nm)
+    m = sqrt(eps)
+    with errstate(all="ignore"):
+        (an, bn) = _layered_coeffs(m.T,x.T,nm)
+
+    valid = (n < nmax[:,newaxis]) & (y != 0)[:,newaxis]
+    an = where(valid, an, 0.0)
+    bn = where(valid, bn, 0.0)
+
+    return (an, bn, nmax)
+
+
+class MieCoeffsJac(object):
+    """Wrapper for the Mie coefficients of many particles and their
+    derivatives.
+
+    Attributes:
+        an, bn, nmax: As in MieCoeffsBatch.
+        dan, dbn: The derivatives of an and bn, arrays of shape
+            (P, N, nmax.max()) with one row for each parameter in params.
+        params: The names of the parameters (see mie_coeffs_jac).
+        dy: The derivatives of the outer size parameter with respect to
+            the parameters, an array of length P.
+    """
+    def __init__(self, par):
+        (self.an, self.bn, self.nmax, self.dan, self.dbn, self.params,
+            self.dy) = mie_coeffs_jac(par)
+
+
+def mie_coeffs_jac(params):
+    """The batch Mie coefficients and their derivatives.
+
+    The parameters are given as for mie_coeffs_batch. The derivatives are
+    computed in the same pass as the coefficients by differentiating the
+    recurrences (forward mode), which is more accurate and much faster than
+    finite differences. Multilayered and magnetic spheres are not
+    supported.
+
+    Returns:
+        A tuple (an, bn, nmax, dan, dbn, params, dy); see MieCoeffsJac.
+        The parameters are ("x", "m_real", "m_imag") for homogeneous spheres
+        and ("x", "y", "m_real", "m_imag", "m2_real", "m2_imag") for coated
+        ones, where m = sqrt(eps) and m2 = sqrt(eps2) are the refractive
+        indices.
+    """
+    if params.get("x_layers") is not None:
+        raise ValueError("Derivatives are not supported for multilayered " + \
+            "particles.")
+    if (params.get("x") is None) or (params.get("eps") is None):
+        raise ValueError("Must specify x and either eps or m.")
+    if (params.get("mu") is not None) and \
+        (asarray(params["mu"]) != 1.0).any():
+        raise ValueError("Derivatives are not supported for magnetic " + \
+            "particles.")
+    y = params.get("y")
+    eps2 = params.get("eps2")
+    coated = (y is not None)
+    if coated == (eps2 is None):
+        raise ValueError("Must specify both y and m2 for coated particles.")
+
+    if not coated:
+        (eps, x) = [a.ravel() for a in broadcast_arrays(
+            asarray(params["eps"], dtype=complex),
+            asarray(params["x"], dtype=float))]
+        if (x < 0).any():
+            raise ValueError("The sizes must satisfy 0 <= x <= y.")
+        (an, bn, nmax, dan, dbn) = single_mie_coeff_jac(eps, x)
+        return (an, bn, nmax, _real_directions(dan, 1),
+            _real_directions(dbn, 1), ("x", "m_real", "m_imag"),
+            array([1.0, 0.0, 0.0]))
+
+    (eps, x, y, eps2) = [a.ravel() for a in broadcast_arrays(
+        asarray(params["eps"], dtype=complex),
+        asarray(params["x"], dtype=float), asarray(y, dtype=float),
+        asarray(eps2, dtype=complex))]
+    if (x < 0).any() or (y < x).any():
+        raise ValueError("The sizes must satisfy 0 <= x <= y.")
+    nmax = _nmax(y)
+    nm = nmax.max() if len(y) else 0
+    an = zeros((len(y),nm), dtype=complex)
+    bn = zeros((len(y),nm), dtype=complex)
+    dan = zeros((4,len(y),nm), dtype=complex)
+    dbn = zeros((4,len(y),nm), dtype=complex)
+    core = (x > 0)
+    if core.any():
+        (an_c, bn_c, nmax_c, dan_c, dbn_c) = coated_mie_coeff_jac(eps[core],
+            eps2[core], x[core], y[core])
+        k = an_c.shape[-1]
+        (an[core,:k], bn[core,:k]) = (an_c, bn_c)
+        (dan[:,core,:k], dbn[:,core,:k]) = (dan_c, dbn_c)
+    if not core.all():
+        # without a core the derivatives with respect to x and m vanish
+        (an_s, bn_s, nmax_s, dan_s, dbn_s) = single_mie_coeff_jac(
+            eps2[~core], y[~core])
+        k = an_s.shape[-1]
+        (an[~core,:k], bn[~core,:k]) = (an_s, bn_s)
+        (dan[1,~core,:k], dbn[1,~core,:k]) = (dan_s[0], dbn_s[0])
+        (dan[3,~core,:k], dbn[3,~core,:k]) = (dan_s[1], dbn_s[1])
+    return (an, bn, nmax, _real_directions(dan, 2),
+        _real_directions(dbn, 2),
+        ("x", "y", "m_real", "m_imag", "m2_real", "m2_imag"),
+        array([0.0, 1.0, 0.0, 0.0, 0.0, 0.0]))
+
+
+def _real_directions(d, n_real):
+    """Split the complex derivatives with respect to the refractive indices
+    into derivatives with respect to their real and imaginary parts.
+
+    The coefficients are analytic functions of the refractive indices, so
+    the derivative with respect to Im(m) is i times that with respect to
+    Re(m). The first n_real rows of d are for real parameters.
+    """
+    rows = list(d[:n_real])
+    for dm in d[n_real:]:
+        rows.extend((dm, complex(0,1)*dm))
+    return array(rows)
+
+
+def _dlog_derivative(z,dn):
+    """The derivative dD_n/dz = n*(n+1)/z**2 - 1 - D_n**2 of the logarithmic
+    derivative dn = D_n(z) from log_derivative.
+    """
+    z = asarray(z)[...,newaxis]
+    n = arange(1,dn.shape[-1]+1)
+    return n*(n+1)/z**2 - 1 - dn**2
+
+
+def _riccati_bessel_jac(psi,x,dx):
+    """psi_n(x) and psi_(n-1)(x), n = 1...nmax, and their derivatives.
+
+    Uses psi_n' = psi_(n-1) - n*psi_n/x and
+    psi_(n-1)' = n*psi_(n-1)/x - psi_n; the same holds for the
+    Riccati-Hankel functions.
+
+    Args:
+        psi: The function for n = 0...nmax, shape (N, nmax+1).
+        x: The real arguments of length N.
+        dx: The derivatives of x with respect to the parameters, shape
+            (P, N).
+
+    Returns:
+        A tuple (p, p1, dp, dp1).
+    """
+    (p, p1) = (psi[:,1:], psi[:,:-1])
+    n = arange(1,p.shape[-1]+1)/x[:,newaxis]
+    dx = dx[...,newaxis]
+    return (p, p1, (p1-n*p)*dx, (n*p1-p)*dx)
+
+
+def _coeff_jac(c,dc,p,p1,g,g1,dp,dp1,dg,dg1):
+    """The coefficient (c*p-p1)/(c*g-g1) and its derivative.
+    """
+    num = c*p-p1
+    den = c*g-g1
+    coeff = num/den
+    dnum = dc*p+c*dp-dp1
+    dden = dc*g+c*dg-dg1
+    return (coeff, (dnum-coeff*dden)/den)
+
+
+def _psi_zeta_jac(z,a,dz,dn):
+    """The products psi_n(z)*zeta_n(z) of _psi_zeta and their derivatives.
+
+    The derivatives of a_n = psi_n/psi_(n-1) follow from
+    d(log a_n)/dz = D_n - D_(n-1), and those of the products are carried
+    along the upward recurrence of _psi_zeta.
+
+    Args:
+        z: The arguments of length N.
+        a: The ratios of _psi_ratio, shape (N, nmax).
+        dz: The derivatives of z with respect to the parameters, shape
+            (P, N).
+        dn: D_n(z) from log_derivative.
+
+    Returns:
+        A tuple (pz, da, dpz) where da and dpz have the shape (P, N, nmax).
+    """
+    n = arange(1,a.shape[-1]+1)
+    da = a*(dn-(n/z[:,newaxis]-a))*dz[...,newaxis]
+    isg = where(z.imag >= 0, complex(0,1), complex(0,-1))
+    e = exp(2*isg*z)
+    p = 0.5*(1-e)
+    dp = -isg*e*dz
+    pz = empty(a.shape, dtype=complex)
+    dpz = empty(da.shape, dtype=complex)
+    for k in range(a.shape[-1]):
+        ak = a[:,k]
+        dp = da[...,k]*(2*ak*p-isg) + ak**2*dp
+        p = ak*(ak*p-isg)
+        pz[:,k] = p
+        dpz[...,k] = dp
+    return (pz, da, dpz)
+
+
+def single_mie_coeff_jac(eps,x):
+    """Mie coefficients for many single-layered spheres and their
+    derivatives.
+
+    Args:
+        eps: Array of complex relative permittivities.
+        x: Array of size parameters.
+
+    Returns:
+        A tuple (an, bn, nmax, dan, dbn) where an, bn and nmax are as in
+        single_mie_coeff_batch and dan and dbn have the shape
+        (2, N, nmax.max()); the rows are the derivatives with respect to
+        x and (as complex derivatives) to the refractive index
+        m = sqrt(eps).
+    """
+    nmax = _nmax(asarray(x, dtype=float))
+    eps = asarray(eps, dtype=complex)
+    x = asarray(x, dtype=float)
+    N = len(x)
+    if N == 0:
+        return (zeros((0,0),dtype=complex), zeros((0,0),dtype=complex), nmax,
+            zeros((2,0,0),dtype=complex), zeros((2,0,0),dtype=complex))
+    zero = (x==0)
+    x = where(zero, 1.0, x)
+
+    m = sqrt(eps)
+    z = m*x
+    nm = nmax.max()
+    nmx = _start_order(nm,abs(z).max())
+    (z0, o) = (zeros(N), ones(N))
+    dx = array([o, z0])
+    dm = array([z0, o])[...,newaxis]
+
+    with errstate(all="ignore"):
+        (psi,chi) = riccati_bessel(x,nm)
+        (px,p1x,dpx,dp1x) = _riccati_bessel_jac(psi,x,dx)
+        (gsx,gs1x,dgsx,dgs1x) = _riccati_bessel_jac(psi-complex(0,1)*chi,
+            x,dx)
+
+        dn = log_derivative(z,nm,nmx)
+        ddn = _dlog_derivative(z,dn)*array([m,x])[...,newaxis]
+        xc = x[:,newaxis]
+        mc = m[:,newaxis]
+        n1 = arange(1,nm+1)/xc
+        dn1 = -n1/xc*dx[...,newaxis]
+        da = dn/mc + n1
+        dda = ddn/mc - dn/mc**2*dm + dn1
+        db = dn*mc + n1
+        ddb = ddn*mc + dn*dm + dn1
+
+        (an,dan) = _coeff_jac(da,dda,px,p1x,gsx,gs1x,dpx,dp1x,dgsx,dgs1x)
+        (bn,dbn) = _coeff_jac(db,ddb,px,p1x,gsx,gs1x,dpx,dp1x,dgsx,dgs1x)
+
+    valid = (arange(nm) < nmax[:,newaxis]) & ~zero[:,newaxis]
+    return (where(valid, an, 0.0), where(valid, bn, 0.0), nmax,
+        where(valid, dan, 0.0), where(valid, dbn, 0.0))
+
+
+def coated_mie_coeff_jac(eps1,eps2,x,y):
+    """Mie coefficients for many dual-layered (coated) spheres and their
+    derivatives.
+
+    The derivatives are carried through the same stable formulation as in
+    coated_mie_coeff_batch. The cores must have x > 0.
+
+    Args:
+        eps1: Array of complex relative permittivities of the core.
+        eps2: Array of complex relative permittivities of the shell.
+        x: Array of size parameters of the core.
+        y: Array of size parameters of the shell.
+
+    Returns:
+        A tuple (an, bn, nmax, dan, dbn) where an, bn and nmax are as in
+        coated_mie_coeff_batch and dan and dbn have the shape
+        (4, N, nmax.max()); the rows are the derivatives with respect to
+        x, y and (as complex derivatives) to the refractive indices
+        m1 = sqrt(eps1) and m2 = sqrt(eps2).
+    """
+    nmax = _nmax(asarray(y, dtype=float))
+    (eps1, eps2) = (asarray(eps1, dtype=complex), asarray(eps2, dtype=complex))
+    (x, y) = (asarray(x, dtype=float), asarray(y, dtype=float))
+    N = len(y)
+    if N == 0:
+        return (zeros((0,0),dtype=complex), zeros((0,0),dtype=complex), nmax,
+            zeros((4,0,0),dtype=complex), zeros((4,0,0),dtype=complex))
+
+    m1 = sqrt(eps1)
+    m2 = sqrt(eps2)
+    m = (m2/m1)[:,newaxis]
+    u = m1*x
+    v = m2*x
+    w = m2*y
+
+    nm = nmax.max()
+    mx = max(abs(m1*y).max(),abs(w).max())
+    nmx = _start_order(nm,mx)
+    (z0, o) = (zeros(N), ones(N))
+    # the derivatives with respect to (x, y, m1, m2)
+    du = array([m1, z0, x, z0])
+    dv = array([m2, z0, z0, x])
+    dw = array([z0, m2, z0, y])
+    dy = array([z0, o, z0, z0])
+    dm = array([z0, z0, -m2/m1**2, 1/m1])[...,newaxis]
+    dm2 = array([z0, z0, z0, o])[...,newaxis]
+
+    with errstate(all="ignore"):
+        (dnu,dnv,dnw) = log_derivative((u,v,w),nm,nmx)
+        ddnu = _dlog_derivative(u,dnu)*du[...,newaxis]
+        ddnv = _dlog_derivative(v,dnv)*dv[...,newaxis]
+        ddnw = _dlog_derivative(w,dnw)*dw[...,newaxis]
+
+        (psi,chi) = riccati_bessel(y,nm)
+        (py,p1y,dpy,dp1y) = _riccati_bessel_jac(psi,y,dy)
+        (gsy,gs1y,dgsy,dgs1y) = _riccati_bessel_jac(psi-complex(0,1)*chi,
+            y,dy)
+        a = _psi_ratio(asarray([v,w]),asarray([dnv,dnw]))
+        (pzv,dav,dpzv) = _psi_zeta_jac(v,a[0],dv,dnv)
+        (pzw,daw,dpzw) = _psi_zeta_jac(w,a[1],dw,dnw)
+        rho2 = _core_ratio(v,w,a[0],a[1])
+        drho2 = 2*rho2*(dnv*dv[...,newaxis]-dnw*dw[...,newaxis])
+
+        isg = where(v.imag >= 0, complex(0,1), complex(0,-1))[:,newaxis]
+        q = isg*(pzv-rho2*pzw)
+        dq = isg*(dpzv-drho2*pzw-rho2*dpzw)
+        uu = m*dnu-dnv
+        duu = dm*dnu+m*ddnu-ddnv
+        vv = dnu/m-dnv
+        dvv = ddnu/m-dnu/m**2*dm-ddnv
+        (dns1,ddns1) = _shell_term_jac(uu,duu,rho2,drho2,q,dq)
+        (gns1,dgns1) = _shell_term_jac(vv,dvv,rho2,drho2,q,dq)
+
+        dns = dns1+dnw
+        gns = gns1+dnw
+        ddns = ddns1+ddnw
+        dgns = dgns1+ddnw
+        yc = y[:,newaxis]
+        nrat = arange(1,nm+1)/yc
+        dnrat = -nrat/yc*dy[...,newaxis]
+        m2c = m2[:,newaxis]
+        a1 = dns/m2c+nrat
+        da1 = ddns/m2c-dns/m2c**2*dm2+dnrat
+        b1 = m2c*gns+nrat
+        db1 = dm2*gns+m2c*dgns+dnrat
+        (an,dan) = _coeff_jac(a1,da1,py,p1y,gsy,gs1y,dpy,dp1y,dgsy,dgs1y)
+        (bn,dbn) = _coeff_jac(b1,db1,py,p1y,gsy,gs1y,dpy,dp1y,dgsy,dgs1y)
+
+    valid = (arange(nm) < nmax[:,newaxis])
+    return (where(valid, an, 0.0), where(valid, bn, 0.0), nmax,
+        where(valid, dan, 0.0), where(valid, dbn, 0.0))
+
+
+def _shell_term_jac(uu,duu,rho2,drho2,q,dq):
+    """The term uu*rho2/(1+uu*q) of coated_mie_coeff and its derivative.
+    """
+    den = 1+uu*q
+    t = uu*rho2/den
+    return (t, (duu*rho2+uu*drho2-t*(duu*q+uu*dq))/den)
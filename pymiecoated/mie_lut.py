@@ -0,0 +1,166 @@
+"""
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import itertools
+import os
+import numpy
+from numpy import asarray, broadcast_arrays, clip, diff, meshgrid, \
+    searchsorted, zeros
+from .mie_batch import mie_batch, PROP_NAMES
+
+
+class LookupTable(object):
+    """Scattering properties tabulated on a rectilinear grid.
+
+    Attributes:
+        axes: A list of (name, values) pairs, one for each dimension of the
+            table. The values must be strictly increasing.
+        props: A dict of arrays with the tabulated properties, each with
+            the shape given by the lengths of the axes.
+    """
+    def __init__(self, axes, props):
+        self.axes = [(name, asarray(values, dtype=float))
+            for (name, values) in axes]
+        for (name, values) in self.axes:
+            if (values.ndim != 1) or (diff(values) <= 0).any():
+                raise ValueError("The values of axis " + name + \
+                    " must be a strictly increasing 1-D sequence.")
+        self.props = props
+
+    def interp(self, prop, **coords):
+        """Multilinear interpolation of a property.
+
+        Args:
+            prop: The name of the property, e.g. "qb".
+            coords: The coordinates for each axis as keyword arguments,
+                given as scalars or arrays that are broadcast together.
+
+        Returns:
+            The interpolated values with the broadcast shape of coords.
+        """
+        table = self.props[prop]
+        names = [name for (name, values) in self.axes]
+        if sorted(coords) != sorted(names):
+            raise ValueError("Must give the coordinates " + \
+                ", ".join(names) + ".")
+        points = broadcast_arrays(*[asarray(coords[name], dtype=float)
+            for name in names])
+        shape = points[0].shape
+
+        ind = []
+        weights = []
+        for (p, (name, values)) in zip(points, self.axes):
+            p = p.ravel()
+            if ((p < values[0]) | (p > values[-1])).any():
+                raise ValueError("Coordinate " + name + \
+                    " is outside the table.")
+            if len(values) == 1:
+                ind.append(zeros(len(p), dtype=int))
+                weights.append(zeros(len(p)))
+                continue
+            i = clip(searchsorted(values, p, side="right")-1, 0,
+                len(values)-2)
+            ind.append(i)
+            weights.append((p-values[i])/(values[i+1]-values[i]))
+
+        result = zeros(points[0].size)
+        for corner in itertools.product((0,1), repeat=len(self.axes)):
+            w = 1.0
+            for (c, t) in zip(corner, weights):
+                w = w*(t if c else 1-t)
+            idx = tuple(clip(i+c, 0, len(values)-1)
+                for (i, c, (name, values)) in zip(ind, corner, self.axes))
+            result += w*table[idx]
+
+        return result.reshape(shape)
+
+    def save(self, path):
+        """Save the table.
+
+        The table is stored in the directory path, with the axes in
+        axes.npz and each property in a separate .npy file, so that the
+        properties can be memory-mapped when loading.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        names = [name for (name, values) in self.axes]
+        axis_values = dict(("axis_"+name, values)
+            for (name, values) in self.axes)
+        numpy.savez(os.path.join(path, "axes.npz"),
+            names=numpy.array(names), props=numpy.array(sorted(self.props)),
+            **axis_values)
+        for (prop, values) in self.props.items():
+            numpy.save(os.path.join(path, prop+".npy"), values)
+
+
+def load_table(path, mmap=True):
+    """Load a table saved with LookupTable.save.
+
+    Args:
+        path: The directory containing the table.
+        mmap: If True, the properties are memory-mapped read-only instead of
+            read into memory. This lets several processes share the data.
+
+    Returns:
+        A LookupTable instance.
+    """
+    with numpy.load(os.path.join(path, "axes.npz")) as f:
+        axes = [(str(name), f["axis_"+str(name)]) for name in f["names"]]
+        prop_names = [str(prop) for prop in f["props"]]
+    props = dict((prop, numpy.load(os.path.join(path, prop+".npy"),
+        mmap_mode="r" if mmap else None)) for prop in prop_names)
+    return LookupTable(axes, props)
+
+
+def build_table(axes, params, props=PROP_NAMES, chunk_size=256,
+    precision="double"):
+    """Compute a lookup table of scattering properties.
+
+    The properties are computed with mie_batch at every point of the grid
+    spanned by the axes.
+
+    For example, a table over diameter and ice fraction for melting hail:
+    def params(D, frac):
+        x_shell = k*D/2
+        return {"x":x_shell*frac**(1.0/3.0), "y":x_shell, "m":m_i, "m2":m_w}
+    table = build_table([("D",D), ("frac",frac)], params, props=("qb",))
+
+    Args:
+        axes: A list of (name, values) pairs defining the grid.
+        params: A function that is called with the grid coordinates as
+            keyword arguments (arrays with the shape of the grid) and
+            returns a dict of arguments for mie_batch.
+        props: The names of the properties to tabulate.
+        chunk_size: Passed to mie_batch.
+        precision: Passed to mie_batch; "single" gives float32 tables of
+            half the size.
+
+    Returns:
+        A LookupTable instance.
+    """
+    axes = [(name, asarray(values, dtype=float)) for (name, values) in axes]
+    grid = meshgrid(*[values for (name, values) in axes], indexing="ij")
+    kwargs = params(**dict(zip([name for (name, values) in axes], grid)))
+    results = mie_batch(chunk_size=chunk_size, props=props,
+        precision=precision, **kwargs)
+    shape = tuple(len(values) for (name, values) in axes)
+    return LookupTable(axes, dict((prop, numpy.broadcast_to(results[prop],
+        shape).copy()) for prop in props))
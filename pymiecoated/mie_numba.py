@@ -0,0 +1,183 @@
+"""The numba backend.
+
+The kernels are compiled with numba when first used (the compiled code is
+cached on disk) and release the GIL, so they can run in parallel in
+threads of the calling code; mie_sweep runs them in separate processes,
+each of which selects its backend when it imports pymiecoated. They
+compute in double precision and return results in the precision of their
+arguments. Importing this module registers the backend; it raises
+ImportError if numba is not installed.
+
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from numba import njit
+from numpy import asarray, zeros, empty, iscomplexobj, float32, nan
+from numpy import sin, cos, exp
+from .mie_backend import register_kernels
+from .mie_coeffs import _as_complex, _start_order, _RESCALE
+
+
+def log_derivative(z,nmax,nmx):
+    z = _as_complex(z)
+    dn = _log_derivative_kernel(z.astype(complex).ravel(), nmax, nmx)
+    return dn.astype(z.dtype, copy=False).reshape(z.shape+(nmax,))
+
+
+@njit(cache=True, nogil=True)
+def _log_derivative_kernel(z,nmax,nmx):
+    dn = zeros((z.size,nmax), dtype=z.dtype)
+    for i in range(z.size):
+        d = 0j
+        for j in range(nmx-1,0,-1):
+            r = (j+1.0)/z[i]
+            d = r - 1.0/(d+r)
+            if j <= nmax:
+                dn[i,j-1] = d
+    return dn
+
+
+def riccati_bessel(z,nmax):
+    z = asarray(z)
+    if iscomplexobj(z):
+        z = _as_complex(z)
+    else:
+        z = z.astype(float32 if z.dtype==float32 else float, copy=False)
+    nm = max(nmax,1)
+    za = abs(z).max() if z.size else 0.0
+    (psi, chi) = _riccati_bessel_kernel(z.astype(complex).ravel(), nm,
+        _start_order(nm,za), _RESCALE)
+    if not iscomplexobj(z):
+        (psi, chi) = (psi.real, chi.real)
+    shape = z.shape+(nm+1,)
+    return (psi.astype(z.dtype, copy=False).reshape(shape)[...,:nmax+1],
+        chi.astype(z.dtype, copy=False).reshape(shape)[...,:nmax+1])
+
+
+@njit(cache=True, nogil=True)
+def _riccati_bessel_kernel(z,nm,nmx,rescale):
+    # see mie_coeffs.riccati_bessel; for real z, the recurrence for zeta
+    # gives chi in the same way
+    psi = empty((z.size,nm+1), dtype=z.dtype)
+    chi = empty((z.size,nm+1), dtype=z.dtype)
+    for i in range(z.size):
+        zz = z[i]
+        (pn, pn1) = (1.0+0j, 0j)
+        for n in range(nmx,0,-1):
+            (pn, pn1) = ((2*n+1)/zz*pn - pn1, pn)
+            if n <= nm+1:
+                psi[i,n-1] = pn
+            if abs(pn) > rescale:
+                pn /= rescale
+                pn1 /= rescale
+                for k in range(max(n-1,0),nm+1):
+                    psi[i,k] /= rescale
+        s0 = sin(zz)
+        s1 = s0/zz - cos(zz)
+        norm = s0/psi[i,0] if abs(s0) >= abs(s1) else s1/psi[i,1]
+        for k in range(nm+1):
+            psi[i,k] *= norm
+
+        sign = 1.0 if zz.imag >= 0 else -1.0
+        e = exp(1j*sign*zz)
+        chi[i,0] = -1j*sign*e
+        chi[i,1] = chi[i,0]/zz - e
+        for n in range(1,nm):
+            chi[i,n+1] = (2*n+1)/zz*chi[i,n] - chi[i,n-1]
+        for k in range(nm+1):
+            chi[i,k] = 1j*sign*(chi[i,k]-psi[i,k])
+    return (psi, chi)
+
+
+def psi_zeta(z,a):
+    z = _as_complex(z)
+    nmax = a.shape[-1]
+    pz = _psi_zeta_kernel(z.astype(complex).ravel(),
+        a.astype(complex).reshape(-1,nmax))
+    return pz.astype(a.dtype, copy=False).reshape(a.shape)
+
+
+@njit(cache=True, nogil=True)
+def _psi_zeta_kernel(z,a):
+    pz = empty(a.shape, dtype=a.dtype)
+    for i in range(z.size):
+        isg = 1j if z[i].imag >= 0 else -1j
+        p = 0.5*(1-exp(2*isg*z[i]))
+        for n in range(a.shape[1]):
+            p = a[i,n]*(a[i,n]*p-isg)
+            pz[i,n] = p
+    return pz
+
+
+def mie_pt(u,nmax):
+    u = asarray(u, dtype=float)
+    (p, t) = _mie_pt_kernel(u.ravel(), nmax)
+    return (p.reshape(u.shape+(nmax,)), t.reshape(u.shape+(nmax,)))
+
+
+@njit(cache=True, nogil=True)
+def _mie_pt_kernel(u,nmax):
+    p = empty((u.size,nmax))
+    t = empty((u.size,nmax))
+    for i in range(u.size):
+        (p0, p1) = (0.0, 1.0)
+        for k in range(nmax):
+            n = k+1.0
+            if k > 0:
+                (p0, p1) = (p1, (2*n-1)/(n-1)*u[i]*p1 - n/(n-1)*p0)
+            p[i,k] = p1
+            t[i,k] = n*u[i]*p1 - (n+1)*p0
+    return (p, t)
+
+
+def all_props(coeffs,y):
+    return list(_all_props_kernel(coeffs.an.astype(complex),
+        coeffs.bn.astype(complex), float(y)))
+
+
+@njit(cache=True, nogil=True)
+def _all_props_kernel(an,bn,y):
+    # see mie_props._all_props_loop
+    (s_ext, s_sca, s_asy, s_b) = (0.0, 0.0, 0.0, 0j)
+    nmax = an.size
+    for i in range(nmax):
+        (a, b) = (an[i], bn[i])
+        n = i+1.0
+        cn = 2*n+1
+        s_ext += cn*(a.real+b.real)
+        s_sca += cn*(a.real*a.real+a.imag*a.imag+b.real*b.real+b.imag*b.imag)
+        s_b += cn*(a-b) if (i%2 == 0) else cn*(b-a)
+        s_asy += cn/(n*(n+1))*(a.real*b.real+a.imag*b.imag)
+        if i+1 < nmax:
+            (a1, b1) = (an[i+1], bn[i+1])
+            s_asy += n*(n+2)/(n+1)*(a.real*a1.real+a.imag*a1.imag+
+                b.real*b1.real+b.imag*b1.imag)
+    y2 = y*y
+    qext = 2*s_ext/y2
+    qsca = 2*s_sca/y2
+    qb = (s_b.real**2+s_b.imag**2)/y2
+    if qsca == 0:
+        return (qext, qsca, qext-qsca, qb, nan, nan)
+    return (qext, qsca, qext-qsca, qb, 4/y2*s_asy/qsca, qb/qsca)
+
+
+register_kernels("numba", log_derivative=log_derivative,
+    riccati_bessel=riccati_bessel, psi_zeta=psi_zeta, mie_pt=mie_pt,
+    all_props=all_props)
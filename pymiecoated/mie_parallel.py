@@ -0,0 +1,110 @@
+"""
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+from numpy import ndarray, float32, float64
+from .mie_batch import mie_batch, PROP_NAMES, _batch_params, _size_chunks, \
+    _batch_props, _outer_size
+
+
+def mie_sweep(x=None, m=None, y=None, m2=None, eps=None, mu=None,
+    eps2=None, x_layers=None, m_layers=None, eps_layers=None,
+    processes=None, chunk_size=256, min_parallel=4096, props=PROP_NAMES,
+    precision="double"):
+    """Scattering properties of many particles using a pool of processes.
+
+    The particles are sorted by size and split into chunks, which are
+    distributed to the worker processes. The workers write their results
+    directly into a shared memory array, so the output is in the same
+    order as the input regardless of the order in which the chunks finish.
+
+    Args:
+        x, m, y, m2, eps, mu, eps2: See mie_batch.
+        x_layers, m_layers, eps_layers: See mie_batch.
+        processes: The number of worker processes (default: the number of
+            CPUs).
+        chunk_size: The number of particles computed in one task.
+        min_parallel: Inputs with fewer particles than this are computed
+            serially with mie_batch, as the overhead of starting the pool
+            would exceed the gain.
+        props: The names of the properties to compute, see mie_batch.
+        precision: "double" or "single", see mie_batch.
+
+    Returns:
+        A dict of arrays as returned by mie_batch.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    layers = dict(x_layers=x_layers, m_layers=m_layers,
+        eps_layers=eps_layers)
+    (par, shape) = _batch_params(x=x, m=m, y=y, m2=m2, eps=eps, mu=mu,
+        eps2=eps2, **layers)
+    N = len(_outer_size(par))
+    if (processes <= 1) or (N < min_parallel):
+        return mie_batch(x=x, m=m, y=y, m2=m2, eps=eps, mu=mu, eps2=eps2,
+            chunk_size=chunk_size, props=props, precision=precision,
+            **layers)
+
+    props = tuple(props)
+    dtype = _out_dtype(precision)
+    chunks = _size_chunks(par, chunk_size)
+    out_shape = (len(props), N)
+    shm = shared_memory.SharedMemory(create=True,
+        size=dtype(0).itemsize*len(props)*N)
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            tasks = [executor.submit(_sweep_chunk, shm.name, out_shape, ind,
+                dict((k,v if v is None else v[ind]) for (k,v) in par.items()),
+                props, precision) for ind in chunks]
+            for task in tasks:
+                task.result()
+        out = ndarray(out_shape, dtype=dtype, buffer=shm.buf)
+        results = dict((p,out[i].reshape(shape).copy())
+            for (i,p) in enumerate(props))
+        del out
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
+
+
+def _sweep_chunk(shm_name, out_shape, ind, par_chunk, props, precision):
+    """Compute one chunk of mie_sweep in a worker process.
+    """
+    values = _batch_props(par_chunk, slice(None), props, precision)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = ndarray(out_shape, dtype=_out_dtype(precision),
+            buffer=shm.buf)
+        for (i,p) in enumerate(props):
+            out[i,ind] = values[p]
+        del out
+    finally:
+        shm.close()
+
+
+def _out_dtype(precision):
+    """The type of the results of mie_sweep.
+    """
+    return float32 if precision == "single" else float64
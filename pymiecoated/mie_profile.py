@@ -0,0 +1,147 @@
+"""Optional profiling of the Mie code.
+
+When a Profiler is active, the functions in mie_coeffs and mie_props and
+the Mie class record the time spent in each stage of the computation, the
+numbers of calls and cache hits, and the distributions of nmax and nmx.
+When no profiler is active the instrumentation costs only a check of
+the module attribute "active".
+
+Example:
+with profiling() as prof:
+    mie.qb()
+print(prof.to_dict())
+
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from contextlib import contextmanager
+from math import floor, log
+from time import perf_counter
+import threading
+
+
+class Profiler(object):
+    """Collector for timings, counts and value distributions.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = {}
+            self.counts = {}
+            self.distributions = {}
+
+    def add_time(self, stage, seconds):
+        """Record one call of stage that took the given time.
+        """
+        with self._lock:
+            t = self.timings.setdefault(stage, [0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+
+    def lap(self, stage, t0):
+        """Record the time elapsed since t0 for stage.
+
+        Returns:
+            The current time, to be used as t0 for the next stage.
+        """
+        t = perf_counter()
+        self.add_time(stage, t-t0)
+        return t
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def observe(self, name, value):
+        """Add a value to the distribution name.
+
+        Only the count, min, max and sum of the values and a histogram with
+        power-of-2 bins are kept, so the memory used does not grow with the
+        number of values.
+        """
+        b = 0 if value < 1 else 2**int(floor(log(value, 2)))
+        with self._lock:
+            d = self.distributions.get(name)
+            if d is None:
+                d = self.distributions[name] = [0, value, value, 0, {}]
+            d[0] += 1
+            d[1] = min(d[1], value)
+            d[2] = max(d[2], value)
+            d[3] += value
+            d[4][b] = d[4].get(b, 0) + 1
+
+    def to_dict(self):
+        """The collected data as a dict of plain Python types.
+
+        The timings are given as the number of calls and the total and mean
+        time for each stage. The distributions are summarized with their
+        count, min, max, mean and a histogram with power-of-2 bins (each
+        bin keyed by its lower edge).
+        """
+        with self._lock:
+            timings = dict((stage, {"calls":calls, "total":total,
+                "mean":total/calls})
+                for (stage, (calls, total)) in self.timings.items())
+            distributions = dict((name, {"count":count, "min":vmin,
+                "max":vmax, "mean":float(total)/count, "histogram":dict(hist)})
+                for (name, (count, vmin, vmax, total, hist))
+                in self.distributions.items())
+            return {"timings":timings, "counts":dict(self.counts),
+                "distributions":distributions}
+
+
+active = None
+
+
+def enable_profiling(profiler=None):
+    """Start collecting profiling data.
+
+    Args:
+        profiler: The Profiler to collect into (a new one by default).
+
+    Returns:
+        The active Profiler.
+    """
+    global active
+    active = Profiler() if profiler is None else profiler
+    return active
+
+
+def disable_profiling():
+    """Stop collecting profiling data.
+    """
+    global active
+    active = None
+
+
+@contextmanager
+def profiling(profiler=None):
+    """Context manager that collects profiling data within its block.
+    """
+    global active
+    previous = active
+    prof = enable_profiling(profiler)
+    try:
+        yield prof
+    finally:
+        active = previous
@@ -19,80 +19,546 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
-from numpy import arange, dot, zeros, vstack, sqrt, sin, cos
+from numpy import arange, array, asarray, dot, zeros, concatenate, moveaxis, newaxis
+from numpy import tensordot, empty, ones, cos, pi, where, errstate, nan
+from time import perf_counter
+from .mie_aux import Cache
+from . import mie_backend
+from . import mie_profile
 
 
-def mie_props(coeffs,y):
+# The names of the scattering properties computed by mie_props
+PROP_NAMES = ("qext", "qsca", "qabs", "qb", "asy", "qratio")
+
+# The properties that each property is derived from
+_PROP_DEPS = {"qabs":("qext","qsca"), "asy":("qsca",),
+    "qratio":("qb","qsca")}
+
+# The sums over the orders needed for each property
+_PROP_SUMS = {"qext":"ext", "qsca":"sca", "qb":"b", "asy":"asy"}
+
+
+def mie_props(coeffs,y,props=None):
     """The scattering properties.
+
+    The coefficients can also be given as arrays of shape (N, nmax) for N
+    particles (see MieCoeffsBatch), in which case y must be an array of
+    length N and the properties are returned as arrays.
+
+    Only the requested properties are computed, together with the ones
+    they are derived from (e.g. qsca for asy), and only the sums over the
+    orders that these need.
+
+    The sums over the orders are accumulated in blocks of _ORDER_BLOCK
+    orders, so that the temporary arrays stay small even for very large
+    size parameters.
+
+    The properties are computed in single precision (float32) if the
+    coefficients are (see mie_coeffs_batch).
+
+    Args:
+        coeffs: The Mie coefficients (MieCoeffs or MieCoeffsBatch).
+        y: The size parameter of the particle (of the outer layer for
+            coated particles).
+        props: The names of the properties to compute, a subset of
+            PROP_NAMES (default: all of them).
+
+    Returns:
+        A dict containing the requested properties.
+    """
+    if props is None:
+        props = PROP_NAMES
+    values = _mie_props(coeffs, y, props, {})
+    return dict((p,values[p]) for p in props)
+
+
+def _mie_props(coeffs,y,props,known):
+    """mie_props using the already computed properties in the dict known.
+
+    Returns:
+        A new dict with the properties in known, the requested properties
+        and the properties these were derived from.
+    """
+    needed = set()
+    stack = list(props)
+    while stack:
+        p = stack.pop()
+        if p not in PROP_NAMES:
+            raise ValueError("Unknown scattering property: " + str(p))
+        if (p not in known) and (p not in needed):
+            needed.add(p)
+            stack.extend(_PROP_DEPS.get(p, ()))
+    values = dict(known)
+    if not needed:
+        return values
+
+    prof = mie_profile.active
+    if prof is not None:
+        t = perf_counter()
+
+    sums = set(_PROP_SUMS[p] for p in needed if p in _PROP_SUMS)
+    nmax = coeffs.an.shape[-1] if sums else 0
+    shape = coeffs.an.shape[:-1] if sums else ()
+    (ctype, rtype) = (coeffs.an.dtype, coeffs.an.real.dtype) if sums else \
+        (complex, float)
+    s = dict((k,zeros(shape, dtype=ctype if k=="b" else rtype))
+        for k in sums)
+    for i0 in range(0, nmax, _ORDER_BLOCK):
+        ds = _props_sums(coeffs.an, coeffs.bn, i0,
+            min(i0+_ORDER_BLOCK, nmax), sums)
+        for k in sums:
+            s[k] += ds[k]
+
+    y2 = asarray(y, dtype=rtype)**2
+    if "qext" in needed:
+        values["qext"] = 2*s["ext"]/y2
+    if "qsca" in needed:
+        values["qsca"] = 2*s["sca"]/y2
+    if "qabs" in needed:
+        values["qabs"] = values["qext"]-values["qsca"]
+    if "qb" in needed:
+        values["qb"] = (s["b"]*s["b"].conj()).real/y2
+    if "asy" in needed:
+        values["asy"] = 4/y2*s["asy"]/values["qsca"]
+    if "qratio" in needed:
+        values["qratio"] = values["qb"]/values["qsca"]
+    if prof is not None:
+        prof.lap("mie_props", t)
+
+    return values
+
+
+# The number of orders summed at a time in mie_props and mie_S12
+_ORDER_BLOCK = 4096
+
+
+def _props_sums(an_all,bn_all,i0,i1,sums):
+    """The sums of mie_props over the orders i0+1...i1.
+
+    Args:
+        an_all, bn_all: The Mie coefficients.
+        i0, i1: The range of the orders.
+        sums: The names of the sums to compute: "ext", "sca" and "asy"
+            for qext, qsca and asy and "b" for the (complex)
+            backscattering amplitude.
+
+    Returns:
+        A dict of the partial sums.
     """
-    anp = coeffs.an.real
-    anpp = coeffs.an.imag
-    bnp = coeffs.bn.real
-    bnpp = coeffs.bn.imag
-    nmax = coeffs.nmax
-
-    n1 = nmax-1
-    n = arange(1,nmax+1,dtype=float)
+    an = an_all[...,i0:i1]
+    bn = bn_all[...,i0:i1]
+    anp = an.real
+    anpp = an.imag
+    bnp = bn.real
+    bnpp = bn.imag
+
+    n = arange(i0+1,i1+1,dtype=anp.dtype)
     cn = 2*n+1
-    c1n = n*(n+2)/(n+1)
-    c2n = cn/(n*(n+1))
-    y2 = y**2
 
-    dn = cn*(anp+bnp)
-    q = dn.sum()
-    qext = 2*q/y2
+    ds = {}
+    if "ext" in sums:
+        ds["ext"] = (cn*(anp+bnp)).sum(axis=-1)
+    if "sca" in sums:
+        ds["sca"] = (cn*(anp**2+anpp**2+bnp**2+bnpp**2)).sum(axis=-1)
+    if "asy" in sums:
+        c1n = n*(n+2)/(n+1)
+        c2n = cn/(n*(n+1))
+        an1 = _next_order(an_all,i0,i1)
+        bn1 = _next_order(bn_all,i0,i1)
+        asy1 = c1n*(anp*an1.real+anpp*an1.imag+bnp*bn1.real+bnpp*bn1.imag)
+        asy2 = c2n*(anp*bnp+anpp*bnpp)
+        ds["asy"] = (asy1+asy2).sum(axis=-1)
+    if "b" in sums:
+        gn = 1-2*(n%2)
+        ds["b"] = ((an-bn)*cn*gn).sum(axis=-1)
+    return ds
+
+
+def _all_props_loop(an,bn,y):
+    """All the properties of one particle with few coefficients.
 
-    en = cn*(anp**2+anpp**2+bnp**2+bnpp**2)
-    q = en.sum()
-    qsca = 2*q/y2
-    qabs = qext-qsca
+    The sums are accumulated in a single pass with Python numbers, which
+    avoids the per-operation overhead of NumPy for short arrays.
 
-    fn = (coeffs.an-coeffs.bn)*cn
-    gn=(-1)**n
-    q = (fn*gn).sum()
-    qb = dot(q,q.conj()).real/y2
+    Returns:
+        A list of the properties in the order of PROP_NAMES.
+    """
+    (s_ext, s_sca, s_asy, s_b) = (0.0, 0.0, 0.0, 0j)
+    an = an.tolist()
+    bn = bn.tolist()
+    nmax = len(an)
+    for i in range(nmax):
+        (a, b) = (an[i], bn[i])
+        n = i+1.0
+        cn = 2*n+1
+        s_ext += cn*(a.real+b.real)
+        s_sca += cn*(a.real*a.real+a.imag*a.imag+b.real*b.real+b.imag*b.imag)
+        s_b += cn*(a-b) if (i%2 == 0) else cn*(b-a)
+        s_asy += cn/(n*(n+1))*(a.real*b.real+a.imag*b.imag)
+        if i+1 < nmax:
+            (a1, b1) = (an[i+1], bn[i+1])
+            s_asy += n*(n+2)/(n+1)*(a.real*a1.real+a.imag*a1.imag+
+                b.real*b1.real+b.imag*b1.imag)
+    y2 = float(y)**2
+    qext = 2*s_ext/y2
+    qsca = 2*s_sca/y2
+    qb = (s_b.real**2+s_b.imag**2)/y2
+    if qsca == 0:
+        # as in _mie_props, where the divisions by zero give nan
+        return [qext, qsca, qext-qsca, qb, nan, nan]
+    return [qext, qsca, qext-qsca, qb, 4/y2*s_asy/qsca, qb/qsca]
+
+
+# The largest number of coefficients for which _all_props_loop is used
+_LOOP_ORDERS = 40
 
-    g1 = zeros((4,nmax),dtype=float)
-    g1[:,:n1] = vstack((anp[1:nmax], anpp[1:nmax], bnp[1:nmax], bnpp[1:nmax]))
 
-    asy1 = c1n*(anp*g1[0,:]+anpp*g1[1,:]+bnp*g1[2,:]+bnpp*g1[3,:])
-    asy2 = c2n*(anp*bnp+anpp*bnpp)
+def _next_order(a,i0,i1):
+    """The coefficients of the orders i0+2...i1+1, padded with zero beyond
+    the last order.
+    """
+    a1 = a[...,i0+1:i1+1]
+    if a1.shape[-1] < i1-i0:
+        a1 = concatenate((a1, zeros(a.shape[:-1]+(1,), dtype=a.dtype)),
+            axis=-1)
+    return a1
+
 
-    asy = 4/y2*(asy1+asy2).sum()/qsca
-    qratio = qb/qsca
+def mie_props_jac(coeffs,y,props=None):
+    """The scattering properties and their derivatives.
 
-    return {"qext":qext, "qsca":qsca, "qabs":qabs, "qb":qb, "asy":asy, 
-        "qratio":qratio}
+    Args:
+        coeffs: The Mie coefficients and their derivatives (MieCoeffsJac).
+        y: The size parameters of the particles (of the outer layer for
+            coated particles), an array of length N.
+        props: The names of the properties, a subset of PROP_NAMES
+            (default: all of them).
 
+    Returns:
+        A tuple (values, jac) where values is a dict of the properties as
+        returned by mie_props and jac is a dict containing for each
+        property an array of shape (P, N) with its derivatives with respect
+        to the parameters coeffs.params. The derivatives of zero-sized
+        particles are given as zero.
+    """
+    if props is None:
+        props = PROP_NAMES
+    y = asarray(y, dtype=float)
+    zero = (y == 0)
+    with errstate(invalid="ignore", divide="ignore"):
+        values = _mie_props(coeffs, y, props, {})
+    # the derivatives are needed for the same properties as the values
+    needed = set(values)
+    values = dict((p,where(zero, 0.0, v)) for (p,v) in values.items())
+
+    prof = mie_profile.active
+    if prof is not None:
+        t = perf_counter()
+
+    (an, bn, dan, dbn) = (coeffs.an, coeffs.bn, coeffs.dan, coeffs.dbn)
+    n = arange(1,an.shape[-1]+1)
+    cn = 2*n+1
+    y = where(zero, 1.0, y)
+    y2 = y**2
+    dlogy = coeffs.dy.reshape((-1,)+(1,)*y.ndim)/y
+    v = values
+    jac = {}
+    with errstate(invalid="ignore", divide="ignore"):
+        if "qext" in needed:
+            dext = (cn*(dan+dbn).real).sum(axis=-1)
+            jac["qext"] = 2*dext/y2 - 2*v["qext"]*dlogy
+        if "qsca" in needed:
+            dsca = 2*(cn*(an.conj()*dan+bn.conj()*dbn).real).sum(axis=-1)
+            jac["qsca"] = 2*dsca/y2 - 2*v["qsca"]*dlogy
+        if "qabs" in needed:
+            jac["qabs"] = jac["qext"]-jac["qsca"]
+        if "qb" in needed:
+            gn = 1-2*(n%2)
+            b = (cn*gn*(an-bn)).sum(axis=-1)
+            db = (cn*gn*(dan-dbn)).sum(axis=-1)
+            jac["qb"] = 2*(b.conj()*db).real/y2 - 2*v["qb"]*dlogy
+        if "asy" in needed:
+            c1n = n*(n+2)/(n+1)
+            c2n = cn/(n*(n+1))
+            nm = len(n)
+            (an1, bn1) = (_next_order(an,0,nm), _next_order(bn,0,nm))
+            (dan1, dbn1) = (_next_order(dan,0,nm), _next_order(dbn,0,nm))
+            dasy = (c1n*(dan*an1.conj()+an*dan1.conj()+dbn*bn1.conj()+
+                bn*dbn1.conj()).real +
+                c2n*(dan*bn.conj()+an*dbn.conj()).real).sum(axis=-1)
+            jac["asy"] = 4*dasy/(y2*v["qsca"]) - \
+                v["asy"]*(2*dlogy+jac["qsca"]/v["qsca"])
+        if "qratio" in needed:
+            jac["qratio"] = (jac["qb"]-v["qratio"]*jac["qsca"])/v["qsca"]
+    if prof is not None:
+        prof.lap("mie_props_jac", t)
+
+    return (dict((p,values[p]) for p in props),
+        dict((p,where(zero, 0.0, jac[p])) for p in props))
 
 def mie_S12(coeffs,u):
     """The amplitude scattering matrix.
+
+    The cosine u can be a scalar or an array, in which case S1 and S2 are
+    returned as arrays of the same shape as u. The weighted angular
+    functions are taken from pt_cache, so repeated calls with the same
+    angles only cost a dot product.
+
+    For coefficients of N particles (see MieCoeffsBatch), S1 and S2 are
+    arrays of shape (N,)+u.shape.
+
+    If the tables would have more than _PT_MAX_SIZE elements, the angular
+    functions are instead generated in blocks of orders and not cached.
     """
-    (pin,tin) = mie_pt(u,coeffs.nmax)
-    n = arange(1, coeffs.nmax+1, dtype=float)
-    n2 = (2*n+1)/(n*(n+1))
-    pin *= n2
-    tin *= n2
-
-    S1 = dot(coeffs.an,pin)+dot(coeffs.bn,tin)
-    S2 = dot(coeffs.an,tin)+dot(coeffs.bn,pin)
+    if asarray(u).size*coeffs.an.shape[-1] > _PT_MAX_SIZE:
+        return _mie_S12_blocks(coeffs,u)
+    prof = mie_profile.active
+    if prof is not None:
+        t = perf_counter()
+    (pin,tin) = pt_cache.get_pt(u,coeffs.an.shape[-1])
+    if prof is not None:
+        t = prof.lap("mie_S12.angular_functions", t)
+    if coeffs.an.ndim > 1:
+        S1 = tensordot(coeffs.an,pin,(-1,-1)) + \
+            tensordot(coeffs.bn,tin,(-1,-1))
+        S2 = tensordot(coeffs.an,tin,(-1,-1)) + \
+            tensordot(coeffs.bn,pin,(-1,-1))
+    else:
+        (S1, S2) = moveaxis(dot(pin,array([coeffs.an,coeffs.bn]).T) +
+            dot(tin,array([coeffs.bn,coeffs.an]).T), -1, 0)
+    if prof is not None:
+        prof.lap("mie_S12.sum", t)
     return (S1, S2)
 
 
+# The largest angular function tables kept by mie_S12
+_PT_MAX_SIZE = 2**22
+
+
+def _mie_S12_blocks(coeffs,u):
+    """mie_S12 with the angular functions generated block by block.
+    """
+    u = asarray(u, dtype=float)
+    an = coeffs.an
+    bn = coeffs.bn
+    nmax = an.shape[-1]
+    shape = an.shape[:-1]+u.shape
+    S1 = zeros(shape, dtype=complex)
+    S2 = zeros(shape, dtype=complex)
+    uc = u[...,newaxis]
+    # pi_(n-1) and pi_n
+    (p0, p1) = (zeros(u.shape), ones(u.shape))
+    for i0 in range(0, nmax, _ORDER_BLOCK):
+        i1 = min(i0+_ORDER_BLOCK, nmax)
+        n = arange(i0+1, i1+1, dtype=float)
+        p = empty(u.shape+(i1-i0,))
+        pm1 = empty(u.shape+(i1-i0,))
+        for (k, nk) in enumerate(n):
+            if nk > 1:
+                (p0, p1) = (p1, (2*nk-1)/(nk-1)*p1*u - nk/(nk-1)*p0)
+            pm1[...,k] = p0
+            p[...,k] = p1
+        t = n*uc*p - (n+1)*pm1
+        w = (2*n+1)/(n*(n+1))
+        p *= w
+        t *= w
+        (a, b) = (an[...,i0:i1], bn[...,i0:i1])
+        if an.ndim > 1:
+            S1 += tensordot(a,p,(-1,-1)) + tensordot(b,t,(-1,-1))
+            S2 += tensordot(a,t,(-1,-1)) + tensordot(b,p,(-1,-1))
+        else:
+            S1 += dot(p,a) + dot(t,b)
+            S2 += dot(t,a) + dot(p,b)
+    return (S1, S2)
+
+
+def mie_mueller(coeffs,u):
+    """The independent elements of the scattering (Mueller) matrix.
+
+    For a sphere, the matrix has the four independent elements
+    S11 = (|S2|**2+|S1|**2)/2, S12 = (|S2|**2-|S1|**2)/2,
+    S33 = Re(S2*conj(S1)) and S34 = Im(S2*conj(S1)), with S1 and S2 from
+    mie_S12 (Bohren and Huffman, 1983, Eq. 4.77). The arguments and the
+    shapes of the results are as for mie_S12.
+
+    Returns:
+        A tuple (S11, S12, S33, S34).
+    """
+    (S1, S2) = mie_S12(coeffs,u)
+    i1 = S1.real**2 + S1.imag**2
+    i2 = S2.real**2 + S2.imag**2
+    s21 = S2*S1.conj()
+    return (0.5*(i2+i1), 0.5*(i2-i1), s21.real, s21.imag)
+
+
+def mie_legendre(coeffs,n_moments=None):
+    """The Legendre moments of the phase function.
+
+    The moments chi_l are the coefficients of the expansion
+    p(u) = sum_l (2*l+1)*chi_l*P_l(u) of the phase function, normalized so
+    that chi_0 = 1; chi_1 is the asymmetry parameter. This is the
+    convention of the PMOM input of DISORT.
+
+    S11 is a polynomial of degree 2*nmax in u, so the moments are
+    integrated exactly (up to rounding errors) with a Gauss-Legendre
+    quadrature of sufficient order, without sampling the phase function
+    on a user-given angle grid. The moments vanish beyond l = 2*nmax.
+
+    The moments are accumulated over chunks of _LEGENDRE_NODES quadrature
+    nodes, and the angular functions of the nodes are generated block by
+    block (see _mie_S12_blocks) rather than kept in pt_cache, so that the
+    memory used grows only linearly with nmax.
+
+    Args:
+        coeffs: The Mie coefficients (MieCoeffs or MieCoeffsBatch).
+        n_moments: The number of moments to return (default: 2*nmax+1,
+            i.e. all the nonzero moments).
+
+    Returns:
+        An array of shape (n_moments,), or (N, n_moments) for the
+        coefficients of N particles, containing chi_0...chi_(n_moments-1).
+    """
+    nmax = coeffs.an.shape[-1]
+    if n_moments is None:
+        n_moments = 2*nmax+1
+    (u, w) = _gauss_legendre(nmax + n_moments//2 + 1)
+    prof = mie_profile.active
+    if prof is not None:
+        t = perf_counter()
+
+    chi = zeros(coeffs.an.shape[:-1]+(n_moments,))
+    for i0 in range(0, len(u), _LEGENDRE_NODES):
+        uc = u[i0:i0+_LEGENDRE_NODES]
+        (S1, S2) = _mie_S12_blocks(coeffs,uc)
+        ws = 0.5*(S1.real**2+S1.imag**2+S2.real**2+S2.imag**2) * \
+            w[i0:i0+_LEGENDRE_NODES]
+        (p0, p1) = (ones(len(uc)), uc)
+        for l in range(n_moments):
+            if l > 1:
+                (p0, p1) = (p1, ((2*l-1)*uc*p1 - (l-1)*p0)/l)
+            chi[...,l] += dot(ws, p0 if l==0 else p1)
+    chi /= chi[...,:1]
+    if prof is not None:
+        prof.lap("mie_legendre", t)
+    return chi
+
+
+# The number of quadrature nodes processed at a time by mie_legendre
+_LEGENDRE_NODES = 512
+
+
+def _gauss_legendre(n):
+    """The nodes and weights of the n-point Gauss-Legendre quadrature.
+
+    The nodes are found with Newton's method from their asymptotic
+    estimates, which unlike numpy.polynomial.legendre.leggauss stays fast
+    for the large n needed at large size parameters. The results are kept
+    in _gauss_cache.
+
+    Returns:
+        A tuple (u, w) of the nodes in increasing order and the weights.
+    """
+    uw = _gauss_cache.get(n)
+    if uw is None:
+        k = arange(n, 0, -1)
+        u = cos(pi*(k-0.25)/(n+0.5))
+        for it in range(100):
+            (p0, p1) = (ones(n), u)
+            for j in range(2, n+1):
+                (p0, p1) = (p1, ((2*j-1)*u*p1 - (j-1)*p0)/j)
+            dp = n*(p0 - u*p1)/(1-u**2)
+            du = p1/dp
+            u = u - du
+            if abs(du).max() < 1e-15:
+                break
+        uw = array([u, 2/((1-u**2)*dp**2)])
+        _gauss_cache[n] = uw
+    return (uw[0], uw[1])
+
+
+_gauss_cache = Cache(size=8)
+
+
+class PTCache(Cache):
+    """LRU cache of the angular functions used by mie_S12.
+
+    Stores pi_n and tau_n, weighted by (2n+1)/(n(n+1)), for each set of
+    cosines. A table computed up to some nmax is sliced when a smaller nmax
+    is requested, and regrown (with some headroom, but to at most
+    _PT_MAX_SIZE elements per function) for a larger one.
+    """
+    def __init__(self, size=16, max_bytes=2**26):
+        super(PTCache, self).__init__(size=size, max_bytes=max_bytes)
+
+    def get_pt(self, u, nmax):
+        """The weighted (pi_n, tau_n) for the cosines u, n = 1...nmax.
+
+        The returned arrays are views of the cached tables and must not be
+        modified.
+        """
+        u = asarray(u, dtype=float)
+        key = (u.shape, u.tobytes())
+        table = self.get(key)
+        prof = mie_profile.active
+        if prof is not None:
+            prof.count("pt_cache.hit" if (table is not None) and
+                (table.shape[-1] >= nmax) else "pt_cache.miss")
+        if (table is None) or (table.shape[-1] < nmax):
+            nmax_table = nmax if table is None else \
+                max(nmax, min(int(1.5*table.shape[-1]),
+                _PT_MAX_SIZE//max(u.size,1)))
+            table = array(mie_pt(u,nmax_table))
+            n = arange(1, nmax_table+1, dtype=float)
+            table *= (2*n+1)/(n*(n+1))
+            self[key] = table
+        return (table[0,...,:nmax], table[1,...,:nmax])
+
+
+pt_cache = PTCache()
+
+
 def mie_pt(u,nmax):
-    u = float(u)
-    p = zeros(nmax, dtype=float)
-    p[0] = 1
-    p[1] = 3*u
-    t = zeros(nmax, dtype=float)
-    t[0] = u
-    t[1] = 6*u**2 - 3
+    """The angular functions pi_n and tau_n for n = 1...nmax.
+
+    If u is an array, the recurrence is computed simultaneously for all the
+    angles and the results are arrays of shape u.shape+(nmax,).
+    """
+    return mie_backend.active.mie_pt(u,nmax)
+
+
+def _mie_pt_numpy(u,nmax):
+    """The NumPy kernel of mie_pt.
+    """
+    u = asarray(u, dtype=float)
+    p = zeros(u.shape+(nmax,), dtype=float)
+    p[...,0] = 1
+    p[...,1] = 3*u
+    t = zeros(u.shape+(nmax,), dtype=float)
+    t[...,0] = u
+    t[...,1] = 6*u**2 - 3
 
     nn = arange(2,nmax,dtype=float)
     for n in nn:
         n_i = int(n)
-        p[n_i] = (2*n+1)/n*p[n_i-1]*u - (n+1)/n*p[n_i-2]
+        p[...,n_i] = (2*n+1)/n*p[...,n_i-1]*u - (n+1)/n*p[...,n_i-2]
 
-    t[2:] = (nn+1)*u*p[2:] - (nn+2)*p[1:-1]
+    uc = u[...,newaxis]
+    t[...,2:] = (nn+1)*uc*p[...,2:] - (nn+2)*p[...,1:-1]
 
     return (p,t)
+
+
+def _all_props_numpy(coeffs,y):
+    """The NumPy kernel for all the properties of one particle.
+
+    Returns:
+        A list of the properties in the order of PROP_NAMES.
+    """
+    if len(coeffs.an) <= _LOOP_ORDERS:
+        return _all_props_loop(coeffs.an, coeffs.bn, y)
+    values = _mie_props(coeffs, y, PROP_NAMES, {})
+    return [values[p] for p in PROP_NAMES]
+
+
+mie_backend.register_kernels("numpy", mie_pt=_mie_pt_numpy,
+    all_props=_all_props_numpy)
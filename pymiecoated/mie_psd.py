@@ -0,0 +1,142 @@
+"""
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from numpy import asarray, empty, exp, log, pi, sqrt, tensordot, zeros
+from .mie_batch import _batch_params, _size_chunks
+from .mie_coeffs import MieCoeffsBatch
+from .mie_props import mie_props, mie_S12, _gauss_legendre
+
+
+class ExponentialPSD(object):
+    """Exponential particle size distribution.
+
+    N(D) = N0 * exp(-Lambda*D)
+    """
+    def __init__(self, N0=1.0, Lambda=1.0):
+        self.N0 = N0
+        self.Lambda = Lambda
+
+    def __call__(self, D):
+        return self.N0*exp(-self.Lambda*asarray(D))
+
+
+class GammaPSD(object):
+    """Gamma particle size distribution.
+
+    N(D) = N0 * D**mu * exp(-Lambda*D)
+    """
+    def __init__(self, N0=1.0, Lambda=1.0, mu=0.0):
+        self.N0 = N0
+        self.Lambda = Lambda
+        self.mu = mu
+
+    def __call__(self, D):
+        D = asarray(D)
+        return self.N0*D**self.mu*exp(-self.Lambda*D)
+
+
+class LognormalPSD(object):
+    """Lognormal particle size distribution.
+
+    N(D) = Nt/(sqrt(2*pi)*log(sigma)*D) * exp(-log(D/D_g)**2/(2*log(sigma)**2))
+
+    Attributes:
+        Nt: The total number concentration.
+        D_g: The geometric mean diameter.
+        sigma: The geometric standard deviation (> 1).
+    """
+    def __init__(self, Nt=1.0, D_g=1.0, sigma=1.5):
+        self.Nt = Nt
+        self.D_g = D_g
+        self.sigma = sigma
+
+    def __call__(self, D):
+        D = asarray(D)
+        ls = log(self.sigma)
+        return self.Nt/(sqrt(2*pi)*ls*D) * exp(-log(D/self.D_g)**2/(2*ls**2))
+
+
+def bulk_props(psd, wl, m, D_max, D_min=0.0, m2=None, core_frac=None,
+    u=None, n_quad=128, chunk_size=256):
+    """Bulk scattering properties of a particle size distribution.
+
+    The properties are integrated over the diameter D with Gauss-Legendre
+    quadrature. The particles at all the quadrature nodes are computed
+    together with the batch coefficient routines, so the Bessel functions
+    and recurrences are evaluated for neighbouring sizes in the same
+    vectorized pass.
+
+    Args:
+        psd: The size distribution, a function returning N(D) for an array
+            of diameters (e.g. an instance of GammaPSD).
+        wl: The wavelength, in the same units as D.
+        m: The complex refractive index (of the core if m2 is given).
+        D_max, D_min: The integration limits.
+        m2: The refractive index of the shell for coated particles.
+        core_frac: The volume fraction of the core for coated particles.
+        u: If given, the cosines of the scattering angles where the bulk
+            phase function is evaluated.
+        n_quad: The number of quadrature nodes.
+        chunk_size: The number of particles computed simultaneously.
+
+    Returns:
+        A dict with the bulk cross sections per unit volume "ext", "sca",
+        "abs" and "bsc" (backscattering), the asymmetry parameter "asy",
+        and if u is given, the phase function "phase" normalized so that its
+        mean over the sphere is 1.
+    """
+    if (m2 is None) != (core_frac is None):
+        raise ValueError("Must specify both m2 and core_frac for coated " + \
+            "particles.")
+    (t, w) = _gauss_legendre(n_quad)
+    D = 0.5*(D_max-D_min)*(t+1)+D_min
+    wn = 0.5*(D_max-D_min)*w*psd(D)
+    w = wn*(pi*D**2/4)
+    k = 2*pi/wl
+    x = 0.5*k*D
+    if m2 is None:
+        (par, shape) = _batch_params(x=x, m=m)
+    else:
+        (par, shape) = _batch_params(x=x*core_frac**(1.0/3.0), y=x, m=m,
+            m2=m2)
+
+    q = dict((p,empty(n_quad)) for p in ("qext","qsca","qabs","qb","asy"))
+    if u is not None:
+        u = asarray(u, dtype=float)
+        s11 = zeros((n_quad,)+u.shape)
+    for ind in _size_chunks(par, chunk_size):
+        par_chunk = dict((p,v if v is None else v[ind])
+            for (p,v) in par.items())
+        coeffs = MieCoeffsBatch(par_chunk)
+        props = mie_props(coeffs, x[ind], tuple(q))
+        for p in q:
+            q[p][ind] = props[p]
+        if u is not None:
+            (S1, S2) = mie_S12(coeffs, u)
+            s11[ind] = 0.5*(abs(S1)**2+abs(S2)**2)
+
+    sca = (w*q["qsca"]).sum()
+    bulk = {"ext":(w*q["qext"]).sum(), "sca":sca, "abs":(w*q["qabs"]).sum(),
+        "bsc":(w*q["qb"]).sum(), "asy":(w*q["qsca"]*q["asy"]).sum()/sca}
+    if u is not None:
+        bulk["phase"] = 4*pi*tensordot(wn,s11,1)/(k**2*sca)
+
+    return bulk
@@ -0,0 +1,143 @@
+"""Refractive index models for water and ice at microwave frequencies.
+
+The models are evaluated for arrays of frequencies and temperatures, which
+are broadcast together, and the results for recently used inputs are kept
+in an LRU cache, so they can be called for every particle. The results
+can be given directly as m or m2 to Mie and to the batch functions, e.g.
+m_w = water_refractive_index(5.6e9, 273.15)
+mie_batch(x=x_core, y=x_shell, m=ice_refractive_index(5.6e9, 273.15),
+    m2=m_w)
+
+or, with wavelengths wl in meters, as a function for mie_spectral:
+mie_spectral(wl, r, lambda wl: water_refractive_index(c/wl, T))
+
+The permittivities follow the convention of Mie, with a positive imaginary
+part for absorbing media.
+
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from numpy import asarray, broadcast_arrays, exp, sqrt
+from .mie_aux import Cache
+from . import mie_profile
+
+
+def water_permittivity(freq, temp):
+    """The complex relative permittivity of liquid water.
+
+    Uses the double Debye model of Liebe et al. (Int. J. Infrared Millim.
+    Waves 12, 659, 1991), valid for frequencies up to 1 THz and
+    temperatures of about 250...320 K (including supercooled water).
+
+    Args:
+        freq: The frequency in Hz, a scalar or an array.
+        temp: The temperature in K, a scalar or an array.
+
+    Returns:
+        The permittivity, a complex number for scalar arguments and
+        otherwise a read-only array with the broadcast shape of the
+        arguments.
+    """
+    return _cached_model("water", freq, temp)
+
+
+def ice_permittivity(freq, temp):
+    """The complex relative permittivity of ice.
+
+    Uses the model of Mätzler (in Thermal Microwave Radiation:
+    Applications for Remote Sensing, IET, 2006), valid for frequencies of
+    0.01...300 GHz and temperatures below the melting point.
+
+    Args and Returns: See water_permittivity.
+    """
+    return _cached_model("ice", freq, temp)
+
+
+def water_refractive_index(freq, temp):
+    """The complex refractive index of liquid water; see
+    water_permittivity.
+    """
+    return _cached_model("water_m", freq, temp)
+
+
+def ice_refractive_index(freq, temp):
+    """The complex refractive index of ice; see ice_permittivity.
+    """
+    return _cached_model("ice_m", freq, temp)
+
+
+def _water_liebe(f, T):
+    f = f*1e-9
+    theta = 300.0/T - 1
+    eps0 = 77.66 + 103.3*theta
+    eps1 = 0.0671*eps0
+    eps2 = 3.52
+    gamma1 = 20.20 - 146.4*theta + 316.0*theta**2
+    gamma2 = 39.8*gamma1
+    return eps0 - f*((eps0-eps1)/(f+1j*gamma1) + (eps1-eps2)/(f+1j*gamma2))
+
+
+def _ice_matzler(f, T):
+    f = f*1e-9
+    theta = 300.0/T - 1
+    alpha = (0.00504 + 0.0062*theta)*exp(-22.1*theta)
+    e = exp(335.0/T)
+    beta = 0.0207/T*e/(e-1)**2 + 1.16e-11*f**2 + \
+        exp(-9.963 + 0.0372*(T-273.16))
+    return 3.1884 + 9.1e-4*(T-273.0) + 1j*(alpha/f + beta*f)
+
+
+_MODELS = {"water":_water_liebe, "ice":_ice_matzler,
+    "water_m":lambda f, T: sqrt(_water_liebe(f, T)),
+    "ice_m":lambda f, T: sqrt(_ice_matzler(f, T))}
+
+
+class ModelCache(Cache):
+    """LRU cache of the results of the refractive index models, keyed by
+    the model and the values of the arguments.
+    """
+    def __init__(self, size=256, max_bytes=2**26):
+        super(ModelCache, self).__init__(size=size, max_bytes=max_bytes)
+
+
+model_cache = ModelCache()
+
+
+def _cached_model(model, freq, temp):
+    if isinstance(freq, (int, float)) and isinstance(temp, (int, float)):
+        key = (model, float(freq), float(temp))
+    else:
+        (freq, temp) = broadcast_arrays(asarray(freq, dtype=float),
+            asarray(temp, dtype=float))
+        key = (model, freq.shape, freq.tobytes(), temp.tobytes())
+    value = model_cache.get(key)
+    prof = mie_profile.active
+    if prof is not None:
+        prof.count("model_cache.miss" if value is None else
+            "model_cache.hit")
+    if value is None:
+        value = _MODELS[model](asarray(freq, dtype=float),
+            asarray(temp, dtype=float))
+        if value.ndim == 0:
+            value = complex(value)
+        else:
+            value.setflags(write=False)
+        model_cache[key] = value
+    return value
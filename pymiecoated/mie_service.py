@@ -0,0 +1,427 @@
+"""A local scattering service.
+
+The server keeps one warm engine for many clients: requests arriving
+within a short window are computed together with mie_batch, identical
+requests are computed only once, and the results are kept in a shared LRU
+cache.
+
+Start a server with:
+python -m pymiecoated.mie_service [--host HOST] [--port PORT] [--unix PATH]
+
+and query it from asyncio code with:
+client = await MieClient.connect(port=port)
+props = await client.query(x=1.0, m=complex(1.5,0.1))
+await client.close()
+
+The protocol is newline-delimited JSON. A request is
+{"id": id, "params": {...}, "props": [...]} where params are the
+arguments of mie_batch for one particle, with complex numbers given as
+[real, imag]; the response is {"id": id, "result": {...}} or
+{"id": id, "error": message}.
+
+Copyright (C) 2012-2013 Jussi Leinonen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+the Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+from .mie_aux import Cache
+from .mie_batch import mie_stream, PROP_NAMES, _stream_record, _record_kind
+
+
+class MieServer(object):
+    """A scattering server that coalesces requests into batches.
+
+    Requests can be made in-process with compute() or over a socket after
+    start(). A request waits at most window seconds for others to be
+    computed with it, and at most max_batch requests are computed together.
+    At most max_pending requests are accepted at a time; further requests
+    wait, and a connection is not read from while its request waits, so
+    that clients writing faster than the server computes are slowed down.
+    Requests for particles with a size parameter larger than max_size are
+    rejected with a ValueError before they are queued.
+
+    Attributes:
+        window: The coalescing window in seconds.
+        max_batch: The maximum number of particles computed together.
+        max_size: The largest size parameter (x, y or of any layer)
+            accepted.
+        precision: Passed to mie_batch.
+        address: The address the server listens on after start(), either
+            (host, port) or the path of the Unix socket.
+    """
+    def __init__(self, window=0.002, max_batch=1024, max_pending=4096,
+        cache_size=100000, precision="double", max_size=1e4):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_size = max_size
+        self.precision = precision
+        self.address = None
+        self._max_pending = max_pending
+        self._slots = None
+        self._cache = Cache(size=cache_size)
+        self._pending = {}
+        self._queue = None
+        self._batcher = None
+        self._server = None
+        self._counts = dict.fromkeys(("requests", "computed", "batches",
+            "coalesced"), 0)
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        """Start listening on a TCP port of host, or on the Unix socket
+        path if given. With port=0 a free port is chosen (see address).
+
+        Returns:
+            The server.
+        """
+        if path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._handle_client, path=path)
+            self.address = path
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_client, host=host, port=port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+        return self
+
+    def close(self):
+        """Stop listening and computing. The requests still waiting for
+        their results fail with a ConnectionError.
+        """
+        if self._server is not None:
+            self._server.close()
+        if self._batcher is not None:
+            self._batcher.cancel()
+            self._batcher = None
+        _fail(self._pending.values(),
+            ConnectionError("The server was closed."))
+        self._pending.clear()
+
+    async def wait_closed(self):
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def serve_forever(self):
+        """Serve until the task is cancelled; start() must be called
+        first.
+        """
+        await self._server.serve_forever()
+
+    async def compute(self, params, props=PROP_NAMES):
+        """The scattering properties of one particle.
+
+        Args:
+            params: A record as accepted by mie_stream.
+            props: The names of the properties to return.
+
+        Returns:
+            A dict of the requested properties.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_pending)
+        async with self._slots:
+            result = await self._compute(params)
+        return dict((p,result[p]) for p in props)
+
+    def stats(self):
+        """The numbers of requests, particles computed, batches, requests
+        coalesced with an identical pending one, and the cache counters.
+        """
+        stats = dict(self._counts)
+        stats["cache"] = self._cache.stats()
+        return stats
+
+    async def _compute(self, params):
+        rec = _stream_record(params)
+        if _record_size(rec) > self.max_size:
+            raise ValueError("The size parameter exceeds the maximum " + \
+                "of {}.".format(self.max_size))
+        key = _record_key(rec)
+        self._counts["requests"] += 1
+        result = self._cache.get(key)
+        if result is not None:
+            return result
+        future = self._pending.get(key)
+        if future is not None:
+            self._counts["coalesced"] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            if self._batcher is None:
+                self._queue = asyncio.Queue()
+                self._batcher = asyncio.ensure_future(self._run_batches())
+            self._queue.put_nowait((key, rec))
+        return await asyncio.shield(future)
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # let the requests arriving within the window join the batch
+            await asyncio.sleep(self.window)
+            while (len(batch) < self.max_batch) and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._counts["batches"] += 1
+            self._counts["computed"] += len(batch)
+            try:
+                results = await loop.run_in_executor(None, _compute_records,
+                    [rec for (key, rec) in batch], self.precision)
+            except Exception as e:
+                # fail this batch only and keep serving the others
+                _fail([self._pending.pop(key) for (key, rec) in batch], e)
+                continue
+            for ((key, rec), result) in zip(batch, results):
+                future = self._pending.pop(key)
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    self._cache[key] = result
+                    future.set_result(result)
+
+    async def _handle_client(self, reader, writer):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_pending)
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # wait for a free slot before reading further requests
+                await self._slots.acquire()
+                task = asyncio.ensure_future(
+                    self._handle_request(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line, writer, lock):
+        req_id = None
+        try:
+            request = json.loads(line)
+            req_id = request.get("id")
+            props = request.get("props") or PROP_NAMES
+            if not set(props) <= set(PROP_NAMES):
+                raise ValueError("Unknown scattering property.")
+            result = await self._compute(_decode(request["params"]))
+            response = {"id":req_id,
+                "result":dict((p,result[p]) for p in props)}
+        except Exception as e:
+            response = {"id":req_id, "error":str(e)}
+        finally:
+            self._slots.release()
+        writer.write((json.dumps(response)+"\n").encode())
+        async with lock:
+            await writer.drain()
+
+
+def _compute_records(records, precision):
+    """Compute the properties of a list of records with mie_stream.
+
+    The records are sorted by kind so that they can be computed in as few
+    chunks as possible. If a record is invalid, the records are computed
+    separately and the error is returned in place of the result.
+
+    Returns:
+        A list with the dict of properties or the exception for each
+        record.
+    """
+    order = sorted(range(len(records)), key=lambda i: _record_kind(records[i]))
+    try:
+        results = list(mie_stream([records[i] for i in order],
+            chunk_size=len(records), precision=precision))
+    except (ValueError, TypeError) as e:
+        if len(records) == 1:
+            return [ValueError(str(e))]
+        return [_compute_records([rec], precision)[0] for rec in records]
+    out = [None]*len(records)
+    for (i, result) in zip(order, results):
+        out[i] = result
+    return out
+
+
+def _record_size(rec):
+    """The largest size parameter of a record.
+    """
+    sizes = [abs(float(rec[k])) for k in ("x", "y") if k in rec]
+    sizes.extend(abs(float(v)) for v in rec.get("x_layers", ()))
+    return max(sizes) if sizes else 0.0
+
+
+def _fail(futures, exception):
+    """Set the exception on the futures that are not done yet.
+    """
+    for future in futures:
+        if not future.done():
+            future.set_exception(exception)
+
+
+def _record_key(rec):
+    """A hashable key identifying the particle of a record.
+    """
+    return tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple)) else v)
+        for (k, v) in rec.items()))
+
+
+# The complex-valued parameters, and those given for each layer
+_COMPLEX_KEYS = ("m", "m2", "eps", "eps2", "mu")
+_LAYER_KEYS = ("m_layers", "eps_layers")
+
+
+def _encode(params):
+    """Convert the complex numbers of params to [real, imag] for JSON.
+    """
+    def enc(v):
+        v = complex(v)
+        return [v.real, v.imag]
+    params = dict((k, v) for (k, v) in params.items() if v is not None)
+    for k in params:
+        if k in _COMPLEX_KEYS:
+            params[k] = enc(params[k])
+        elif k in _LAYER_KEYS:
+            params[k] = [enc(v) for v in params[k]]
+        elif k == "x_layers":
+            params[k] = [float(v) for v in params[k]]
+        else:
+            params[k] = float(params[k])
+    return params
+
+
+def _decode(params):
+    """The inverse of _encode. Complex numbers can also be given as plain
+    real numbers.
+    """
+    def dec(v):
+        return complex(*v) if isinstance(v, list) else v
+    if not isinstance(params, dict):
+        raise ValueError("The parameters must be a JSON object.")
+    params = dict(params)
+    for k in params:
+        if k in _COMPLEX_KEYS:
+            params[k] = dec(params[k])
+        elif k in _LAYER_KEYS:
+            params[k] = [dec(v) for v in params[k]]
+    return params
+
+
+class MieClient(object):
+    """An asyncio client for MieServer.
+
+    Many queries can be made concurrently over one connection; they are
+    sent immediately and the responses are matched to them by id.
+    """
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count()
+        self._futures = {}
+        self._lock = asyncio.Lock()
+        self._reading = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=None, path=None):
+        """Connect to a server on a TCP port of host or on the Unix socket
+        path.
+
+        Returns:
+            A MieClient instance.
+        """
+        if path is not None:
+            (reader, writer) = await asyncio.open_unix_connection(path)
+        else:
+            (reader, writer) = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def query(self, props=PROP_NAMES, **params):
+        """The scattering properties of one particle.
+
+        Args:
+            props: The names of the properties to return.
+            params: The parameters of the particle as keyword arguments
+                of mie_batch for a single particle, e.g. x=1.0, m=1.5.
+
+        Returns:
+            A dict of the requested properties.
+        """
+        req_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[req_id] = future
+        request = {"id":req_id, "params":_encode(params),
+            "props":list(props)}
+        self._writer.write((json.dumps(request)+"\n").encode())
+        async with self._lock:
+            # waits while the server is not reading (backpressure)
+            await self._writer.drain()
+        return await future
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._reading.cancel()
+
+    async def _read_responses(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self._futures.pop(response["id"])
+            if "error" in response:
+                future.set_exception(ValueError(response["error"]))
+            else:
+                future.set_result(response["result"])
+        for future in self._futures.values():
+            future.set_exception(ConnectionError("The server closed the " + \
+                "connection."))
+        self._futures.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local scattering " + \
+        "service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", metavar="PATH",
+        help="listen on a Unix socket instead of a TCP port")
+    parser.add_argument("--window", type=float, default=0.002,
+        help="the coalescing window in seconds")
+    parser.add_argument("--precision", choices=("double","single"),
+        default="double")
+    parser.add_argument("--max-size", type=float, default=1e4,
+        help="the largest size parameter accepted")
+    args = parser.parse_args(argv)
+
+    async def serve():
+        server = MieServer(window=args.window, precision=args.precision,
+            max_size=args.max_size)
+        await server.start(host=args.host, port=args.port, path=args.unix)
+        print("Listening on {}".format(server.address))
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -22,8 +22,31 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import unittest
-from ..mie_coated import Mie
+from ..mie_coated import Mie, MieSolver
+from ..mie_batch import mie_batch, mie_spectral, mie_stream, mie_jacobian, \
+    _size_chunks, MAX_CHUNK_COEFFS
+from ..mie_props import pt_cache
+from .. import mie_props
+from ..mie_aux import Cache
+from .. import mie_coeffs
+from ..mie_lut import build_table, load_table
+from ..mie_parallel import mie_sweep
+from ..mie_service import MieServer, MieClient
+from .. import mie_service
+from .. import mie_refractive
+from ..mie_psd import ExponentialPSD, GammaPSD, LognormalPSD, bulk_props
+from ..benchmarks import run_benchmarks
+from .. import __version__
+from .. import mie_profile
+from .. import mie_backend
+import asyncio
+import json
+import numpy
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 
 #some allowance for rounding errors etc
@@ -36,11 +59,93 @@ def run_tests():
        Runs several tests that test the Mie code. All tests should return ok.
        If they don't, please contact the author.
     """
-    suite = unittest.TestLoader().loadTestsFromTestCase(MieTests)
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([loader.loadTestsFromTestCase(MieTests),
+        loader.loadTestsFromTestCase(MieNumbaTests)])
     unittest.TextTestRunner(verbosity=2).run(suite)
 
 
+def _layered_reference(x_layers, m_layers):
+    """An independent implementation of the multilayered sphere for the
+    tests: the radial functions psi_n+B*chi_n of each layer are matched at
+    the boundaries directly, with psi_n from its power series and chi_n
+    from the upward recurrence. This is accurate for |m*x| up to about 8.
+
+    Returns:
+        A tuple (qext, qsca, qb).
+    """
+    x = x_layers[-1]
+    nmax = int(round(2+x+4*x**(1.0/3.0))) + 5
+
+    def psi_chi(z):
+        #psi_n(z) = z*j_n(z) and chi_n(z) = z*y_n(z) for n = 0...nmax
+        psi = []
+        for n in range(nmax+1):
+            (term, total, k) = (1.0, 0.0, 0)
+            while True:
+                total += term
+                k += 1
+                term *= -z*z/(2*k*(2*n+2*k+1))
+                if abs(term) < 1e-17*abs(total):
+                    break
+            psi.append(total*z**(n+1)/numpy.prod(range(1,2*n+2,2)))
+        chi = [-numpy.cos(z), -numpy.cos(z)/z-numpy.sin(z)]
+        for n in range(1, nmax):
+            chi.append((2*n+1)/z*chi[n]-chi[n-1])
+        return (psi, chi)
+
+    def deriv(f, z, n):
+        return f[n-1]-n*f[n]/z
+
+    (an, bn) = ([], [])
+    for n in range(1, nmax+1):
+        #the ratios m*f'/f (TE, b_n) and f'/(m*f) (TM, a_n) at the outer
+        #boundary of each layer, starting from f = psi_n in the core
+        (ratio_te, ratio_tm) = (None, None)
+        for (i, (xl, m)) in enumerate(zip(x_layers, m_layers)):
+            if i > 0:
+                #match to the ratios of the inner layer at its boundary
+                z = m*x_layers[i-1]
+                (psi, chi) = psi_chi(z)
+                (p, dp, c, dc) = (psi[n], deriv(psi,z,n), chi[n],
+                    deriv(chi,z,n))
+                b_te = (ratio_te*p-m*dp)/(m*dc-ratio_te*c)
+                b_tm = (ratio_tm*m*p-dp)/(dc-ratio_tm*m*c)
+            else:
+                (b_te, b_tm) = (0.0, 0.0)
+            z = m*xl
+            (psi, chi) = psi_chi(z)
+            (p, dp, c, dc) = (psi[n], deriv(psi,z,n), chi[n], deriv(chi,z,n))
+            ratio_te = m*(dp+b_te*dc)/(p+b_te*c)
+            ratio_tm = (dp+b_tm*dc)/(m*(p+b_tm*c))
+        (psi, chi) = psi_chi(complex(x))
+        (p, dp) = (psi[n], deriv(psi,x,n))
+        xi = p+complex(0,1)*chi[n]
+        dxi = dp+complex(0,1)*deriv(chi,x,n)
+        an.append((dp-ratio_tm*p)/(dxi-ratio_tm*xi))
+        bn.append((dp-ratio_te*p)/(dxi-ratio_te*xi))
+
+    (an, bn) = (numpy.array(an), numpy.array(bn))
+    n = numpy.arange(1, nmax+1)
+    qext = 2.0/x**2*((2*n+1)*(an+bn).real).sum()
+    qsca = 2.0/x**2*((2*n+1)*(abs(an)**2+abs(bn)**2)).sum()
+    qb = abs(((2*n+1)*(-1)**n*(an-bn)).sum())**2/x**2
+    return (qext, qsca, qb)
+
+
 class MieTests(unittest.TestCase):
+    """The tests, run with the backend given by the attribute backend.
+    """
+    backend = "numpy"
+
+    def setUp(self):
+        self._previous_backend = mie_backend.get_backend()
+        mie_backend.set_backend(self.backend)
+        #make sure that the kernels are run instead of reading the cache
+        pt_cache.clear()
+
+    def tearDown(self):
+        mie_backend.set_backend(self._previous_backend)
 
     def test_single_nonmagnetic(self):
         mie = Mie(m=complex(1.5,0.5),x=2.5)
@@ -86,6 +191,67 @@ class MieTests(unittest.TestCase):
         self.assertLess(abs(S12_ref[1]-S12[1])/S12_ref[1], epsilon)
 
 
+    def test_multilayer(self):
+        mie = Mie(m_layers=[complex(1.5,0.5),complex(1.2,0.2),
+            complex(1.8,0.01)], x_layers=[1.0,2.5,4.0])
+
+        qext_ref = 3.9884566993104587
+        qsca_ref = 3.297181631028038
+        qabs_ref = 0.6912750682824207
+        qb_ref = 2.1342001328077207
+        asy_ref = 0.7325161708494929
+        qratio_ref = 0.6472801233404579
+
+        for (func,ref) in zip(
+            (mie.qext, mie.qsca, mie.qabs, mie.qb, mie.asy, mie.qratio),
+            (qext_ref,qsca_ref,qabs_ref,qb_ref,asy_ref,qratio_ref)):
+            self.assertLess(abs(ref-func())/ref, epsilon)
+
+        #three dissimilar layers: an absorbing core, a nearly transparent
+        #layer and a high-index shell, checked against an independent
+        #implementation, with the batch version giving the same results
+        x_layers = [0.8,2.2,3.5]
+        m_layers = [complex(2.5,1.5),complex(1.05,0.001),complex(1.9,0.3)]
+        mie = Mie(x_layers=x_layers, m_layers=m_layers)
+        props = mie_batch(x_layers=x_layers, m_layers=m_layers)
+        for (p,ref) in zip(("qext","qsca","qb"),
+            _layered_reference(x_layers, m_layers)):
+            self.assertLess(abs(getattr(mie, p)()-ref)/ref, 1e-9)
+        for (p,v) in props.items():
+            ref = getattr(mie, p)()
+            self.assertLess(abs(v-ref)/ref, epsilon)
+
+        #reduces to the coated and homogeneous spheres
+        m = (complex(1.5,0.5), complex(1.2,0.2))
+        mie_coated = Mie(m=m[0],m2=m[1],x=1.5,y=5.0)
+        for (x_layers, m_layers) in (([1.5,5.0], m), ([1.5,3.0,5.0],
+            m+m[1:]), ([0.0,1.5,1.5,5.0], m[:1]+m+m[1:])):
+            mie = Mie(x_layers=x_layers, m_layers=m_layers)
+            self.assertLess(abs(mie.qext()-mie_coated.qext()), epsilon)
+            self.assertLess(abs(mie.qb()-mie_coated.qb()), epsilon)
+        mie = Mie(x_layers=[2.0,5.0], m_layers=[m[1],m[1]])
+        self.assertLess(abs(mie.qext()-Mie(x=5.0,m=m[1]).qext()), epsilon)
+        #a zero-thickness outer layer is dropped
+        mie = Mie(x_layers=[2.0,2.0], m_layers=m)
+        qext_single = Mie(x=2.0,m=m[0]).qext()
+        self.assertLess(abs(mie.qext()-qext_single), epsilon)
+        props = mie_batch(x_layers=[2.0,2.0], m_layers=m)
+        self.assertLess(abs(props["qext"]-qext_single), epsilon)
+
+        #batch version, including a core of zero size
+        x_layers = numpy.array([[1.0,2.5,4.0], [0.0,2.5,4.0]])
+        props = mie_batch(x_layers=x_layers, m_layers=[complex(1.5,0.5),
+            complex(1.2,0.2),complex(1.8,0.01)])
+        self.assertLess(abs(props["qext"][0]-qext_ref)/qext_ref, epsilon)
+        qext_ref = Mie(m=complex(1.2,0.2),m2=complex(1.8,0.01),x=2.5,
+            y=4.0).qext()
+        self.assertLess(abs(props["qext"][1]-qext_ref)/qext_ref, epsilon)
+
+        self.assertRaises(ValueError, Mie, x_layers=[2.0,1.0])
+        mie = Mie(x=1.0,m=m[0],x_layers=[1.0,2.0],m_layers=m)
+        self.assertRaises(ValueError, mie.qext)
+
+
     def test_magnetic(self):
         mie = Mie(eps=complex(2.2,0.8),mu=complex(1.6,1.4),x=4.0)
 
@@ -156,5 +322,688 @@ class MieTests(unittest.TestCase):
         self.assertRaises(ValueError, mie.qext)
 
 
+    def test_batch(self):
+        props = ("qext", "qsca", "qabs", "qb", "asy", "qratio")
+        m = numpy.array([complex(1.5,0.5), complex(1.33,0.01)])
+        x = numpy.array([[2.5], [0.1], [12.0]])
+        batch = mie_batch(x=x, m=m)
+        mie = Mie()
+        for (i,j) in numpy.ndindex(x.shape[0], m.shape[0]):
+            mie.x = x[i,0]
+            mie.m = m[j]
+            for p in props:
+                ref = getattr(mie,p)()
+                self.assertLess(abs(ref-batch[p][i,j])/ref, epsilon)
+
+        x = numpy.array([0.0, 1.5, 1.0, 2.0])
+        y = numpy.array([5.0, 5.0, 1.0, 3.0])
+        batch = mie_batch(x=x, y=y, m=complex(1.5,0.5), m2=complex(1.2,0.2))
+        mie = Mie(m=complex(1.5,0.5), m2=complex(1.2,0.2))
+        for i in range(len(x)):
+            mie.x = x[i]
+            mie.y = y[i]
+            for p in props:
+                ref = getattr(mie,p)()
+                self.assertLess(abs(ref-batch[p][i])/ref, epsilon)
+
+        batch = mie_batch(x=[0.0, 1.0], m=complex(1.5,0.5))
+        for p in props:
+            self.assertEqual(batch[p][0], 0.0)
+
+
+    def test_S12_array(self):
+        mie = Mie(m=complex(1.5,0.5),m2=complex(1.2,0.2),x=1.5,y=5.0)
+        u = numpy.array([[-1.0, -0.6], [0.3, 1.0]])
+        (S1, S2) = mie.S12(u)
+        self.assertEqual(S1.shape, u.shape)
+        for i in numpy.ndindex(u.shape):
+            S12_ref = mie.S12(u[i])
+            self.assertLess(abs(S12_ref[0]-S1[i])/abs(S12_ref[0]), epsilon)
+            self.assertLess(abs(S12_ref[1]-S2[i])/abs(S12_ref[1]), epsilon)
+        self.assertRaises(ValueError, mie.S12, numpy.array([0.5, 1.5]))
+
+
+    def test_pt_cache(self):
+        u = numpy.linspace(-1.0, 1.0, 7)
+        mie_small = Mie(m=complex(1.5,0.5),x=2.5)
+        mie_large = Mie(m=complex(1.5,0.5),x=25.0)
+        pt_cache.clear()
+        S12_ref = (mie_small.S12(u), mie_large.S12(u))
+        pt_cache.clear()
+        #the table computed for the larger particle is sliced for the smaller
+        S12 = (mie_large.S12(u), mie_small.S12(u))[::-1]
+        for (ref, S) in zip(S12_ref, S12):
+            for i in range(2):
+                self.assertLess(abs(ref[i]-S[i]).max()/abs(ref[i]).max(),
+                    epsilon)
+
+        #the headroom of a regrown table is limited by _PT_MAX_SIZE
+        self.assertEqual(pt_cache.max_bytes, 2**26)
+        pt_size = mie_props._PT_MAX_SIZE
+        mie_props._PT_MAX_SIZE = 7*40
+        try:
+            pt_cache.clear()
+            pt_cache.get_pt(u, 30)
+            (pin, tin) = pt_cache.get_pt(u, 35)
+        finally:
+            mie_props._PT_MAX_SIZE = pt_size
+        self.assertEqual(pin.shape, (7,35))
+        self.assertEqual(pt_cache.nbytes, 2*7*40*8)
+        pt_cache.clear()
+
+
+    def test_backend_import(self):
+        #the module of an optional backend is imported on first use
+        code = "import sys; import pymiecoated; " + \
+            "print(pymiecoated.get_backend(), 'numba' in sys.modules); " + \
+            "pymiecoated.Mie(x=1.0, m=1.5).qext(); " + \
+            "print('numba' in sys.modules)"
+        env = dict(os.environ, PYMIECOATED_BACKEND="auto")
+        out = subprocess.check_output([sys.executable, "-c", code],
+            env=env, cwd=os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))))
+        (backend, before, after) = out.decode().split()
+        self.assertEqual(before, "False")
+        self.assertEqual(after, str(backend == "numba"))
+
+
+    def test_cache(self):
+        cache = Cache(size=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        self.assertEqual(cache.get("a"), 1)
+        cache["c"] = 3 #evicts b, the least recently used
+        self.assertTrue("b" not in cache)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), 3)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"],
+            stats["entries"]), (2, 1, 1, 2))
+
+        cache = Cache(size=None, max_bytes=250)
+        for k in range(3):
+            cache[k] = numpy.zeros(10) #80 bytes each
+        cache[3] = numpy.zeros(10)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 240)
+
+        #None means no limit, even if a default limit is set
+        default_size = Cache.default_size
+        Cache.default_size = 1
+        try:
+            self.assertEqual(Cache().size, 1)
+            self.assertEqual(Cache(size=None).size, None)
+            mie = Mie(m=complex(1.5,0.5), cache_size=None)
+            for x in (1.0, 2.0, 3.0):
+                mie.x = x
+                mie.qext()
+            self.assertEqual(mie.cache_stats()["entries"], 3)
+            self.assertEqual(mie.cache_stats()["evictions"], 0)
+            self.assertEqual(MieSolver(cache_size=None)._cache.size, None)
+            self.assertEqual(MieSolver()._cache.size, 1)
+        finally:
+            Cache.default_size = default_size
+
+        mie = Mie(m=complex(1.5,0.5), cache_size=1)
+        for x in (1.0, 2.0, 1.0, 1.0):
+            mie.x = x
+            mie.qext()
+        stats = mie.cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]),
+            (1, 3, 2))
+
+
+    def test_shared_cache(self):
+        cache = mie_coeffs.enable_shared_cache(x_digits=6)
+        try:
+            qext_ref = Mie(m=complex(1.5,0.5),x=2.5).qext()
+            mie = Mie(m=complex(1.5,0.5),x=2.5+1e-9)
+            #same coefficients, normalized with the unquantized size
+            self.assertLess(abs(mie.qext()-qext_ref)/qext_ref, 1e-8)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            batch = mie_batch(x=[2.5, 3.0, 3.0], m=complex(1.5,0.5))
+            self.assertEqual(batch["qext"][0], qext_ref)
+            self.assertEqual(batch["qext"][1], batch["qext"][2])
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(mie_batch(x=3.0, m=complex(1.5,0.5))["qext"],
+                batch["qext"][1])
+        finally:
+            mie_coeffs.disable_shared_cache()
+
+
+    def test_lookup_table(self):
+        x = numpy.linspace(0.5, 3.0, 6)
+        m_re = numpy.array([1.3, 1.5])
+        def params(x, m_re):
+            return {"x":x, "m":m_re+complex(0,0.5)}
+        table = build_table([("x",x), ("m_re",m_re)], params,
+            props=("qext","qb"))
+        self.assertEqual(table.props["qb"].shape, (6,2))
+
+        mie = Mie(x=x[2], m=complex(1.5,0.5))
+        self.assertLess(abs(table.interp("qb", x=x[2], m_re=1.5)-mie.qb()) /
+            mie.qb(), epsilon)
+        qext_mid = table.props["qext"][1:3,:].mean()
+        qext = table.interp("qext", x=0.5*(x[1]+x[2]), m_re=[[1.3,1.4]])
+        self.assertEqual(qext.shape, (1,2))
+        self.assertLess(abs(qext[0,1]-qext_mid), epsilon)
+        self.assertRaises(ValueError, table.interp, "qext", x=4.0, m_re=1.4)
+
+        path = tempfile.mkdtemp()
+        try:
+            table.save(path)
+            table2 = load_table(path)
+            self.assertEqual([n for (n,v) in table2.axes], ["x","m_re"])
+            self.assertTrue(isinstance(table2.props["qb"], numpy.memmap))
+            self.assertTrue((table2.props["qb"] == table.props["qb"]).all())
+            self.assertEqual(table2.interp("qext", x=2.2, m_re=1.35),
+                table.interp("qext", x=2.2, m_re=1.35))
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_sweep(self):
+        x = numpy.array([[3.0, 0.0, 1.0], [2.0, 5.0, 0.5]])
+        ref = mie_batch(x=x, y=1.5*x, m=complex(1.5,0.5),
+            m2=complex(1.2,0.2), chunk_size=2)
+        sweep = mie_sweep(x=x, y=1.5*x, m=complex(1.5,0.5),
+            m2=complex(1.2,0.2), processes=2, chunk_size=2, min_parallel=0)
+        for p in ref:
+            self.assertEqual(sweep[p].shape, x.shape)
+            self.assertTrue((sweep[p] == ref[p]).all())
+
+
+    def test_bulk_props(self):
+        (u, wu) = numpy.polynomial.legendre.leggauss(100)
+        for psd in (ExponentialPSD(N0=1e3, Lambda=2.0),
+            GammaPSD(N0=1e3, Lambda=3.0, mu=2.0),
+            LognormalPSD(Nt=1e3, D_g=0.8, sigma=1.4)):
+
+            bulk = bulk_props(psd, 3.0, complex(1.33,0.01), D_max=4.0, u=u,
+                n_quad=32)
+            #compare to direct summation over the same quadrature
+            (t, w) = numpy.polynomial.legendre.leggauss(32)
+            D = 2.0*(t+1)
+            mie = Mie(m=complex(1.33,0.01))
+            ext = 0.0
+            for (Di, wi) in zip(D, w):
+                mie.x = numpy.pi*Di/3.0
+                ext += 2.0*wi*psd(Di)*mie.qext()*numpy.pi*Di**2/4
+            self.assertLess(abs(bulk["ext"]-ext)/ext, epsilon)
+            self.assertLess(abs(bulk["ext"]-bulk["sca"]-bulk["abs"]) /
+                bulk["ext"], epsilon)
+            #phase function normalization and asymmetry parameter
+            self.assertLess(abs(0.5*(wu*bulk["phase"]).sum()-1), 1e-10)
+            self.assertLess(abs(0.5*(wu*u*bulk["phase"]).sum()-bulk["asy"]),
+                1e-10)
+
+        self.assertRaises(ValueError, bulk_props, GammaPSD(), 3.0,
+            complex(1.33,0.01), 4.0, m2=complex(1.7,0.01))
+
+
+    def test_spectral(self):
+        wl = numpy.array([0.4, 0.55, 0.7, 1.0])
+        def m(wl):
+            return 1.5+0.01/wl + complex(0,0.01)*wl
+        spec = mie_spectral(wl, 0.3, m, r2=0.5, m2=complex(1.33,0.001))
+        mie = Mie(m2=complex(1.33,0.001))
+        for (i,wli) in enumerate(wl):
+            mie.m = m(wli)
+            mie.x = 2*numpy.pi*0.3/wli
+            mie.y = 2*numpy.pi*0.5/wli
+            self.assertLess(abs(spec["qb"][i]-mie.qb())/mie.qb(), 1e-10)
+        spec = mie_spectral(wl, 0.3, m(wl))
+        mie = Mie(x=2*numpy.pi*0.3/wl[1], m=m(wl[1]))
+        self.assertLess(abs(spec["qext"][1]-mie.qext())/mie.qext(), epsilon)
+
+
+    def test_benchmarks(self):
+        report = run_benchmarks(sizes=(1.0,), min_time=0.0,
+            names=("mie_props", "Mie_cached"))
+        report = json.loads(json.dumps(report))
+        self.assertEqual([r["name"] for r in report["results"]],
+            ["mie_props", "Mie_cached"])
+        self.assertEqual(report["backend"], self.backend)
+        self.assertEqual(report["pymiecoated"], __version__)
+        for r in report["results"]:
+            self.assertTrue(r["calls_per_sec"] > 0)
+
+
+    def test_profiling(self):
+        mie = Mie(m=complex(1.5,0.5),m2=complex(1.2,0.2),x=1.5,y=5.0)
+        with mie_profile.profiling() as prof:
+            mie.qext()
+            mie.qb()
+        self.assertTrue(mie_profile.active is None)
+        mie.x = 1.0
+        mie.qext() #not recorded
+        stats = prof.to_dict()
+        self.assertEqual(stats["counts"],
+            {"Mie.cache_miss":1, "Mie.cache_hit":1})
+        #the properties are computed separately when requested
+        self.assertEqual(stats["timings"]["mie_props"]["calls"], 2)
+        self.assertEqual(
+            stats["timings"]["coated_mie_coeff.bessel"]["calls"], 1)
+        self.assertEqual(stats["distributions"]["nmax"]["max"], 14)
+
+        #the distributions are summarized as the values come in
+        prof = mie_profile.Profiler()
+        for v in range(1, 10001):
+            prof.observe("n", v)
+        dist = prof.to_dict()["distributions"]["n"]
+        self.assertEqual((dist["count"], dist["min"], dist["max"]),
+            (10000, 1, 10000))
+        self.assertAlmostEqual(dist["mean"], 5000.5)
+        self.assertEqual(len(dist["histogram"]), 14)
+        self.assertEqual(dist["histogram"][8], 8)
+        self.assertEqual(sum(dist["histogram"].values()), 10000)
+
+
+    def test_term_cache(self):
+        self.assertTrue(mie_coeffs.term_cache is None)
+        term_cache = mie_coeffs.enable_term_cache()
+        try:
+            mie = Mie(m=complex(1.5,0.5),m2=complex(1.2,0.2),x=1.5,y=5.0)
+            mie.qext()
+            with mie_profile.profiling() as prof:
+                # only the terms of w = m2*y and of y are recomputed
+                for y in (4.0, 3.0):
+                    mie.y = y
+                    qext = mie.qext()
+            counts = prof.to_dict()["counts"]
+            self.assertEqual(counts["term_cache.miss"], 2*3)
+            term_cache.clear()
+            self.assertLess(abs(qext-mie.qext()), 1e-14*qext)
+
+            # changing eps of a homogeneous sphere reuses the functions of x
+            mie = Mie(m=complex(1.5,0.5),x=10.0)
+            mie.qext()
+            mie.m = complex(1.33,0.01)
+            stats = term_cache.stats()
+            qsca = mie.qsca()
+            self.assertEqual(term_cache.stats()["hits"], stats["hits"]+1)
+            mie_coeffs.disable_term_cache()
+            self.assertEqual(qsca, Mie(m=complex(1.33,0.01),x=10.0).qsca())
+
+            # the terms of one backend are not used with another
+            mie_coeffs.enable_term_cache()
+            Mie(m=complex(1.5,0.5),x=10.0).qext()
+            self.assertTrue(len(mie_coeffs.term_cache) > 0)
+            for name in mie_backend.available_backends():
+                if name != self.backend:
+                    with mie_backend.backend(name):
+                        self.assertEqual(len(mie_coeffs.term_cache), 0)
+        finally:
+            mie_coeffs.disable_term_cache()
+
+
+    def test_lazy_props(self):
+        mie = Mie(m=complex(1.5,0.5),x=3.0)
+        full = mie_props.mie_props(mie_coeffs.MieCoeffs({"eps":mie.eps,
+            "mu":1.0, "x":3.0, "y":None, "eps2":None}), 3.0)
+        self.assertEqual(mie.qext(), full["qext"])
+        self.assertEqual(mie.asy(), full["asy"])
+        #qabs is derived from the memoized qext and qsca
+        mie._get_scatt_props()._coeffs = None
+        self.assertEqual(mie.qabs(), full["qabs"])
+
+        props = mie_batch(x=[0.0,1.0,3.0], m=complex(1.5,0.5),
+            props=("qb","qratio"))
+        self.assertEqual(sorted(props), ["qb","qratio"])
+        self.assertEqual(props["qratio"][2], full["qratio"])
+        self.assertEqual(props["qb"][0], 0.0)
+        self.assertRaises(ValueError, mie_batch, x=1.0, m=1.5,
+            props=("qbsc",))
+
+        mie = Mie(m=complex(1.5,0.5),x=0.0)
+        self.assertEqual(mie.qext(), 0.0)
+        self.assertEqual(mie.asy(), 0.0)
+
+
+    def test_mueller(self):
+        for par in ({"x":3.0, "m":complex(1.5,0.1)},
+            {"x":1.0, "y":12.0, "m":complex(1.5,0.5), "m2":1.33}):
+            mie = Mie(**par)
+            y = par.get("y", par["x"])
+            (S11, S12, S33, S34) = mie.mueller(numpy.array([-1.0, 0.3]))
+            #pure (non-depolarizing) scattering matrix
+            self.assertLess(abs(S11**2-S12**2-S33**2-S34**2).max(),
+                1e-12*S11.max()**2)
+            self.assertLess(abs(4*S11[0]/y**2-mie.qb()), 1e-12*mie.qb())
+
+            chi = mie.legendre_moments()
+            self.assertEqual(len(chi), 2*int(round(2+y+4*y**(1.0/3.0)))+1)
+            self.assertLess(abs(chi[0]-1), 1e-14)
+            self.assertLess(abs(chi[1]-mie.asy()), 1e-13)
+            #reconstruct the phase function from the moments
+            u = numpy.linspace(-1, 1, 7)
+            p = numpy.polynomial.legendre.legval(u,
+                (2*numpy.arange(len(chi))+1)*chi)
+            self.assertLess(abs(p-4*mie.mueller(u)[0]/(y**2*mie.qsca())).max(),
+                1e-10*p.max())
+            self.assertEqual(len(mie.legendre_moments(4)), 4)
+
+        coeffs = mie_coeffs.MieCoeffsBatch({"eps":[2.25,2.25], "mu":None,
+            "x":numpy.array([1.0,3.0]), "y":None, "eps2":None})
+        chi = mie_props.mie_legendre(coeffs, 3)
+        self.assertLess(abs(chi[1,1]-Mie(x=3.0,m=1.5).asy()), 1e-13)
+
+        #the same moments in small chunks of nodes, which are not cached
+        pt_cache.clear()
+        legendre_nodes = mie_props._LEGENDRE_NODES
+        mie_props._LEGENDRE_NODES = 4
+        try:
+            chi_chunks = mie_props.mie_legendre(coeffs)
+        finally:
+            mie_props._LEGENDRE_NODES = legendre_nodes
+        chi = mie_props.mie_legendre(coeffs)
+        self.assertLess(abs(chi_chunks-chi).max(), 1e-14)
+        self.assertEqual(len(pt_cache), 0)
+
+
+    def test_single_precision(self):
+        #the reference cases of the tests above in single precision; the
+        #relative errors are about 1e-7...1e-6 (the coefficients of all but
+        #the first are computed in double precision and converted)
+        cases = ({"x":2.5, "m":complex(1.5,0.5)},
+            {"x":1.5, "y":5.0, "m":complex(1.5,0.5), "m2":complex(1.2,0.2)},
+            {"x_layers":[1.0,2.5,4.0], "m_layers":[complex(1.5,0.5),
+                complex(1.2,0.2),complex(1.8,0.01)]},
+            {"x":0.05, "m":complex(1.5,0.5)}) #computed in double precision
+        for par in cases:
+            props = mie_batch(**par)
+            props_single = mie_batch(precision="single", **par)
+            for p in props:
+                self.assertEqual(props_single[p].dtype, numpy.float32)
+                self.assertLess(abs(props_single[p]-props[p])/props[p],
+                    1e-5)
+
+        #the documented bound: errors below 1e-4*qext (1e-4 for asy), also
+        #near the sharp resonances of large weakly absorbing particles
+        sweeps = [{"x":numpy.linspace(0.5, 900.0, 3000),
+            "m":complex(1.5,1e-6)}]
+        for m in (4.0, complex(1.78,0.003), complex(1.33,0.02),
+            complex(8.33,2.22)):
+            sweeps.append({"x":numpy.linspace(0.5, 200.0, 3000), "m":m})
+        y = numpy.linspace(1.0, 40.0, 1000)
+        sweeps.append({"x":0.9*y, "y":y, "m":complex(1.78,0.003),
+            "m2":complex(1.33,1e-6)})
+        for par in sweeps:
+            with numpy.errstate(all="ignore"):
+                props = mie_batch(**par)
+                props_single = mie_batch(precision="single", **par)
+            for p in ("qext", "qsca", "qb"):
+                self.assertLess((abs(props_single[p]-props[p]) /
+                    props["qext"]).max(), 1e-4)
+            self.assertLess(abs(props_single["asy"]-props["asy"]).max(),
+                1e-4)
+
+        coeffs = mie_coeffs.MieCoeffsBatch({"eps":[2.25,2.25], "mu":None,
+            "x":numpy.array([0.5,3.0]), "y":None, "eps2":None},
+            precision="single")
+        self.assertEqual(coeffs.an.dtype, numpy.complex64)
+        self.assertRaises(ValueError, mie_batch, x=1.0, m=1.5,
+            precision="half")
+
+
+    def test_stream(self):
+        m = (complex(1.5,0.5), complex(1.2,0.2))
+        records = [(0.5*i, m[0]) for i in range(7)] + \
+            [(1.5, m[0], 5.0, m[1]), {"x":1.5, "y":5.0, "eps":m[0]**2,
+            "eps2":m[1]**2}, {"x_layers":[1.5,5.0], "m_layers":m},
+            (2.5, m[0])]
+        read = []
+        def reader():
+            for rec in records:
+                read.append(rec)
+                yield rec
+
+        stream = mie_stream(reader(), chunk_size=3, props=("qext","qb"))
+        props = next(stream)
+        self.assertEqual(len(read), 4) #one chunk and the record ending it
+        props = [props] + list(stream)
+        self.assertEqual(len(props), len(records))
+        self.assertEqual(props[0], {"qext":0.0, "qb":0.0})
+        for (rec, p) in zip(records[1:], props[1:]):
+            if isinstance(rec, dict):
+                mie = Mie(**rec)
+            else:
+                mie = Mie(**dict(zip(("x","m","y","m2"), rec)))
+            self.assertLess(abs(p["qext"]-mie.qext()), epsilon)
+            self.assertLess(abs(p["qb"]-mie.qb()), epsilon)
+        self.assertRaises(ValueError, list, mie_stream([(1.0,)]))
+
+
+    def test_service(self):
+        m = (complex(1.5,0.5), complex(1.2,0.2))
+        queries = [{"x":0.5*i, "m":m[0]} for i in range(10)]*3 + \
+            [{"x":1.5, "y":5.0, "m":m[0], "m2":m[1]},
+            {"x_layers":[1.0,2.5,4.0], "m_layers":m+(1.33,)}]
+
+        async def run():
+            server = await MieServer(window=0.05).start()
+            try:
+                client = await MieClient.connect(*server.address)
+                results = await asyncio.gather(*[client.query(**q)
+                    for q in queries])
+                with self.assertRaises(ValueError):
+                    await client.query(x=-1.0, m=m[0])
+                cached = await server.compute((0.5, m[0]), props=("qb",))
+                await client.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return (results, cached, server.stats())
+
+        (results, cached, stats) = asyncio.run(run())
+        for (q, r) in zip(queries, results):
+            mie = Mie(**q)
+            self.assertLess(abs(r["qext"]-mie.qext()), epsilon)
+            self.assertLess(abs(r["asy"]-mie.asy()), epsilon)
+        self.assertEqual(cached, {"qb":results[1]["qb"]})
+        #the duplicates are coalesced and the rest computed in few batches
+        self.assertEqual(stats["computed"], 13)
+        self.assertEqual(stats["coalesced"], 20)
+        self.assertLessEqual(stats["batches"], 3)
+
+
+    def test_service_errors(self):
+        m = complex(1.5,0.5)
+
+        def broken(records, precision):
+            raise RuntimeError("broken batch")
+
+        async def run():
+            server = await MieServer(window=0.01, max_size=100.0).start()
+            try:
+                client = await MieClient.connect(*server.address)
+                with self.assertRaises(ValueError):
+                    await client.query(x=1e3, m=m)
+                #a failing batch does not stop the following ones
+                compute_records = mie_service._compute_records
+                mie_service._compute_records = broken
+                try:
+                    with self.assertRaises(ValueError):
+                        await client.query(x=1.0, m=m)
+                finally:
+                    mie_service._compute_records = compute_records
+                result = await client.query(x=1.0, m=m)
+                await client.close()
+                #the requests still waiting fail when the server is closed
+                server.window = 10.0
+                task = asyncio.ensure_future(server.compute((2.0, m)))
+                await asyncio.sleep(0.01)
+            finally:
+                server.close()
+                await server.wait_closed()
+            with self.assertRaises(ConnectionError):
+                await task
+            return result
+
+        result = asyncio.run(run())
+        self.assertLess(abs(result["qext"]-Mie(x=1.0, m=m).qext()), epsilon)
+
+
+    def test_jacobian(self):
+        h = 1e-6
+        particles = [{"x":0.5, "m":complex(1.5,0.01)},
+            {"x":12.0, "m":complex(1.33,0.5)},
+            {"x":0.8, "y":1.5, "m":complex(1.78,0.003), "m2":complex(7,2)},
+            {"x":3.0, "y":4.0, "m":complex(1.5,0.1), "m2":complex(1.33,0.01)}]
+        for par in particles:
+            (values, jac) = mie_jacobian(**par)
+            for (name, d) in jac["qb"].items():
+                key = name.split("_")[0]
+                step = complex(0,h) if name.endswith("imag") else h
+                par1 = dict(par, **{key:par[key]+step})
+                par0 = dict(par, **{key:par[key]-step})
+                for p in values:
+                    (q1, q0) = (getattr(Mie(**par1), p)(),
+                        getattr(Mie(**par0), p)())
+                    self.assertLess(abs((q1-q0)/(2*h)-jac[p][name]),
+                        1e-6*(1+abs(jac[p][name])))
+        #batch input with zero-size particles and cores
+        (values, jac) = mie_jacobian(x=[0.0,0.0,1.0], y=[0.0,2.0,2.0],
+            m=complex(1.5,0.1), m2=complex(1.33,0.01), props=("qext",))
+        self.assertEqual(jac["qext"]["y"][0], 0.0)
+        self.assertEqual(jac["qext"]["m_real"][1], 0.0)
+        mie = Mie(x=2.0, m=complex(1.33,0.01))
+        self.assertLess(abs(values["qext"][1]-mie.qext()), epsilon)
+        (values, jac_shell) = mie_jacobian(x=2.0, m=complex(1.33,0.01))
+        self.assertLess(abs(jac["qext"]["y"][1]-jac_shell["qext"]["x"]),
+            epsilon)
+        self.assertRaises(ValueError, mie_coeffs.mie_coeffs_jac,
+            {"x":1.0, "eps":2.25, "mu":complex(1.1,0.1)})
+
+
+    def test_solver(self):
+        solver = MieSolver(cache_size=4)
+        m = (complex(1.5,0.5), complex(1.2,0.2))
+        for (x, y) in ((0.0, None), (0.3, None), (80.0, None), (1.0, 1.0),
+            (0.0, 2.0), (1.5, 5.0)):
+            m2 = None if y is None else m[1]
+            result = solver.solve(x, m[0], y, m2)
+            mie = Mie(x=x, m=m[0]) if y is None else \
+                Mie(x=x, m=m[0], y=y, m2=m2)
+            for (p, v) in result.as_dict().items():
+                self.assertLess(abs(v-getattr(mie, p)()), epsilon)
+            self.assertEqual(result.qb, result.values[3])
+        self.assertIs(solver.solve(1.5, m[0], 5.0, m[1]), result)
+        self.assertEqual(solver.cache_stats()["hits"], 1)
+        self.assertEqual(solver.cache_stats()["nbytes"], 4*result.nbytes)
+        self.assertRaises(AttributeError, setattr, result, "qext", 1.0)
+        self.assertRaises(ValueError, solver.solve, 2.0, m[0], 1.0, m[1])
+        self.assertRaises(ValueError, solver.solve, 1.0, m[0], 2.0)
+        #a vanishing scattering efficiency gives nan for the ratios, as Mie
+        with numpy.errstate(all="ignore"):
+            result = solver.solve(1e-120, 1.5)
+            mie = Mie(x=1e-120, m=1.5)
+            for (p, v) in result.as_dict().items():
+                ref = getattr(mie, p)()
+                if p in ("asy", "qratio"):
+                    self.assertTrue(numpy.isnan(v) and numpy.isnan(ref))
+                else:
+                    self.assertEqual(v, ref)
+
+
+    def test_refractive_index(self):
+        #close to the values of the melting hail demo at 5.6 GHz and 0 C
+        m_w = mie_refractive.water_refractive_index(5.6e9, 273.15)
+        m_i = mie_refractive.ice_refractive_index(5.6e9, 273.15)
+        self.assertTrue(isinstance(m_w, complex))
+        self.assertLess(abs(m_w-complex(8.33,2.22)), 0.01)
+        self.assertLess(abs(m_i.real-1.785), 0.001)
+        self.assertLess(abs(m_i.imag-1.7e-4), 0.2e-4)
+        eps = mie_refractive.water_permittivity(5.6e9, 273.15)
+        self.assertLess(abs(eps-m_w**2), epsilon)
+
+        freq = numpy.array([1e9, 10e9, 94e9])
+        temp = numpy.array([[253.15], [273.15], [293.15]])
+        mie_refractive.model_cache.clear()
+        mie_refractive.model_cache.reset_stats()
+        m = mie_refractive.water_refractive_index(freq, temp)
+        self.assertEqual(m.shape, (3,3))
+        self.assertEqual(m[1,1], mie_refractive.water_refractive_index(
+            10e9, 273.15))
+        self.assertIs(mie_refractive.water_refractive_index(freq, temp), m)
+        self.assertEqual(mie_refractive.model_cache.stats()["hits"], 1)
+        self.assertRaises(ValueError, m.__setitem__, (0,0), 1.0)
+        #the absorption of ice grows with temperature, and with frequency
+        #above its minimum at about 1 GHz
+        m = mie_refractive.ice_refractive_index(freq, temp-20)
+        self.assertTrue((numpy.diff(m.imag, axis=0) > 0).all())
+        self.assertTrue((numpy.diff(m.imag[:,1:], axis=1) > 0).all())
+        #the results can be given directly to the batch functions
+        m_w = mie_refractive.water_refractive_index(freq, temp)
+        qb = mie_batch(x=0.5, y=1.0, m=m, m2=m_w)["qb"]
+        self.assertEqual(qb.shape, (3,3))
+        mie = Mie(x=0.5, y=1.0, m=m[1,1], m2=m_w[1,1])
+        self.assertLess(abs(qb[1,1]-mie.qb()), epsilon)
+
+
+    def test_riccati_bessel(self):
+        try:
+            import scipy.special
+        except ImportError:
+            self.skipTest("SciPy is not available")
+        z = numpy.array([0.1, 1.0, 10.0, 200.0, complex(1.5,0.5),
+            complex(30.0,-2.0), complex(5.0,50.0)])
+        (psi, chi) = mie_coeffs.riccati_bessel(z, 60)
+        (psi_ref, chi_ref) = mie_coeffs.riccati_bessel_scipy(z, 60)
+        for (f, f_ref) in ((psi, psi_ref), (chi, chi_ref)):
+            ok = numpy.isfinite(f_ref) & (abs(f_ref) < 1e100)
+            self.assertLess((abs(f-f_ref)/abs(f_ref))[ok].max(), 1e-10)
+
+
+    def test_large_x(self):
+        #the shell is opaque; this used to overflow
+        mie = Mie(m=complex(1.33,1e-8),m2=complex(1.2,0.05),x=1.8e4,y=2e4)
+        self.assertTrue(numpy.isfinite(mie.qext()))
+        self.assertLess(abs(mie.qext()-2.0), 1e-2)
+        mie_h = Mie(m=complex(1.33,1e-8),m2=complex(1.33,1e-8),x=1.8e4,y=2e4)
+        mie_s = Mie(m=complex(1.33,1e-8),x=2e4)
+        for prop in ("qext", "qsca", "asy", "qb"):
+            self.assertLess(abs(getattr(mie_h,prop)()-getattr(mie_s,prop)()),
+                1e-10)
+
+        #sums and angular functions computed in blocks of orders
+        mie = Mie(m=complex(1.5,0.1),x=30.0)
+        u = numpy.linspace(-1.0, 1.0, 7)
+        (props_ref, S12_ref) = ([mie.qext(), mie.asy(), mie.qb()], mie.S12(u))
+        coeffs = mie._get_scatt_props()._coeffs
+        (block, max_size) = (mie_props._ORDER_BLOCK, mie_props._PT_MAX_SIZE)
+        try:
+            mie_props._ORDER_BLOCK = 5
+            mie_props._PT_MAX_SIZE = 1
+            props = mie_props.mie_props(coeffs, 30.0)
+            S12 = mie_props.mie_S12(coeffs, u)
+        finally:
+            (mie_props._ORDER_BLOCK, mie_props._PT_MAX_SIZE) = \
+                (block, max_size)
+        for (p, p_ref) in zip((props["qext"], props["asy"], props["qb"]),
+            props_ref):
+            self.assertLess(abs(p-p_ref)/p_ref, epsilon)
+        for i in range(2):
+            self.assertLess(abs(S12[i]-S12_ref[i]).max()/
+                abs(S12_ref[i]).max(), epsilon)
+
+        #the chunks are limited by the number of coefficients
+        x = numpy.concatenate((numpy.linspace(0.1,10,500),
+            numpy.linspace(1e3,2e4,100)))
+        chunks = _size_chunks({"x":x, "y":None}, 256)
+        self.assertEqual(sorted(numpy.concatenate(chunks)), list(range(600)))
+        for ind in chunks:
+            self.assertTrue(len(ind) == 1 or len(ind)*mie_coeffs._nmax(
+                x[ind]).max() <= MAX_CHUNK_COEFFS)
+
+
+
+@unittest.skipUnless("numba" in mie_backend.available_backends(),
+    "numba is not installed")
+class MieNumbaTests(MieTests):
+    backend = "numba"
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -9,7 +9,9 @@ interface.
 
 Based on code by C. Mätzler; ported and published with permission.
 
-Requires NumPy and SciPy.
+Requires NumPy. SciPy is optional and only used for cross-checking
+the Riccati-Bessel functions in the tests. If numba is installed, it is
+used to compile the recurrences.
 """
 
 setup(name='pymiecoated',